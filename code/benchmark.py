@@ -0,0 +1,555 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to measure the speed (and check the correctness) of
+alternative ways of running our models. It's used by the benchmark modes in main.py"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import re
+import time
+import threading
+import resource
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+import tensorflow as tf
+
+from data_batcher import Batch
+from session_config import get_session_config
+from distributed import run_local_cluster
+from evaluate import exact_match_score, f1_score
+from span_scorer import SpanScorer
+from official_eval_helper import get_batch_generator, generate_answers
+
+
+def slice_batch(batch, num_examples):
+    """Returns a Batch containing the first num_examples examples of batch"""
+    def first(x):
+        return x[:num_examples] if x is not None else None
+    return Batch(first(batch.context_ids), first(batch.context_mask), first(batch.context_tokens),
+                 first(batch.qn_ids), first(batch.qn_mask), first(batch.qn_tokens),
+                 first(batch.ans_span), first(batch.ans_tokens), uuids=first(batch.uuids))
+
+
+def mean_time(fn, inputs):
+    """
+    Calls fn on each of inputs (after one untimed warm-up call)
+    and returns the mean time per call in seconds.
+    """
+    fn(inputs[0])
+    tic = time.time()
+    for x in inputs:
+        fn(x)
+    toc = time.time()
+    return (toc - tic) / len(inputs)
+
+
+def benchmark_numpy_inference(session, tf_model, np_model, batches, batch_sizes, tolerance=1e-4):
+    """
+    Checks that the NumPy forward pass (see numpy_inference.py) gives the same
+    start/end distributions as the TensorFlow model, and compares their latency.
+
+    Inputs:
+      session: TensorFlow session, with tf_model's variables restored
+      tf_model: BaselineModel
+      np_model: NumpyModel, with weights loaded from the same checkpoint
+      batches: list of Batch objects
+      batch_sizes: list of ints. Batch sizes to measure latency for.
+      tolerance: float. Largest allowed absolute difference between the distributions.
+
+    Returns:
+      results: dictionary with the max absolute difference ("max_diff")
+        and, for each batch size, the mean latency per batch in seconds of each implementation.
+    """
+    # Parity check
+    max_diff = 0.
+    for batch in batches:
+        tf_dists = tf_model.get_prob_dists(session, batch)
+        np_dists = np_model.get_prob_dists(None, batch)
+        for tf_dist, np_dist in zip(tf_dists, np_dists):
+            max_diff = max(max_diff, float(np.max(np.abs(tf_dist - np_dist))))
+    print "Max absolute difference between TensorFlow and NumPy distributions: %g" % max_diff
+    if max_diff > tolerance:
+        raise Exception("NumPy forward pass doesn't match TensorFlow (max difference %g > %g)" % (max_diff, tolerance))
+
+    # Latency
+    results = {"max_diff": max_diff}
+    for batch_size in batch_sizes:
+        sliced = [slice_batch(batch, batch_size) for batch in batches]
+        tf_time = mean_time(lambda b: tf_model.get_prob_dists(session, b), sliced)
+        np_time = mean_time(lambda b: np_model.get_prob_dists(None, b), sliced)
+        print "Batch size %i: TensorFlow %.2f ms/batch, NumPy %.2f ms/batch" % (batch_size, tf_time * 1000, np_time * 1000)
+        results[batch_size] = {"tensorflow": tf_time, "numpy": np_time}
+
+    return results
+
+
+def f1_em_and_speed(session, model, batches):
+    """
+    Computes F1/EM of model's predictions on batches, and its throughput.
+
+    Inputs:
+      session: TensorFlow session (ignored by NumpyModels)
+      model: anything with a get_start_end_pos method (e.g. BaselineModel or NumpyModel)
+      batches: list of Batch objects, with ans_tokens
+
+    Returns:
+      f1, em: floats. The average across the examples.
+      examples_per_sec: float.
+    """
+    f1_total = 0.
+    em_total = 0.
+    example_num = 0
+    tic = time.time()
+    for batch in batches:
+        pred_start_pos, pred_end_pos = model.get_start_end_pos(session, batch)
+        for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos.tolist(), pred_end_pos.tolist(), batch.ans_tokens)):
+            pred_answer = " ".join(batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1])
+            true_answer = " ".join(true_ans_tokens)
+            f1_total += f1_score(pred_answer, true_answer)
+            em_total += exact_match_score(pred_answer, true_answer)
+            example_num += 1
+    toc = time.time()
+    return f1_total / example_num, em_total / example_num, example_num / (toc - tic)
+
+
+def benchmark_quantization(float_model, quantized_model, batches):
+    """
+    Compares dev F1/EM and throughput of a NumpyModel before and after int8 quantization (see quantization.py).
+    The int8 weights are dequantized when the NumpyModel is built, so only F1/EM should differ.
+
+    Inputs:
+      float_model, quantized_model: NumpyModels with the float32 and quantized weights of the same checkpoint
+      batches: list of Batch objects, with ans_tokens
+
+    Returns:
+      results: dictionary mapping "float32" and "int8" to (f1, em, examples_per_sec)
+    """
+    results = {}
+    for name, model in [("float32", float_model), ("int8", quantized_model)]:
+        results[name] = f1_em_and_speed(None, model, batches)
+        print "%s: F1 %.4f, EM %.4f, %.1f examples/sec" % ((name,) + results[name])
+
+    f1_delta = results["int8"][0] - results["float32"][0]
+    em_delta = results["int8"][1] - results["float32"][1]
+    speedup = results["int8"][2] / results["float32"][2]
+    print "int8 - float32: F1 %+.4f, EM %+.4f, throughput x%.2f" % (f1_delta, em_delta, speedup)
+    return results
+
+
+def synthetic_batch(FLAGS, vocab_size, rng):
+    """
+    Makes a full-size Batch of random word ids, for timing the model without reading data.
+
+    Inputs:
+      FLAGS: the flags passed in from main.py. Uses batch_size, context_len and question_len.
+      vocab_size: int. Word ids are drawn from [2, vocab_size), i.e. no padding or UNKs.
+      rng: np.random.RandomState
+
+    Returns:
+      batch: a Batch with every context and question at full length
+    """
+    batch_size, context_len, question_len = FLAGS.batch_size, FLAGS.context_len, FLAGS.question_len
+    context_ids = rng.randint(2, vocab_size, size=(batch_size, context_len))
+    qn_ids = rng.randint(2, vocab_size, size=(batch_size, question_len))
+    ans_starts = rng.randint(0, context_len, size=batch_size)
+    ans_ends = np.minimum(ans_starts + rng.randint(0, 5, size=batch_size), context_len - 1)
+    ans_span = np.stack([ans_starts, ans_ends], axis=1) # shape (batch_size, 2)
+    no_tokens = [None] * batch_size # the models only need the ids
+    return Batch(context_ids, np.ones_like(context_ids, dtype=np.int32), no_tokens, qn_ids, np.ones_like(qn_ids, dtype=np.int32), no_tokens, ans_span, no_tokens)
+
+
+def time_train_and_inference(session, model, batch, num_steps, summary_writer):
+    """
+    Times model on batch.
+
+    The first step is run separately, so graph optimization (and XLA compilation) isn't counted.
+
+    Returns:
+      train_time, inference_time: mean seconds per training step / per forward pass
+    """
+    train_time = mean_time(lambda b: model.run_train_iter(session, b, summary_writer), [batch] * num_steps)
+    inference_time = mean_time(lambda b: model.get_prob_dists(session, b), [batch] * num_steps)
+    return train_time, inference_time
+
+
+def benchmark_xla(FLAGS, models, id2word, word2id, emb_matrix, num_steps):
+    """
+    Reports step time with and without XLA JIT compilation for each model.
+
+    Inputs:
+      FLAGS: the flags passed in from main.py
+      models: dictionary mapping model name to model class (main.models)
+      id2word, word2id, emb_matrix: as passed to the model constructors
+      num_steps: int. How many steps to time, per model and setting.
+
+    Returns:
+      results: dictionary mapping (model name, xla_jit) to (train_time, inference_time)
+    """
+    summary_dir = tempfile.mkdtemp()
+    batch = synthetic_batch(FLAGS, len(word2id), np.random.RandomState(0))
+    results = {}
+    try:
+        for model_name in sorted(models):
+            for xla_jit in [False, True]:
+                # Build each model in a fresh graph
+                tf.reset_default_graph()
+                tf.set_random_seed(42)
+                model = models[model_name](FLAGS, id2word, word2id, emb_matrix)
+                with tf.Session(config=get_session_config(xla_jit=xla_jit)) as sess:
+                    sess.run(tf.global_variables_initializer())
+                    summary_writer = tf.summary.FileWriter(summary_dir)
+                    results[(model_name, xla_jit)] = time_train_and_inference(sess, model, batch, num_steps, summary_writer)
+                    summary_writer.close()
+
+            no_jit, jit = results[(model_name, False)], results[(model_name, True)]
+            print "%s: train step %.1f ms (XLA %.1f ms), forward pass %.1f ms (XLA %.1f ms)" % (model_name, no_jit[0] * 1000, jit[0] * 1000, no_jit[1] * 1000, jit[1] * 1000)
+    finally:
+        shutil.rmtree(summary_dir)
+
+    return results
+
+
+TRAIN_STEP_TIME_MSG = "Train step time: %.6f seconds" # printed by benchmark_train_step mode
+PEAK_MEMORY_MSG = "Peak memory: %.1f MB" # printed by benchmark_train_step mode
+
+
+def benchmark_train_step(session, model, FLAGS, vocab_size, num_steps):
+    """
+    Prints and returns the mean train step time of model on a synthetic batch,
+    using session's threading settings. The variables must already be initialized.
+    Also prints the peak memory usage of the process.
+
+    If num_steps is None, trains until the process is stopped instead
+    (this is what the non-chief workers do in benchmark_scaling mode).
+    """
+    batch = synthetic_batch(FLAGS, vocab_size, np.random.RandomState(0))
+    summary_dir = tempfile.mkdtemp()
+    try:
+        summary_writer = tf.summary.FileWriter(summary_dir)
+        if num_steps is None:
+            while True:
+                model.run_train_iter(session, batch, summary_writer)
+        train_time, _ = time_train_and_inference(session, model, batch, num_steps, summary_writer)
+        summary_writer.close()
+    finally:
+        shutil.rmtree(summary_dir)
+    print TRAIN_STEP_TIME_MSG % train_time
+    print PEAK_MEMORY_MSG % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.) # ru_maxrss is in KB on Linux
+    return train_time
+
+
+def run_train_step_trial(trial_command):
+    """
+    Runs main.py in benchmark_train_step mode in a fresh process.
+    A fresh process is needed because TensorFlow fixes its thread pools when the first session
+    in a process is created, and because peak memory can only be measured per process.
+
+    Inputs:
+      trial_command: list of strings. Command that runs main.py in benchmark_train_step mode.
+
+    Returns:
+      step_time: float. Mean train step time in seconds.
+      peak_memory: float. Peak memory usage of the process in MB.
+    """
+    return parse_train_step_output(subprocess.check_output(trial_command), " ".join(trial_command))
+
+
+def parse_train_step_output(output, description):
+    """
+    Inputs:
+      output: string. Output of main.py in benchmark_train_step mode.
+      description: string. What produced the output (for the error message).
+
+    Returns:
+      step_time, peak_memory: as for run_train_step_trial
+    """
+    results = []
+    for msg in [TRAIN_STEP_TIME_MSG, PEAK_MEMORY_MSG]:
+        match = re.search(re.escape(msg.split("%")[0]) + "([0-9.]+)", output) # the number follows the message text
+        if not match:
+            raise Exception("Couldn't find '%s' in the output of %s" % (msg, description))
+        results.append(float(match.group(1)))
+    return tuple(results)
+
+
+def thread_candidates(num_cores):
+    """
+    Returns the (intra_op_threads, inter_op_threads) settings that autotune_threads tries:
+    powers of two (and num_cores itself) for the intra-op pool, and 1 or 2 inter-op threads.
+    """
+    intra = set([num_cores])
+    n = 1
+    while n < num_cores:
+        intra.add(n)
+        n *= 2
+    inter = [n for n in [1, 2] if n <= num_cores]
+    return [(i, j) for i in sorted(intra) for j in inter]
+
+
+def autotune_threads(trial_command, candidates):
+    """
+    Finds the fastest thread pool sizes for training.
+
+    Inputs:
+      trial_command: list of strings. Command that runs main.py in benchmark_train_step mode;
+        the --intra_op_threads and --inter_op_threads flags are appended to it.
+      candidates: list of (intra_op_threads, inter_op_threads) pairs
+
+    Returns:
+      best: the fastest (intra_op_threads, inter_op_threads) pair
+      best_time: float. Its mean train step time in seconds.
+    """
+    best, best_time = None, float("inf")
+    for intra_op_threads, inter_op_threads in candidates:
+        step_time, _ = run_train_step_trial(trial_command + ["--intra_op_threads=%i" % intra_op_threads, "--inter_op_threads=%i" % inter_op_threads])
+        print "intra_op_threads=%i, inter_op_threads=%i: train step %.1f ms" % (intra_op_threads, inter_op_threads, step_time * 1000)
+        if step_time < best_time:
+            best, best_time = (intra_op_threads, inter_op_threads), step_time
+    return best, best_time
+
+
+def benchmark_recompute(trial_command, batch_sizes):
+    """
+    Reports peak memory and train step time with and without recomputation (--recompute),
+    at each batch size.
+
+    Inputs:
+      trial_command: list of strings. Command that runs main.py in benchmark_train_step mode;
+        the --batch_size and --recompute flags are appended to it.
+      batch_sizes: list of ints
+
+    Returns:
+      results: dictionary mapping (batch_size, recompute) to (step_time, peak_memory)
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        for recompute in [False, True]:
+            results[(batch_size, recompute)] = run_train_step_trial(trial_command + ["--batch_size=%i" % batch_size, "--recompute=%s" % recompute])
+        no_rc, rc = results[(batch_size, False)], results[(batch_size, True)]
+        print "Batch size %i: %.1f ms, %.0f MB without recomputation; %.1f ms, %.0f MB with recomputation" % (batch_size, no_rc[0] * 1000, no_rc[1], rc[0] * 1000, rc[1])
+    return results
+
+
+def benchmark_scaling(trial_command, max_workers, batch_size):
+    """
+    Reports train step time and throughput of synchronous data-parallel training
+    (see distributed.py) with 1, 2, 4, ... up to max_workers workers on this host.
+    Every worker processes batch_size examples per step, so the global batch grows with the number of workers.
+
+    Inputs:
+      trial_command: list of strings. Command that runs main.py in benchmark_train_step mode;
+        the --num_workers flag is appended to it.
+      max_workers: int
+      batch_size: int. The per-worker batch size.
+
+    Returns:
+      results: dictionary mapping number of workers to (step_time, examples_per_sec)
+    """
+    worker_counts = [2 ** i for i in range(int(np.log2(max_workers)) + 1)]
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+    results = {}
+    for num_workers in worker_counts:
+        command = trial_command + ["--num_workers=%i" % num_workers]
+        output = run_local_cluster(command, num_workers, capture_chief_output=True)
+        step_time, _ = parse_train_step_output(output, " ".join(command))
+        results[num_workers] = (step_time, num_workers * batch_size / step_time)
+        print "%i workers: train step %.1f ms, %.1f examples/sec (%.2fx the examples/sec of 1 worker)" % (num_workers, step_time * 1000, results[num_workers][1], results[num_workers][1] / results[1][1])
+    return results
+
+
+def benchmark_hogwild(FLAGS, model_class, id2word, word2id, emb_matrix, train_paths, dev_paths, thread_counts, train_secs):
+    """
+    Compares Hogwild training with several threads (see QAModel.train_thread) against single-threaded training.
+    For each number of threads, trains a freshly initialized model for train_secs seconds,
+    then reports the training throughput and the dev loss and F1 reached.
+
+    Inputs:
+      FLAGS: the flags passed in from main.py
+      model_class: the model to train (e.g. QAModel or BiDAFModel)
+      id2word, word2id, emb_matrix: as passed to the model constructor
+      train_paths, dev_paths: tuples of paths to the {train/dev}.{context/question/answer} data files
+      thread_counts: list of ints
+      train_secs: float. Training time per setting.
+
+    Returns:
+      results: dictionary mapping number of threads to (examples_per_sec, dev_loss, dev_f1)
+    """
+    summary_dir = tempfile.mkdtemp()
+    results = {}
+    try:
+        for num_threads in thread_counts:
+            # Build the model in a fresh graph, so every setting starts from the same initialization
+            tf.reset_default_graph()
+            tf.set_random_seed(42)
+            model = model_class(FLAGS, id2word, word2id, emb_matrix)
+            with tf.Session(config=get_session_config()) as sess:
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+                summary_writer = tf.summary.FileWriter(summary_dir)
+                stop_event = threading.Event()
+                examples_trained = [0] * num_threads
+                threads = [threading.Thread(target=model.train_thread, args=(sess,) + tuple(train_paths) + (i, num_threads, summary_writer, stop_event, examples_trained, i)) for i in range(num_threads)]
+                tic = time.time()
+                for thread in threads:
+                    thread.start()
+                time.sleep(train_secs)
+                stop_event.set()
+                for thread in threads:
+                    thread.join()
+                toc = time.time()
+                summary_writer.close()
+
+                dev_context_path, dev_qn_path, dev_ans_path = dev_paths
+                dev_loss = model.get_dev_loss(sess, dev_context_path, dev_qn_path, dev_ans_path)
+                dev_f1, _ = model.check_f1_em(sess, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=0)
+                results[num_threads] = (sum(examples_trained) / (toc - tic), dev_loss, dev_f1)
+
+            print "%i threads: %.1f examples/sec (%.2fx 1 thread), dev loss %.4f, dev F1 %.4f after %.0f seconds" % (num_threads, results[num_threads][0], results[num_threads][0] / results[thread_counts[0]][0], dev_loss, dev_f1, train_secs)
+    finally:
+        shutil.rmtree(summary_dir)
+
+    return results
+
+
+def benchmark_span_scorer(batches, rng):
+    """
+    Checks that SpanScorer gives the same F1/EM as evaluate.f1_score and exact_match_score,
+    and compares their speed. The predicted spans are random, plus the true spans
+    (so exact matches are covered too).
+
+    Inputs:
+      batches: list of Batches, e.g. the dev set from load_batches
+      rng: np.random.RandomState
+
+    Returns:
+      max_f1_diff, max_em_diff: largest differences between the two scorers' per-example scores
+    """
+    inputs = [] # (batch, starts, ends) triples
+    for batch in batches:
+        context_lens = np.array([len(context_tokens) for context_tokens in batch.context_tokens])
+        starts = (rng.rand(batch.batch_size) * context_lens).astype(np.int64)
+        ends = starts + rng.randint(-1, 15, size=batch.batch_size) # sometimes empty (end < start)
+        inputs.append((batch, starts, ends))
+        inputs.append((batch, batch.ans_span[:, 0], batch.ans_span[:, 1]))
+
+    def score_strings(batch, starts, ends):
+        pred_answers = [" ".join(context_tokens[start : end + 1]) for context_tokens, start, end in zip(batch.context_tokens, starts, ends)]
+        true_answers = [" ".join(ans_tokens) for ans_tokens in batch.ans_tokens]
+        f1 = [f1_score(pred_answer, true_answer) for pred_answer, true_answer in zip(pred_answers, true_answers)]
+        em = [exact_match_score(pred_answer, true_answer) for pred_answer, true_answer in zip(pred_answers, true_answers)]
+        return np.array(f1, dtype=np.float64), np.array(em, dtype=np.float64)
+
+    # Each batch is scored twice, so the SpanScorer time includes encoding each batch once
+    scorer = SpanScorer()
+    string_time = mean_time(lambda x: score_strings(*x), inputs)
+    scorer_time = mean_time(lambda x: scorer.score_batch(*x), inputs)
+
+    max_f1_diff, max_em_diff = 0., 0.
+    for batch, starts, ends in inputs:
+        string_f1, string_em = score_strings(batch, starts, ends)
+        f1, em = scorer.score_batch(batch, starts, ends)
+        max_f1_diff = max(max_f1_diff, float(np.max(np.abs(f1 - string_f1))))
+        max_em_diff = max(max_em_diff, float(np.max(np.abs(em - string_em))))
+
+    print "evaluate.py: %.2f ms per batch. SpanScorer: %.2f ms per batch (%.1fx faster)" % (string_time * 1000, scorer_time * 1000, string_time / scorer_time)
+    print "Largest difference in F1: %g, in EM: %g, over %i examples" % (max_f1_diff, max_em_diff, sum(batch.batch_size for batch, _, _ in inputs))
+    return max_f1_diff, max_em_diff
+
+
+def benchmark_eval_batcher(FLAGS, word2id, question_counts, rng):
+    """
+    Times official_eval_helper.get_batch_generator on synthetic inputs with each number of
+    questions in question_counts (e.g. up to 1M), to check that batching time is linear in
+    the number of questions. For comparison, also times emptying the same input lists with
+    pop(0), as official_eval's batcher used to. That is quadratic, so it's only timed up to
+    100,000 questions.
+
+    Inputs:
+      FLAGS: the flags passed in from main.py. Uses batch_size, context_len, question_len and doc_stride.
+      word2id: dictionary mapping word (string) to word id (int)
+      question_counts: list of ints
+      rng: np.random.RandomState
+
+    Returns:
+      batch_times: list of floats. Seconds to batch each input.
+    """
+    # The questions share a pool of contexts and questions (with lengths like SQuAD's), so that a 1M-question input fits in memory
+    words = sorted(word2id)
+    contexts = [[words[i] for i in rng.randint(len(words), size=rng.randint(20, 300))] for _ in range(1000)]
+    questions = [[words[i] for i in rng.randint(len(words), size=rng.randint(3, 25))] for _ in range(1000)]
+
+    batch_times = []
+    for num_questions in question_counts:
+        qn_uuid_data = ["%024x" % i for i in xrange(num_questions)]
+        context_token_data = [contexts[(i // 5) % len(contexts)] for i in xrange(num_questions)] # 5 questions per context, as in SQuAD
+        qn_token_data = [questions[i % len(questions)] for i in xrange(num_questions)]
+
+        tic = time.time()
+        num_batches = sum(1 for _ in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, FLAGS.batch_size, FLAGS.context_len, FLAGS.question_len, FLAGS.doc_stride))
+        batch_time = time.time() - tic
+        batch_times.append(batch_time)
+        assert len(qn_uuid_data) == num_questions # the input lists are left as they are
+
+        message = "%i questions: %i batches in %.2f seconds (%.2f us per question)" % (num_questions, num_batches, batch_time, batch_time * 1e6 / num_questions)
+        if num_questions <= 100000:
+            tic = time.time()
+            for data in [qn_uuid_data, context_token_data, qn_token_data]:
+                while data:
+                    data.pop(0)
+            message += ". Emptying the lists with pop(0) alone: %.2f seconds" % (time.time() - tic)
+        print message
+
+    return batch_times
+
+
+def benchmark_length_sorting(session, model, word2id, json_data, batch_size, sort_windows):
+    """
+    Compares official_eval's throughput with each sort window (see official_eval_helper.refill_batches;
+    0 keeps the input order), and checks that they give the same answers.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      json_data: (qn_uuid_data, context_token_data, qn_token_data), from get_json_data
+      batch_size: int
+      sort_windows: list of ints. The first is the baseline the others are compared to.
+
+    Returns:
+      questions_per_sec: list of floats, one per sort window
+    """
+    qn_uuid_data, context_token_data, qn_token_data = json_data
+
+    # Warm up
+    generate_answers(session, model, word2id, qn_uuid_data[:batch_size], context_token_data[:batch_size], qn_token_data[:batch_size], batch_size=batch_size)
+
+    questions_per_sec = []
+    all_answers = []
+    for sort_window in sort_windows:
+        tic = time.time()
+        answers = generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size=batch_size, sort_window=sort_window)
+        questions_per_sec.append(len(answers) / (time.time() - tic))
+        all_answers.append(answers)
+
+    for sort_window, speed, answers in zip(sort_windows, questions_per_sec, all_answers):
+        num_different = sum(answers[uuid] != all_answers[0].get(uuid) for uuid in answers)
+        print "sort_window=%i, batch_size=%i: %.1f questions/sec (%.2fx), %i answers different from sort_window=%i" % (sort_window, batch_size, speed, speed / questions_per_sec[0], num_different, sort_windows[0])
+
+    return questions_per_sec
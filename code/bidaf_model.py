@@ -71,6 +71,7 @@ class BiDAFModel(BaselineModel):
         # between the context and the question.
         encoder = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob)
         context_hiddens = encoder.build_graph(self.context_embs, self.context_mask) # (batch_size, context_len, hidden_size*2)
+        self.context_hiddens = context_hiddens # doesn't depend on the question, so can be cached at inference time (see get_prob_dists_cached)
         question_hiddens = encoder.build_graph(self.qn_embs, self.qn_mask) # (batch_size, question_len, hidden_size*2)
 
         # Use context hidden states to attend to question hidden states
@@ -77,8 +77,9 @@ class CompleteModel(BaselineModel):
         # First bidirection GRU layer
         ########################################
 
-        encoder = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob)
+        encoder = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob, recompute=self.FLAGS.recompute)
         context_hiddens = encoder.build_graph(self.context_embs, self.context_mask) # (batch_size, context_len, hidden_size*2)
+        self.context_hiddens = context_hiddens # doesn't depend on the question, so can be cached at inference time (see get_prob_dists_cached)
         question_hiddens = encoder.build_graph(self.qn_embs, self.qn_mask) # (batch_size, question_len, hidden_size*2)
 
         ####################
@@ -97,7 +98,7 @@ class CompleteModel(BaselineModel):
 
         # Bidaf layer after context and question attnetion is calculated. Based off oringinal BiDaf paper
 
-        encoder2 = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob)
+        encoder2 = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob, recompute=self.FLAGS.recompute)
         bidaf_second_layer_hiddens = encoder2.build_graph(blended_reps, self.context_mask, scope_name="BidafEncoder") # (batch_size, question_len, hidden_size*2)
 
         ####################
@@ -116,7 +117,7 @@ class CompleteModel(BaselineModel):
         # Bidaf third bidirection layer
         ####################
 
-        encoder3 = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob)
+        encoder3 = RNNEncoder(self.FLAGS.hidden_size, self.keep_prob, recompute=self.FLAGS.recompute)
         bidaf_third_layer = encoder3.build_graph(bidaf_second_layer_hiddens, self.context_mask, scope_name="SelfAttnBidaf") # (batch_size, question_len, hidden_size*2)
         
         final_context_reps = tf.contrib.layers.fully_connected(bidaf_third_layer, num_outputs=self.FLAGS.hidden_size) # final_context_reps is shape (batch_size, context_len, hidden_size)
@@ -126,7 +127,7 @@ class CompleteModel(BaselineModel):
         # ansptr_layer = AnsPtr(self.FLAGS.hidden_size, self.keep_prob)
 
         # BiDAF Output Layer
-        bidaf_out = BiDAFOut(self.FLAGS.hidden_size, self.keep_prob)
+        bidaf_out = BiDAFOut(self.FLAGS.hidden_size, self.keep_prob, recompute=self.FLAGS.recompute)
         self.logits_start, self.probdist_start, self.logits_end, self.probdist_end = bidaf_out.build_graph(attn_output, bidaf_second_layer_hiddens, self.context_mask)
 
 
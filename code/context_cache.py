@@ -0,0 +1,70 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a cache for context encodings, used at inference time"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ContextEncodingCache(object):
+    """
+    Bounded LRU cache mapping a context to its encoding (e.g. the output of the
+    context RNNEncoder). Many questions are asked about the same paragraph,
+    so at inference time we only need to encode each paragraph once.
+
+    Contexts are identified by a hash of their (padded) token ids.
+    """
+
+    def __init__(self, max_size):
+        """
+        Inputs:
+          max_size: int. Maximum number of encodings to keep.
+            Each encoding has shape (context_len, hidden_size*2), so this bounds the memory used.
+        """
+        self.max_size = max_size
+        self.encodings = OrderedDict() # maps key to encoding, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, context_ids):
+        """Returns the key for context_ids, a numpy array of token ids"""
+        return hashlib.sha1(np.ascontiguousarray(context_ids).tobytes()).digest()
+
+    def get(self, key):
+        """Returns the encoding for key, or None if it's not in the cache"""
+        encoding = self.encodings.pop(key, None)
+        if encoding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.encodings[key] = encoding # move to the most recently used end
+        return encoding
+
+    def put(self, key, encoding):
+        """Adds encoding to the cache, evicting the least recently used encodings if necessary"""
+        self.encodings.pop(key, None)
+        self.encodings[key] = encoding
+        while len(self.encodings) > self.max_size:
+            self.encodings.popitem(last=False)
+
+    def hit_rate(self):
+        """Fraction of lookups that were found in the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
@@ -0,0 +1,63 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a script to convert the JSONL predictions written by
+official_eval mode with --jsonl_out_path into the official predictions JSON
+(a single object mapping question id to answer, as written to --json_out_path),
+which evaluate.py and fast_evaluate.py read.
+
+Usage: python convert_predictions.py predictions.jsonl predictions.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import io
+import json
+
+
+def read_jsonl_predictions(jsonl_path):
+    """
+    Inputs:
+      jsonl_path: path to a JSONL file with one {"id": ..., "answer": ...} object per line
+
+    Returns:
+      predictions: dictionary mapping question id to answer.
+        If a question id appears more than once, the last answer is kept.
+    """
+    predictions = {}
+    with io.open(jsonl_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            prediction = json.loads(line)
+            predictions[prediction['id']] = prediction['answer']
+    return predictions
+
+
+def write_json_predictions(predictions, json_path):
+    """Writes the predictions dictionary to json_path, in the same format as official_eval mode"""
+    with io.open(json_path, 'w', encoding='utf-8') as f:
+        f.write(u"%s" % json.dumps(predictions, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert JSONL predictions to the official SQuAD predictions JSON')
+    parser.add_argument('jsonl_file', help='JSONL predictions file (from --jsonl_out_path)')
+    parser.add_argument('json_file', help='Output predictions JSON file')
+    args = parser.parse_args()
+    predictions = read_jsonl_predictions(args.jsonl_file)
+    write_json_predictions(predictions, args.json_file)
+    print("Wrote %i predictions to %s" % (len(predictions), args.json_file))
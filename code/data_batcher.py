@@ -23,14 +23,14 @@ import time
 import re
 
 import numpy as np
-from six.moves import xrange
+from six.moves import xrange, zip as izip
 from vocab import PAD_ID, UNK_ID
 
 
 class Batch(object):
     """A class to hold the information needed for a training batch"""
 
-    def __init__(self, context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens, uuids=None):
+    def __init__(self, context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens, uuids=None, window_starts=None, qn_idxs=None):
         """
         Inputs:
           {context/qn}_ids: Numpy arrays.
@@ -41,6 +41,12 @@ class Batch(object):
           ans_span: numpy array, shape (batch_size, 2)
           uuid: a list (length batch_size) of strings.
             Not needed for training. Used by official_eval mode.
+          window_starts: a list (length batch_size) of ints.
+            Not needed for training. Used by official_eval mode with doc_stride > 0.
+            The position in context_tokens where the context window in context_ids starts.
+          qn_idxs: a list (length batch_size) of ints.
+            Not needed for training. Used by official_eval mode.
+            The position of each example's question in the input (the examples are sorted by length).
         """
         self.context_ids = context_ids
         self.context_mask = context_mask
@@ -54,10 +60,71 @@ class Batch(object):
         self.ans_tokens = ans_tokens
 
         self.uuids = uuids
+        self.window_starts = window_starts
+        self.qn_idxs = qn_idxs
 
         self.batch_size = len(self.context_tokens)
 
 
+class MultiQuestionBatch(object):
+    """A class to hold a single context and several questions about it, for inference"""
+
+    def __init__(self, context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens):
+        """
+        Inputs:
+          context_ids, context_mask: Numpy arrays. Shape (1, context_len). Contains padding.
+            The context is only stored once; the model broadcasts it to every question.
+          context_tokens: List (unpadded) of tokens (strings)
+          qn_ids, qn_mask: Numpy arrays. Shape (num_questions, question_len). Contains padding.
+          qn_tokens: List length num_questions, containing lists (unpadded) of tokens (strings)
+        """
+        self.context_ids = context_ids
+        self.context_mask = context_mask
+        self.context_tokens = context_tokens
+
+        self.qn_ids = qn_ids
+        self.qn_mask = qn_mask
+        self.qn_tokens = qn_tokens
+
+        self.batch_size = len(self.qn_tokens)
+
+
+class ShardedFile(object):
+    """
+    Wraps a file so that readline() only returns lines shard_index, shard_index + num_shards, shard_index + 2*num_shards, ...
+    Wrapping the context, question and answer files the same way keeps them aligned.
+    """
+
+    def __init__(self, f, shard_index, num_shards):
+        self.f = f
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.line_num = 0 # number of lines read from f so far
+
+    def readline(self):
+        while True:
+            line = self.f.readline()
+            if not line: # end of file
+                return line
+            self.line_num += 1
+            if (self.line_num - 1) % self.num_shards == self.shard_index:
+                return line
+
+
+class LineList(object):
+    """Wraps a list of lines so it can be read like a file, with readline()"""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.line_num = 0 # number of lines read so far
+
+    def readline(self):
+        if self.line_num == len(self.lines):
+            return "" # end of file
+        self.line_num += 1
+        return self.lines[self.line_num - 1]
+
+
 def split_by_whitespace(sentence):
     words = []
     for space_separated_fragment in sentence.strip().split():
@@ -93,6 +160,28 @@ def padded(token_batch, batch_pad=0):
     return map(lambda token_list: token_list + [PAD_ID] * (maxlen - len(token_list)), token_batch)
 
 
+def make_multi_question_batch(word2id, context_tokens, qn_tokens_list, context_len, question_len):
+    """
+    Makes a MultiQuestionBatch for asking several questions about one context.
+
+    Inputs:
+      word2id: dictionary mapping word (string) to word id (int)
+      context_tokens: list of strings (no UNKs, no padding)
+      qn_tokens_list: list of lists of strings (no UNKs, no padding)
+      context_len, question_len: max length of context and question respectively.
+        Anything longer is truncated.
+    """
+    context_ids = [word2id.get(w, UNK_ID) for w in context_tokens][:context_len]
+    qn_ids = [[word2id.get(w, UNK_ID) for w in qn_tokens][:question_len] for qn_tokens in qn_tokens_list]
+
+    context_ids = np.array(padded([context_ids], context_len)) # shape (1, context_len)
+    context_mask = (context_ids != PAD_ID).astype(np.int32) # shape (1, context_len)
+    qn_ids = np.array(padded(qn_ids, question_len)) # shape (num_questions, question_len)
+    qn_mask = (qn_ids != PAD_ID).astype(np.int32) # shape (num_questions, question_len)
+
+    return MultiQuestionBatch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens_list)
+
+
 def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long):
     """
     Adds more batches into the "batches" list.
@@ -171,7 +260,7 @@ def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size
     return
 
 
-def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long):
+def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, shard_index=0, num_shards=1):
     """
     This function returns a generator object that yields batches.
     The last batch in the dataset will be a partial batch.
@@ -184,8 +273,20 @@ def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, co
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      shard_index, num_shards: ints. Only use every num_shards-th example, starting with example shard_index.
+        Used to give each worker or thread its own disjoint part of the data.
     """
     context_file, qn_file, ans_file = open(context_path), open(qn_path), open(ans_path)
+    if num_shards > 1:
+        context_file, qn_file, ans_file = [ShardedFile(f, shard_index, num_shards) for f in [context_file, qn_file, ans_file]]
+    return generate_batches(word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long)
+
+
+def generate_batches(word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long):
+    """
+    Like get_batch_generator, but reads from already open files
+    (or any objects with a readline method, e.g. ShardedFile or LineList).
+    """
     batches = []
 
     while True:
@@ -218,3 +319,63 @@ def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, co
         yield batch
 
     return
+
+
+def load_batches(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long):
+    """
+    Reads a whole dataset into memory as a list of Batches (see get_batch_generator for the inputs).
+    Use this for a dataset that's evaluated many times (e.g. the dev set during training),
+    so the files are only read, tokenized and padded once.
+
+    The id arrays are stored as int32 (the type of the model's placeholders), which halves their size.
+    """
+    batches = []
+    for batch in get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long):
+        batch.context_ids = batch.context_ids.astype(np.int32)
+        batch.qn_ids = batch.qn_ids.astype(np.int32)
+        batches.append(batch)
+    return batches
+
+
+def sample_lines(paths, num_samples, rng):
+    """
+    Draws a uniform random sample of num_samples examples from aligned data files,
+    in one pass without knowing the number of examples in advance (reservoir sampling).
+
+    Inputs:
+      paths: list of paths to aligned files, e.g. the {train}.{context/question/answer} files
+      num_samples: int
+      rng: np.random.RandomState
+
+    Returns:
+      samples: list (one per path) of lists of lines, each length min(num_samples, number of examples).
+        The lists are aligned: samples[i][j] is the line in paths[i] for the j-th sampled example.
+    """
+    reservoir = [] # list of tuples of lines, one line per file
+    files = [open(path) for path in paths]
+    for example_num, lines in enumerate(izip(*files)):
+        if example_num < num_samples:
+            reservoir.append(lines)
+        else:
+            # Replace a random sample with this example, with probability num_samples / (example_num + 1)
+            idx = rng.randint(0, example_num + 1)
+            if idx < num_samples:
+                reservoir[idx] = lines
+    for f in files:
+        f.close()
+    return [list(file_lines) for file_lines in zip(*reservoir)] if reservoir else [[] for _ in paths]
+
+
+def load_sampled_batches(word2id, context_path, qn_path, ans_path, num_samples, rng, batch_size, context_len, question_len):
+    """
+    Draws a uniform random sample of num_samples examples (see sample_lines) and returns them
+    as a list of Batches, truncating long examples (as with discard_long=False).
+    The ids are stored as int32, as in load_batches.
+    """
+    context_lines, qn_lines, ans_lines = sample_lines([context_path, qn_path, ans_path], num_samples, rng)
+    batches = []
+    for batch in generate_batches(word2id, LineList(context_lines), LineList(qn_lines), LineList(ans_lines), batch_size, context_len, question_len, discard_long=False):
+        batch.context_ids = batch.context_ids.astype(np.int32)
+        batch.qn_ids = batch.qn_ids.astype(np.int32)
+        batches.append(batch)
+    return batches
@@ -0,0 +1,103 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code for synchronous data-parallel training on one host.
+
+The cluster has one parameter server process (which holds the variables) and
+num_workers worker processes, all on localhost. Each worker trains on its own shard
+of the training data, and SyncReplicasOptimizer averages the workers' gradients
+before each update. Worker 0 is the chief: it initializes the variables, saves checkpoints
+and evaluates, and training ends when it has done num_epochs epochs of its shard.
+
+run_local_cluster starts all the processes (by running main.py again with --job_name and
+--task_index) and stops them once the chief exits.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+import subprocess
+
+import tensorflow as tf
+
+
+def make_local_cluster(num_workers, ps_port):
+    """
+    Inputs:
+      num_workers: int. Number of worker tasks.
+      ps_port: int. Port of the parameter server. The workers use the following ports.
+
+    Returns:
+      tf.train.ClusterSpec with jobs "ps" (1 task) and "worker" (num_workers tasks)
+    """
+    return tf.train.ClusterSpec({
+        "ps": ["localhost:%i" % ps_port],
+        "worker": ["localhost:%i" % (ps_port + 1 + i) for i in range(num_workers)],
+    })
+
+
+def run_local_cluster(command, num_workers, capture_chief_output=False):
+    """
+    Runs a parameter server and num_workers workers as separate processes,
+    waits for the chief worker to finish, then terminates the rest
+    (the parameter server and the other workers run until they're stopped).
+
+    Inputs:
+      command: list of strings. Command that runs main.py with the flags for this cluster.
+        --job_name and --task_index are appended to it for each process.
+      num_workers: int
+      capture_chief_output: If True, return the chief's stdout instead of printing it.
+
+    Returns:
+      The chief's stdout if capture_chief_output, otherwise None.
+    """
+    def start(job_name, task_index, stdout=None):
+        return subprocess.Popen(command + ["--job_name=%s" % job_name, "--task_index=%i" % task_index], stdout=stdout)
+
+    others = [start("ps", 0)] + [start("worker", i) for i in range(1, num_workers)]
+    try:
+        chief = start("worker", 0, stdout=subprocess.PIPE if capture_chief_output else None)
+        output, _ = chief.communicate()
+        if chief.returncode != 0:
+            raise Exception("The chief worker failed with exit code %i" % chief.returncode)
+    finally:
+        for process in others:
+            if process.poll() is None:
+                process.terminate()
+        for process in others:
+            process.wait()
+    return output
+
+
+def wait_for_chief(session, poll_secs=1):
+    """
+    For non-chief workers: waits until the chief has initialized (or restored) the variables,
+    then initializes this worker's local variables.
+    """
+    uninitialized = tf.report_uninitialized_variables(tf.global_variables())
+    while session.run(uninitialized).size > 0:
+        time.sleep(poll_secs)
+    session.run(tf.local_variables_initializer())
+
+
+def start_sync_replicas(session, model, is_chief):
+    """
+    Runs the SyncReplicasOptimizer's initialization for this worker
+    (and, on the chief, starts the thread that applies the averaged gradients).
+    Call this after the variables are initialized.
+    """
+    hook = model.sync_optimizer.make_session_run_hook(is_chief)
+    hook.begin()
+    hook.after_create_session(session, tf.train.Coordinator())
@@ -0,0 +1,84 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains the evaluation worker, which evaluates the checkpoints
+saved by a training run in a separate process, so that training never stops to evaluate.
+
+Run training with --async_eval, and main.py in eval_worker mode with the same
+--experiment_name (or --train_dir) alongside it.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+
+def run_eval_worker(session, model, FLAGS, train_paths, dev_paths):
+    """
+    Waits for new checkpoints in FLAGS.train_dir and evaluates each one (see QAModel.evaluate),
+    writing the results to tensorboard in FLAGS.train_dir and keeping the checkpoint with the best
+    dev EM in the best_checkpoint directory.
+
+    If the training run saves checkpoints faster than they can be evaluated, some are skipped:
+    the next one evaluated is always the latest.
+
+    Inputs:
+      session: TensorFlow session
+      model: the model, built with training=False
+      FLAGS: the flags passed in from main.py. Uses train_dir, eval_interval_secs, eval_timeout_secs and train_eval_refresh.
+      train_paths, dev_paths: tuples of paths to the {train/dev}.{context/question/answer} data files
+    """
+    bestmodel_ckpt_path = os.path.join(FLAGS.train_dir, "best_checkpoint", "qa_best.ckpt")
+    best_dev_em = None
+    summary_writer = tf.summary.FileWriter(FLAGS.train_dir)
+    train_context_path, train_qn_path, train_ans_path = train_paths
+    dev_context_path, dev_qn_path, dev_ans_path = dev_paths
+
+    dev_batches = model.load_dev_batches(dev_context_path, dev_qn_path, dev_ans_path)
+
+    # Train F1/EM is estimated on a random sample of the train set, as in QAModel.train
+    train_eval_rng = np.random.RandomState(42)
+    train_batches = None
+    num_evals = 0
+
+    timeout = FLAGS.eval_timeout_secs or None # None means wait forever
+    for checkpoint_path in tf.contrib.training.checkpoints_iterator(FLAGS.train_dir, min_interval_secs=FLAGS.eval_interval_secs, timeout=timeout):
+        try:
+            model.saver.restore(session, checkpoint_path)
+        except tf.errors.NotFoundError:
+            # The training run deletes old checkpoints (see --keep)
+            logging.info("Checkpoint %s was deleted before it could be evaluated" % checkpoint_path)
+            continue
+        global_step = session.run(model.global_step)
+
+        if train_batches is None or (FLAGS.train_eval_refresh and num_evals % FLAGS.train_eval_refresh == 0):
+            train_batches = model.sample_train_eval_batches(train_context_path, train_qn_path, train_ans_path, train_eval_rng)
+        num_evals += 1
+        dev_f1, dev_em = model.evaluate(session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path, global_step, summary_writer, "Iter %d" % global_step, dev_batches=dev_batches, train_batches=train_batches)
+        summary_writer.flush()
+
+        # Early stopping based on dev EM, as in QAModel.train.
+        # (The best checkpoint doesn't include the optimizer's slot variables, since this model has no optimizer.)
+        if best_dev_em is None or dev_em > best_dev_em:
+            best_dev_em = dev_em
+            logging.info("Saving to %s..." % bestmodel_ckpt_path)
+            model.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+
+    logging.info("No new checkpoint in %s for %i seconds, stopping" % (FLAGS.train_dir, FLAGS.eval_timeout_secs))
+    summary_writer.close()
@@ -0,0 +1,180 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a faster version of the official evaluation script (evaluate.py),
+for scoring many prediction files (e.g. checkpoints or ensembles) against a large dataset.
+
+Each ground truth answer is normalized once (not once per prediction file and ground truth),
+the articles are split into shards that are scored by a pool of processes,
+and any number of prediction files are scored in one invocation.
+The scores are the same as evaluate.py's: the per-question scores are added up in
+dataset order, exactly as evaluate.py does.
+
+Usage: python fast_evaluate.py dataset_file prediction_file [prediction_file ...]
+With one prediction file, the output is the same as evaluate.py's.
+With several, each line of the output is the prediction file name, a tab and its scores.
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+from collections import Counter
+import argparse
+import json
+import multiprocessing
+import sys
+
+from evaluate import normalize_answer
+
+
+# Set in each worker process by init_worker
+worker_dataset = None
+worker_predictions = None
+
+
+def init_worker(dataset, predictions_list):
+    global worker_dataset, worker_predictions
+    worker_dataset = dataset
+    worker_predictions = predictions_list
+
+
+def f1_from_tokens(prediction_tokens, ground_truth_tokens):
+    """Same as evaluate.f1_score, on normalized tokens"""
+    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
+    num_same = sum(common.values())
+    if num_same == 0:
+        return 0
+    precision = 1.0 * num_same / len(prediction_tokens)
+    recall = 1.0 * num_same / len(ground_truth_tokens)
+    f1 = (2 * precision * recall) / (precision + recall)
+    return f1
+
+
+def score_shard(shard):
+    """
+    Scores every prediction file on the questions of the articles in shard.
+
+    Inputs:
+      shard: (first, last) indices of the articles in worker_dataset
+
+    Returns:
+      scores: list (one per prediction file) of lists (one per question, in dataset order).
+        Each item is (exact_match, f1) for the question, or None if it wasn't answered.
+    """
+    first, last = shard
+
+    # Normalize each ground truth once
+    questions = [] # list of (question id, list of normalized ground truth token lists)
+    for article in worker_dataset[first:last]:
+        for paragraph in article['paragraphs']:
+            for qa in paragraph['qas']:
+                ground_truths = [normalize_answer(answer['text']).split() for answer in qa['answers']]
+                questions.append((qa['id'], ground_truths))
+
+    scores = []
+    normalized_predictions = {} # normalized tokens of each prediction string, shared by the prediction files
+    for predictions in worker_predictions:
+        file_scores = []
+        for qid, ground_truths in questions:
+            if qid not in predictions:
+                file_scores.append(None)
+                continue
+            prediction = predictions[qid]
+            if prediction not in normalized_predictions:
+                normalized_predictions[prediction] = normalize_answer(prediction).split()
+            prediction_tokens = normalized_predictions[prediction]
+            # as evaluate.metric_max_over_ground_truths
+            exact_match = max([prediction_tokens == ground_truth_tokens for ground_truth_tokens in ground_truths])
+            f1 = max([f1_from_tokens(prediction_tokens, ground_truth_tokens) for ground_truth_tokens in ground_truths])
+            file_scores.append((exact_match, f1))
+        scores.append(file_scores)
+    return scores
+
+
+def evaluate(dataset, predictions_list, num_processes=None, num_shards=None):
+    """
+    Scores several sets of predictions against dataset, like evaluate.evaluate.
+
+    Inputs:
+      dataset: the 'data' list of the SQuAD JSON
+      predictions_list: list of dictionaries mapping question id to predicted answer
+      num_processes: int. Size of the process pool. Defaults to the number of CPUs.
+      num_shards: int. How many parts to split the articles into. Defaults to 4 per process.
+
+    Returns:
+      results: list of {'exact_match': ..., 'f1': ...} dictionaries, one per set of predictions
+    """
+    num_processes = num_processes or multiprocessing.cpu_count()
+    num_shards = min(num_shards or 4 * num_processes, len(dataset)) or 1
+    shards = [(len(dataset) * i // num_shards, len(dataset) * (i + 1) // num_shards) for i in range(num_shards)]
+
+    if num_processes == 1:
+        init_worker(dataset, predictions_list)
+        shard_scores = list(map(score_shard, shards))
+    else:
+        pool = multiprocessing.Pool(num_processes, initializer=init_worker, initargs=(dataset, predictions_list))
+        try:
+            shard_scores = pool.map(score_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Add up the scores in dataset order, as evaluate.evaluate does
+    question_ids = [qa['id'] for article in dataset for paragraph in article['paragraphs'] for qa in paragraph['qas']]
+    results = []
+    for file_idx in range(len(predictions_list)):
+        f1 = exact_match = total = 0
+        question_scores = [score for scores in shard_scores for score in scores[file_idx]]
+        for qid, score in zip(question_ids, question_scores):
+            total += 1
+            if score is None:
+                message = 'Unanswered question ' + qid + \
+                          ' will receive score 0.'
+                print(message, file=sys.stderr)
+                continue
+            exact_match += score[0]
+            f1 += score[1]
+
+        exact_match = 100.0 * exact_match / total
+        f1 = 100.0 * f1 / total
+        results.append({'exact_match': exact_match, 'f1': f1})
+
+    return results
+
+
+if __name__ == '__main__':
+    expected_version = '1.1'
+    parser = argparse.ArgumentParser(
+        description='Fast evaluation for SQuAD ' + expected_version)
+    parser.add_argument('dataset_file', help='Dataset file')
+    parser.add_argument('prediction_files', nargs='+', help='Prediction files')
+    parser.add_argument('--num_processes', type=int, default=None, help='Size of the process pool. Defaults to the number of CPUs.')
+    args = parser.parse_args()
+    with open(args.dataset_file) as dataset_file:
+        dataset_json = json.load(dataset_file)
+        if (dataset_json['version'] != expected_version):
+            print('Evaluation expects v-' + expected_version +
+                  ', but got dataset with v-' + dataset_json['version'],
+                  file=sys.stderr)
+        dataset = dataset_json['data']
+    predictions_list = []
+    for prediction_file_name in args.prediction_files:
+        with open(prediction_file_name) as prediction_file:
+            predictions_list.append(json.load(prediction_file))
+    results = evaluate(dataset, predictions_list, num_processes=args.num_processes)
+    if len(results) == 1:
+        print(json.dumps(results[0]))
+    else:
+        for prediction_file_name, result in zip(args.prediction_files, results):
+            print(prediction_file_name + '\t' + json.dumps(result))
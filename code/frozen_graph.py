@@ -0,0 +1,151 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to export a trained model as a frozen inference-only graph,
+and to load that graph for serving (e.g. in "official_eval" mode in main.py)"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+
+# Names of the tensors in the exported graph.
+# These are the names given in BaselineModel.add_placeholders and BaselineModel.add_span_decoder.
+CONTEXT_IDS = "QAModel/context_ids:0"
+CONTEXT_MASK = "QAModel/context_mask:0"
+QN_IDS = "QAModel/qn_ids:0"
+QN_MASK = "QAModel/qn_mask:0"
+KEEP_PROB = "QAModel/keep_prob"
+OUTPUTS = ["QAModel/span_decoder/pred_start", "QAModel/span_decoder/pred_end"]
+
+
+def export_frozen_graph(session, model, export_path):
+    """
+    Writes an inference-only version of the model's graph to export_path.
+
+    The variables are replaced by constants holding their current values,
+    and everything that isn't needed to compute the answer span distributions
+    and the span decoder (loss, gradients, optimizer, summaries, savers) is pruned.
+    Dropout is switched off by replacing keep_prob with the constant 1.0,
+    and then constant subexpressions are folded.
+
+    Inputs:
+      session: TensorFlow session, with the model's variables initialized (e.g. restored from a checkpoint)
+      model: BaselineModel
+      export_path: where to write the frozen GraphDef
+    """
+    output_names = [model.probdist_start.op.name, model.probdist_end.op.name] + OUTPUTS
+
+    # Replace variables by constants. This also drops every node the outputs don't depend on.
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_names)
+
+    # We never want dropout when serving
+    for node in graph_def.node:
+        if node.name == KEEP_PROB:
+            node.op = "Const"
+            del node.input[:]
+            node.attr.clear()
+            node.attr["dtype"].type = tf.float32.as_datatype_enum
+            node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(1.0, dtype=tf.float32))
+
+    # Note: fold_constants fails on TF 1.4 if we list the placeholders as inputs, but it doesn't need them
+    graph_def = TransformGraph(graph_def, [], output_names, ["fold_constants(ignore_errors=true)"])
+
+    with tf.gfile.GFile(export_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    print "Wrote frozen graph with %i nodes to %s" % (len(graph_def.node), export_path)
+
+
+def get_probdist_names(graph_def):
+    """Returns the names of the start and end distributions. They are the inputs of the span decoder."""
+    nodes = dict((node.name, node) for node in graph_def.node)
+    return [nodes[name].input[0] for name in OUTPUTS]
+
+
+class FrozenModel(object):
+    """
+    Loads a graph written by export_frozen_graph.
+    Provides the same inference methods as BaselineModel (get_prob_dists, get_start_end_pos),
+    so it can be used with official_eval_helper.generate_answers.
+    Create the session with tf.Session(graph=frozen_model.graph).
+    """
+
+    def __init__(self, FLAGS, frozen_graph_path):
+        """
+        Inputs:
+          FLAGS: the flags passed in from main.py.
+            context_len and question_len must be the same as when the model was trained.
+          frozen_graph_path: path to the file written by export_frozen_graph
+        """
+        self.FLAGS = FLAGS
+
+        tic = time.time()
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph_path, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+
+        self.context_ids = self.graph.get_tensor_by_name(CONTEXT_IDS)
+        self.context_mask = self.graph.get_tensor_by_name(CONTEXT_MASK)
+        self.qn_ids = self.graph.get_tensor_by_name(QN_IDS)
+        self.qn_mask = self.graph.get_tensor_by_name(QN_MASK)
+        self.pred_start, self.pred_end = [self.graph.get_tensor_by_name(name + ":0") for name in OUTPUTS]
+        self.probdist_start, self.probdist_end = [self.graph.get_tensor_by_name(name + ":0") for name in get_probdist_names(graph_def)]
+
+        # The context encoding isn't exported, so this can't be used with a ContextEncodingCache
+        self.context_hiddens = None
+
+        toc = time.time()
+        print "Loaded frozen graph from %s in %.2f seconds" % (frozen_graph_path, toc-tic)
+
+    def get_prob_dists(self, session, batch):
+        """
+        Run forward-pass only; get probability distributions for start and end positions.
+
+        Returns:
+          probdist_start and probdist_end: both shape (batch_size, context_len)
+        """
+        input_feed = {}
+        input_feed[self.context_ids] = batch.context_ids
+        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+
+        output_feed = [self.probdist_start, self.probdist_end]
+        [probdist_start, probdist_end] = session.run(output_feed, input_feed)
+        return probdist_start, probdist_end
+
+    def get_start_end_pos(self, session, batch):
+        """
+        Run forward-pass only; get the most likely answer span (using the exported span decoder).
+
+        Returns:
+          start_pos, end_pos: both numpy arrays shape (batch_size).
+        """
+        input_feed = {}
+        input_feed[self.context_ids] = batch.context_ids
+        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+
+        output_feed = [self.pred_start, self.pred_end]
+        [start_pos, end_pos] = session.run(output_feed, input_feed)
+        return start_pos, end_pos
@@ -22,10 +22,23 @@ import io
 import json
 import sys
 import logging
+import multiprocessing
 
+import numpy as np
 import tensorflow as tf
 from vocab import get_glove
-from official_eval_helper import get_json_data, generate_answers
+from official_eval_helper import get_json_data, generate_answers, stream_answers, get_shard_path, run_shards, merge_shards
+from frozen_graph import export_frozen_graph, FrozenModel
+from numpy_inference import load_checkpoint_weights, save_weights, load_weights, NumpyModel
+from quantization import quantize_weights, quantization_error, save_quantized_weights, weights_nbytes
+from benchmark import benchmark_numpy_inference, benchmark_quantization, benchmark_xla
+from benchmark import benchmark_train_step, thread_candidates, autotune_threads, benchmark_recompute, benchmark_scaling, benchmark_hogwild
+from benchmark import benchmark_span_scorer, benchmark_eval_batcher, benchmark_length_sorting
+from session_config import get_session_config, parse_cpu_list, set_cpu_affinity, load_thread_config, save_thread_config
+from data_batcher import get_batch_generator, load_batches
+from optimizers import OPTIMIZERS, LR_SCALING_RULES
+from eval_worker import run_eval_worker
+from distributed import make_local_cluster, run_local_cluster, wait_for_chief, start_sync_replicas
 
 from qa_model import QAModel
 from qaoa_model import QAoAModel
@@ -50,19 +63,46 @@ EXPERIMENTS_DIR = os.path.join(MAIN_DIR, "experiments") # relative path of exper
 
 # High-level options
 tf.app.flags.DEFINE_integer("gpu", 0, "Which GPU to use, if you have multiple.")
-tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval")
+tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval / export / export_numpy / benchmark_numpy / quantize / benchmark_quantized / benchmark_xla / benchmark_train_step / autotune_threads / benchmark_recompute / benchmark_scaling / benchmark_hogwild / eval_worker / benchmark_span_scorer / benchmark_eval_batcher / benchmark_length_sorting")
 tf.app.flags.DEFINE_string("experiment_name", "", "Unique name for your experiment. This will create a directory by this name in the experiments/ directory, which will hold all data related to this experiment")
 tf.app.flags.DEFINE_string("model_name", "baseline", "Name of the model for your experiment.")
+tf.app.flags.DEFINE_boolean("xla_jit", False, "If True, compile the model graph with XLA JIT. This reduces per-op overhead, especially on CPU.")
 tf.app.flags.DEFINE_integer("num_epochs", 50, "Number of epochs to train. 0 means train indefinitely")
 
+# Threading (0 means use the setting recorded by autotune_threads mode, if any, otherwise TensorFlow's default)
+tf.app.flags.DEFINE_integer("intra_op_threads", 0, "How many threads each op (e.g. a matmul) can use.")
+tf.app.flags.DEFINE_integer("inter_op_threads", 0, "How many ops can run in parallel.")
+tf.app.flags.DEFINE_string("cpu_affinity", "", "If given, pin this process to these CPUs, in taskset format (e.g. 0-3,8). Useful when running several jobs on one host.")
+
+# Distributed training on this host (see distributed.py)
+tf.app.flags.DEFINE_integer("num_workers", 0, "For train and benchmark_scaling modes. If nonzero, train with this many worker processes (plus a parameter server), each on its own shard of the data. For benchmark_scaling mode, the largest number of workers to measure. For official_eval mode with --jsonl_out_path, answer the questions in this many processes, each on its own shard, then merge their predictions.")
+tf.app.flags.DEFINE_integer("ps_port", 2222, "Port of the parameter server in distributed training. The workers use the following ports.")
+tf.app.flags.DEFINE_string("job_name", "", "Set automatically in distributed training: ps or worker (or eval, for a shard of official_eval mode).")
+tf.app.flags.DEFINE_integer("task_index", 0, "Set automatically in distributed training: index of this worker. Worker 0 is the chief. For official_eval mode, the shard index.")
+
 # Hyperparameters
 tf.app.flags.DEFINE_float("learning_rate", 0.005, "Learning rate.")
+tf.app.flags.DEFINE_string("optimizer", "adam", "Available optimizers: adam / lamb / lars. LAMB and LARS scale each layer's update by its weight norm, for large batches (see optimizers.py).")
+tf.app.flags.DEFINE_string("lr_scaling", "none", "How to scale learning_rate with the effective batch size (batch_size * grad_accum_steps * workers) relative to lr_base_batch_size: none / linear / sqrt")
+tf.app.flags.DEFINE_integer("lr_base_batch_size", 100, "The batch size learning_rate is tuned for, for lr_scaling.")
+tf.app.flags.DEFINE_integer("warmup_steps", 0, "Ramp the learning rate up linearly over this many updates.")
+tf.app.flags.DEFINE_float("weight_decay", 0.0, "Weight decay, for the lamb and lars optimizers.")
+tf.app.flags.DEFINE_float("momentum", 0.9, "Momentum, for the lars optimizer.")
+tf.app.flags.DEFINE_integer("train_eval_samples", 1000, "Number of train examples, sampled at random, to calculate train F1/EM on at each evaluation.")
+tf.app.flags.DEFINE_integer("train_eval_refresh", 0, "Draw a new sample of train examples every this many evaluations. 0 means keep the same sample.")
+tf.app.flags.DEFINE_boolean("async_eval", False, "If True, training doesn't evaluate (and only saves checkpoints); run eval_worker mode alongside it to evaluate them.")
+tf.app.flags.DEFINE_integer("eval_interval_secs", 60, "For eval_worker mode, the minimum time between evaluations.")
+tf.app.flags.DEFINE_integer("eval_timeout_secs", 0, "For eval_worker mode, stop after this long without a new checkpoint. 0 means never stop.")
+tf.app.flags.DEFINE_float("target_f1", 0.0, "If nonzero, stop training once dev F1 reaches this, and log how long it took.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 2.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.2, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use")
+tf.app.flags.DEFINE_integer("grad_accum_steps", 1, "Sum the gradients of this many batches before each update, for an effective batch size of batch_size * grad_accum_steps.")
+tf.app.flags.DEFINE_integer("num_train_threads", 1, "Number of Hogwild training threads, each on its own shard of the training data, updating the shared variables without locks. For benchmark_hogwild mode, the number of threads to compare with 1.")
 tf.app.flags.DEFINE_integer("hidden_size", 200, "Size of the hidden states")
 tf.app.flags.DEFINE_integer("context_len", 300, "The maximum context length of your model")
 tf.app.flags.DEFINE_integer("question_len", 30, "The maximum question length of your model")
+tf.app.flags.DEFINE_boolean("recompute", False, "If True, recompute the RNN encoders' activations during backprop instead of storing them. Saves memory at the cost of slower training steps. Only used by the complete model.")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained word vectors. This needs to be one of the available GloVe dimensions: 50/100/200/300")
 
 # How often to print, save, eval
@@ -75,10 +115,22 @@ tf.app.flags.DEFINE_integer("keep", 1, "How many checkpoints to keep. 0 indicate
 tf.app.flags.DEFINE_string("train_dir", "", "Training directory to save the model parameters and other info. Defaults to experiments/{experiment_name}")
 tf.app.flags.DEFINE_string("glove_path", "", "Path to glove .txt file. Defaults to data/glove.6B.{embedding_size}d.txt")
 tf.app.flags.DEFINE_string("data_dir", DEFAULT_DATA_DIR, "Where to find preprocessed SQuAD data for training. Defaults to data/")
-tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval mode, which directory to load the checkpoint fron. You need to specify this for official_eval mode.")
+tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval and export modes, which directory to load the checkpoint fron. You need to specify this for official_eval mode (unless you specify --frozen_graph_path or --numpy_weights_path) and export mode.")
+tf.app.flags.DEFINE_string("frozen_graph_path", "", "For export mode, where to write the frozen inference-only graph. For official_eval mode, if given, serve this frozen graph instead of building the model and loading --ckpt_load_dir.")
+tf.app.flags.DEFINE_string("numpy_weights_path", "", "For export_numpy and quantize modes, where to write the model weights as a .npz file for the NumPy forward pass (see numpy_inference.py). For official_eval mode, serve the model from this file (float32 or quantized) with the NumPy forward pass instead of TensorFlow.")
 tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval mode, path to JSON input file. You need to specify this for official_eval_mode.")
 tf.app.flags.DEFINE_string("json_out_path", "predictions.json", "Output path for official_eval mode. Defaults to predictions.json")
-tf.app.flags.DEFINE_boolean("overwrite", False, "Output path for official_eval mode. Defaults to predictions.json")
+tf.app.flags.DEFINE_string("jsonl_out_path", "", "For official_eval mode. If given, stream the predictions to this JSONL file (one {\"id\": ..., \"answer\": ...} per line) as they're made, instead of writing --json_out_path at the end. If the file exists, questions it answers already are skipped (see --overwrite). Convert it with convert_predictions.py.")
+tf.app.flags.DEFINE_boolean("overwrite", False, "For train mode, delete train_dir first. For official_eval mode with --jsonl_out_path, start the predictions afresh instead of resuming from the existing file.")
+tf.app.flags.DEFINE_integer("doc_stride", 0, "For official_eval mode. If nonzero, contexts longer than context_len are split into overlapping windows starting doc_stride tokens apart, instead of being truncated. Should be at most context_len.")
+tf.app.flags.DEFINE_integer("benchmark_batches", 20, "For benchmark modes, how many dev batches (or synthetic steps) to run.")
+tf.app.flags.DEFINE_integer("benchmark_secs", 60, "For benchmark_hogwild mode, how long to train with each number of threads.")
+tf.app.flags.DEFINE_string("benchmark_batch_sizes", "25,50,100", "For benchmark_recompute mode, comma-separated batch sizes to measure.")
+tf.app.flags.DEFINE_integer("tokenize_processes", 0, "For official_eval mode, how many processes to tokenize the JSON input in. 0 means one per CPU (shared between the shards with --num_workers).")
+tf.app.flags.DEFINE_string("token_cache_dir", "", "For official_eval mode. If given, save the tokenized JSON input in this directory, keyed by a hash of the file, so that evaluating the same file again skips tokenization.")
+tf.app.flags.DEFINE_integer("eval_batch_size", 0, "Batch size for official_eval and benchmark_length_sorting modes. 0 means use --batch_size.")
+tf.app.flags.DEFINE_integer("sort_window", 160, "For official_eval mode, sort the examples by (context length, question length) within windows of this many batches, so each batch has inputs of similar length. 0 keeps the input order. With --jsonl_out_path, the predictions are written after each window.")
+tf.app.flags.DEFINE_integer("context_cache_size", 100, "For official_eval mode, how many context encodings to cache, so that a paragraph is only encoded once for all its questions. 0 disables the cache.")
 
 
 FLAGS = tf.app.flags.FLAGS
@@ -102,12 +154,14 @@ def initialize_model(session, model, train_dir, expect_exists):
     if ckpt and (tf.gfile.Exists(ckpt.model_checkpoint_path) or tf.gfile.Exists(v2_path)):
         print "Reading model parameters from %s" % ckpt.model_checkpoint_path
         model.saver.restore(session, ckpt.model_checkpoint_path)
+        session.run(tf.local_variables_initializer()) # e.g. gradient accumulators, which aren't saved
     else:
         if expect_exists:
             raise Exception("There is no saved checkpoint at %s" % train_dir)
         else:
             print "There is no saved checkpoint at %s. Creating model with fresh parameters." % train_dir
             session.run(tf.global_variables_initializer())
+            session.run(tf.local_variables_initializer())
             print 'Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables())
 
 
@@ -124,13 +178,45 @@ def main(unused_argv):
     print "This code was developed and tested on TensorFlow 1.4.1. Your TensorFlow version: %s" % tf.__version__
 
     # Define train_dir
-    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode != "official_eval":
+    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode not in ["official_eval", "export", "export_numpy", "benchmark_numpy", "quantize", "benchmark_quantized", "benchmark_xla", "benchmark_train_step", "benchmark_recompute", "benchmark_scaling", "benchmark_hogwild", "benchmark_span_scorer", "benchmark_eval_batcher", "benchmark_length_sorting"]:
         raise Exception("You need to specify either --experiment_name or --train_dir")
     FLAGS.train_dir = FLAGS.train_dir or os.path.join(EXPERIMENTS_DIR, FLAGS.experiment_name)
 
     # Initialize bestmodel directory
     bestmodel_dir = os.path.join(FLAGS.train_dir, "best_checkpoint")
 
+    if FLAGS.mode == "benchmark_scaling" and FLAGS.num_workers == 0:
+        raise Exception("For benchmark_scaling mode, set --num_workers to the largest number of workers to measure")
+
+    # QAoAModel.train has no data sharding and doesn't synchronize its workers' updates
+    if FLAGS.num_workers > 0 and FLAGS.mode in ["train", "benchmark_scaling"] and FLAGS.model_name == "AoA":
+        raise Exception("Distributed training (--num_workers) isn't supported for the AoA model")
+
+    # Distributed training: start the parameter server and the workers, which run this file again
+    if FLAGS.num_workers > 0 and not FLAGS.job_name:
+        command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+        if FLAGS.mode == "train":
+            if os.path.exists(FLAGS.train_dir) and FLAGS.overwrite:
+                shutil.rmtree(FLAGS.train_dir)
+            run_local_cluster(command + ["--overwrite=False"], FLAGS.num_workers)
+        elif FLAGS.mode == "benchmark_scaling":
+            benchmark_scaling(command + ["--mode=benchmark_train_step"], FLAGS.num_workers, FLAGS.batch_size)
+        elif FLAGS.mode == "official_eval":
+            if not FLAGS.jsonl_out_path:
+                raise Exception("For official_eval mode with --num_workers, you need to specify --jsonl_out_path")
+            run_shards(command, FLAGS.num_workers)
+            merge_shards(FLAGS.jsonl_out_path, FLAGS.num_workers)
+            print "Merged the predictions of %i shards into %s" % (FLAGS.num_workers, FLAGS.jsonl_out_path)
+        else:
+            raise Exception("--num_workers is only supported in train, benchmark_scaling and official_eval modes")
+        return
+
+    # The parameter server just holds the variables until it's stopped
+    if FLAGS.job_name == "ps":
+        server = tf.train.Server(make_local_cluster(FLAGS.num_workers, FLAGS.ps_port), job_name="ps", task_index=FLAGS.task_index)
+        server.join()
+        return
+
     # Define path for glove vecs
     FLAGS.glove_path = FLAGS.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(FLAGS.embedding_size))
 
@@ -140,6 +226,20 @@ def main(unused_argv):
         raise Exception("A model with that name was not found")
     tf.set_random_seed(42)
     current_model = models[FLAGS.model_name]
+    if FLAGS.grad_accum_steps > 1 and FLAGS.model_name == "AoA":
+        raise Exception("--grad_accum_steps isn't supported for the AoA model")
+    if FLAGS.num_train_threads > 1 and FLAGS.model_name == "AoA":
+        raise Exception("--num_train_threads isn't supported for the AoA model")
+    if FLAGS.optimizer not in OPTIMIZERS:
+        raise Exception("Unknown optimizer: %s" % FLAGS.optimizer)
+    if FLAGS.lr_scaling not in LR_SCALING_RULES:
+        raise Exception("Unknown lr_scaling: %s" % FLAGS.lr_scaling)
+    if (FLAGS.target_f1 or FLAGS.async_eval or FLAGS.mode == "eval_worker") and FLAGS.model_name == "AoA":
+        raise Exception("--target_f1, --async_eval and eval_worker mode aren't supported for the AoA model")
+    if FLAGS.target_f1 and FLAGS.async_eval:
+        raise Exception("--target_f1 needs the training run to evaluate, so it can't be combined with --async_eval")
+    if FLAGS.num_train_threads > 1 and (FLAGS.grad_accum_steps > 1 or FLAGS.num_workers > 0):
+        raise Exception("--num_train_threads can't be combined with --grad_accum_steps or --num_workers")
     # Get filepaths to train/dev datafiles for tokenized queries, contexts and answers
     train_context_path = os.path.join(FLAGS.data_dir, "train.context")
     train_qn_path = os.path.join(FLAGS.data_dir, "train.question")
@@ -148,12 +248,40 @@ def main(unused_argv):
     dev_qn_path = os.path.join(FLAGS.data_dir, "dev.question")
     dev_ans_path = os.path.join(FLAGS.data_dir, "dev.span")
 
+    # Pin to CPUs if requested. Do this before creating any session, so TensorFlow's threads are pinned too.
+    if FLAGS.cpu_affinity:
+        set_cpu_affinity(FLAGS.cpu_affinity)
+
+    # Use the thread pool sizes found by autotune_threads mode, unless they're given
+    intra_op_threads, inter_op_threads = FLAGS.intra_op_threads, FLAGS.inter_op_threads
+    if intra_op_threads == 0 and inter_op_threads == 0 and FLAGS.mode != "autotune_threads":
+        thread_config = load_thread_config(FLAGS.train_dir, FLAGS.model_name)
+        if thread_config:
+            intra_op_threads, inter_op_threads = thread_config
+            print "Using intra_op_threads=%i, inter_op_threads=%i from autotune_threads" % thread_config
+
+    # Some GPU settings, threading, and XLA if requested
+    config = get_session_config(xla_jit=FLAGS.xla_jit, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    # In distributed training, sessions run on this worker's server, and the variables live on the parameter server
+    is_chief = FLAGS.task_index == 0
+    target = ""
+    device_fn = None
+    if FLAGS.job_name == "worker":
+        cluster = make_local_cluster(FLAGS.num_workers, FLAGS.ps_port)
+        target = tf.train.Server(cluster, job_name="worker", task_index=FLAGS.task_index, config=config).target
+        device_fn = tf.train.replica_device_setter(worker_device="/job:worker/task:%i" % FLAGS.task_index, cluster=cluster)
+
     # Initialize model
-    qa_model = current_model(FLAGS, id2word, word2id, emb_matrix)
-    
-    # Some GPU settings
-    config=tf.ConfigProto()
-    config.gpu_options.allow_growth = True
+    # (unless we're serving a frozen graph, which contains the model already, or NumPy weights)
+    if FLAGS.mode == "official_eval" and FLAGS.frozen_graph_path:
+        qa_model = FrozenModel(FLAGS, FLAGS.frozen_graph_path)
+    elif FLAGS.mode == "official_eval" and FLAGS.numpy_weights_path:
+        qa_model = NumpyModel(FLAGS, FLAGS.model_name, load_weights(FLAGS.numpy_weights_path), emb_matrix)
+    else:
+        # Only build gradients and optimizer if we're going to train
+        with tf.device(device_fn):
+            qa_model = current_model(FLAGS, id2word, word2id, emb_matrix, training=(FLAGS.mode in ["train", "benchmark_train_step"]))
 
     # Split by mode
     if FLAGS.mode == "train":
@@ -163,7 +291,7 @@ def main(unused_argv):
         # Setup train dir and logfile
         if not os.path.exists(FLAGS.train_dir):
             os.makedirs(FLAGS.train_dir)
-        file_handler = logging.FileHandler(os.path.join(FLAGS.train_dir, "log.txt"))
+        file_handler = logging.FileHandler(os.path.join(FLAGS.train_dir, "log.txt" if is_chief else "log_worker%i.txt" % FLAGS.task_index))
         logging.getLogger().addHandler(file_handler)
 
         # Save a record of flags as a .json file in train_dir
@@ -174,13 +302,33 @@ def main(unused_argv):
         if not os.path.exists(bestmodel_dir):
             os.makedirs(bestmodel_dir)
 
-        with tf.Session(config=config) as sess:
+        with tf.Session(target, config=config) as sess:
+
+            # Load most recent model (in distributed training, the chief does this for everyone)
+            if is_chief:
+                initialize_model(sess, qa_model, FLAGS.train_dir, expect_exists=False)
+            else:
+                wait_for_chief(sess)
 
-            # Load most recent model
-            initialize_model(sess, qa_model, FLAGS.train_dir, expect_exists=False)
+            # Train (in distributed training, on this worker's shard of the data)
+            if FLAGS.job_name == "worker":
+                start_sync_replicas(sess, qa_model, is_chief)
+                qa_model.train(sess, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path, shard_index=FLAGS.task_index, num_shards=FLAGS.num_workers, is_chief=is_chief)
+            else:
+                qa_model.train(sess, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path)
 
-            # Train
-            qa_model.train(sess, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path)
+    elif FLAGS.mode == "eval_worker":
+        # Setup logfile (the training run writes log.txt)
+        if not os.path.exists(bestmodel_dir):
+            os.makedirs(bestmodel_dir)
+        file_handler = logging.FileHandler(os.path.join(FLAGS.train_dir, "log_eval.txt"))
+        logging.getLogger().addHandler(file_handler)
+
+        with tf.Session(config=config) as sess:
+            # Evaluate each checkpoint the training run saves
+            train_paths = (train_context_path, train_qn_path, train_ans_path)
+            dev_paths = (dev_context_path, dev_qn_path, dev_ans_path)
+            run_eval_worker(sess, qa_model, FLAGS, train_paths, dev_paths)
 
     elif FLAGS.mode == "show_examples":
         with tf.Session(config=config) as sess:
@@ -195,16 +343,47 @@ def main(unused_argv):
     elif FLAGS.mode == "official_eval":
         if FLAGS.json_in_path == "":
             raise Exception("For official_eval mode, you need to specify --json_in_path")
-        if FLAGS.ckpt_load_dir == "":
-            raise Exception("For official_eval mode, you need to specify --ckpt_load_dir")
-
-        # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
-
-        with tf.Session(config=config) as sess:
-
-            # Load model from ckpt_load_dir
-            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+        if FLAGS.ckpt_load_dir == "" and FLAGS.frozen_graph_path == "" and FLAGS.numpy_weights_path == "":
+            raise Exception("For official_eval mode, you need to specify --ckpt_load_dir, --frozen_graph_path or --numpy_weights_path")
+        if FLAGS.doc_stride < 0 or FLAGS.doc_stride > FLAGS.context_len:
+            raise Exception("--doc_stride must be between 0 and --context_len")
+
+        # Tokenize in parallel (with --num_workers, the shards share the CPUs)
+        tokenize_processes = FLAGS.tokenize_processes or max(multiprocessing.cpu_count() // max(FLAGS.num_workers, 1), 1)
+
+        # Read the JSON data from file. When streaming, it's tokenized as it's used, by a pool
+        # started now: forking once the TensorFlow session's threads are running isn't safe
+        pool = None
+        if not FLAGS.jsonl_out_path:
+            qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path, tokenize_processes, FLAGS.token_cache_dir)
+        elif tokenize_processes > 1:
+            pool = multiprocessing.Pool(tokenize_processes)
+
+        # A frozen graph is loaded into its own tf.Graph
+        graph = qa_model.graph if FLAGS.frozen_graph_path else None
+
+        with tf.Session(graph=graph, config=config) as sess:
+
+            # Load model from ckpt_load_dir (a frozen graph or NumpyModel has its weights already)
+            if not FLAGS.frozen_graph_path and not FLAGS.numpy_weights_path:
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+            if FLAGS.jsonl_out_path:
+                # With --num_workers, each shard writes its own file (see run_shards)
+                if FLAGS.job_name == "eval":
+                    jsonl_out_path = get_shard_path(FLAGS.jsonl_out_path, FLAGS.task_index, FLAGS.num_workers)
+                    shard_index, num_shards = FLAGS.task_index, FLAGS.num_workers
+                else:
+                    jsonl_out_path, shard_index, num_shards = FLAGS.jsonl_out_path, 0, 1
+                print "Streaming predictions to %s..." % jsonl_out_path
+                try:
+                    num_answers = stream_answers(sess, qa_model, word2id, FLAGS.json_in_path, jsonl_out_path, shard_index, num_shards, resume=not FLAGS.overwrite, pool=pool, token_cache_dir=FLAGS.token_cache_dir)
+                finally:
+                    if pool is not None:
+                        pool.terminate()
+                        pool.join()
+                print "Wrote %i predictions to %s" % (num_answers, jsonl_out_path)
+                return
 
             # Get a predicted answer for each example in the data
             # Return a mapping answers_dict from uuid to answer
@@ -217,6 +396,148 @@ def main(unused_argv):
                 print "Wrote predictions to %s" % FLAGS.json_out_path
 
 
+    elif FLAGS.mode == "export":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For export mode, you need to specify --ckpt_load_dir")
+        if FLAGS.frozen_graph_path == "":
+            raise Exception("For export mode, you need to specify --frozen_graph_path")
+
+        with tf.Session(config=config) as sess:
+
+            # Load model from ckpt_load_dir
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+            # Write the inference-only graph
+            export_frozen_graph(sess, qa_model, FLAGS.frozen_graph_path)
+
+    elif FLAGS.mode == "export_numpy":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For export_numpy mode, you need to specify --ckpt_load_dir")
+        if FLAGS.numpy_weights_path == "":
+            raise Exception("For export_numpy mode, you need to specify --numpy_weights_path")
+
+        # Read the weights straight from the checkpoint; no session needed
+        ckpt = tf.train.get_checkpoint_state(FLAGS.ckpt_load_dir)
+        if not ckpt:
+            raise Exception("There is no saved checkpoint at %s" % FLAGS.ckpt_load_dir)
+        save_weights(load_checkpoint_weights(ckpt.model_checkpoint_path), FLAGS.numpy_weights_path)
+        print "Wrote NumPy weights to %s" % FLAGS.numpy_weights_path
+
+    elif FLAGS.mode == "benchmark_numpy":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For benchmark_numpy mode, you need to specify --ckpt_load_dir")
+
+        with tf.Session(config=config) as sess:
+
+            # Load the same checkpoint into both implementations
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            ckpt = tf.train.get_checkpoint_state(FLAGS.ckpt_load_dir)
+            np_model = NumpyModel(FLAGS, FLAGS.model_name, load_checkpoint_weights(ckpt.model_checkpoint_path), emb_matrix)
+
+            batches = []
+            for batch in get_batch_generator(word2id, dev_context_path, dev_qn_path, dev_ans_path, FLAGS.batch_size, context_len=FLAGS.context_len, question_len=FLAGS.question_len, discard_long=False):
+                batches.append(batch)
+                if len(batches) == FLAGS.benchmark_batches:
+                    break
+
+            # Check the outputs match, and compare latency for single-example and full batches
+            benchmark_numpy_inference(sess, qa_model, np_model, batches, [1, FLAGS.batch_size])
+
+    elif FLAGS.mode in ["quantize", "benchmark_quantized"]:
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For %s mode, you need to specify --ckpt_load_dir" % FLAGS.mode)
+        if FLAGS.mode == "quantize" and FLAGS.numpy_weights_path == "":
+            raise Exception("For quantize mode, you need to specify --numpy_weights_path")
+
+        ckpt = tf.train.get_checkpoint_state(FLAGS.ckpt_load_dir)
+        if not ckpt:
+            raise Exception("There is no saved checkpoint at %s" % FLAGS.ckpt_load_dir)
+        weights = load_checkpoint_weights(ckpt.model_checkpoint_path)
+        quantized = quantize_weights(weights)
+        print "Largest absolute weight error after quantization: %g" % quantization_error(weights, quantized)
+        print "Weights: %.2f MB as float32, %.2f MB as int8" % (weights_nbytes(weights) / 1e6, weights_nbytes(quantized) / 1e6)
+
+        if FLAGS.mode == "quantize":
+            save_quantized_weights(quantized, FLAGS.numpy_weights_path)
+            print "Wrote quantized NumPy weights to %s" % FLAGS.numpy_weights_path
+        else:
+            batches = []
+            for batch in get_batch_generator(word2id, dev_context_path, dev_qn_path, dev_ans_path, FLAGS.batch_size, context_len=FLAGS.context_len, question_len=FLAGS.question_len, discard_long=False):
+                batches.append(batch)
+                if len(batches) == FLAGS.benchmark_batches:
+                    break
+
+            # Report the F1/EM delta of the quantized model
+            # (the throughput should match, since NumpyModel dequantizes the weights when it's built)
+            float_model = NumpyModel(FLAGS, FLAGS.model_name, weights, emb_matrix)
+            quantized_model = NumpyModel(FLAGS, FLAGS.model_name, quantized, emb_matrix)
+            benchmark_quantization(float_model, quantized_model, batches)
+
+    elif FLAGS.mode == "benchmark_xla":
+        # Time every registered model on a synthetic batch, with and without XLA
+        benchmark_xla(FLAGS, models, id2word, word2id, emb_matrix, FLAGS.benchmark_batches)
+
+    elif FLAGS.mode == "benchmark_train_step":
+        with tf.Session(target, config=config) as sess:
+            if is_chief:
+                sess.run(tf.global_variables_initializer())
+                sess.run(tf.local_variables_initializer())
+            else:
+                wait_for_chief(sess)
+            if FLAGS.job_name == "worker":
+                start_sync_replicas(sess, qa_model, is_chief)
+
+            # Time training steps on a synthetic batch with the current settings (threading, batch size, recompute, number of workers)
+            # In distributed training, the other workers keep training until the chief is done
+            benchmark_train_step(sess, qa_model, FLAGS, len(word2id), FLAGS.benchmark_batches if is_chief else None)
+
+    elif FLAGS.mode == "autotune_threads":
+        if not os.path.exists(FLAGS.train_dir):
+            os.makedirs(FLAGS.train_dir)
+
+        # Try every setting in a fresh process, on the CPUs we're allowed to use
+        num_cores = len(parse_cpu_list(FLAGS.cpu_affinity)) if FLAGS.cpu_affinity else multiprocessing.cpu_count()
+        trial_command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--mode=benchmark_train_step"]
+        (intra, inter), train_time = autotune_threads(trial_command, thread_candidates(num_cores))
+
+        save_thread_config(FLAGS.train_dir, FLAGS.model_name, intra, inter, train_time)
+        print "Best for %s: intra_op_threads=%i, inter_op_threads=%i (%.1f ms per train step). Recorded in %s" % (FLAGS.model_name, intra, inter, train_time * 1000, FLAGS.train_dir)
+
+    elif FLAGS.mode == "benchmark_recompute":
+        # Measure each setting in a fresh process, since peak memory is per process
+        trial_command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--mode=benchmark_train_step"]
+        benchmark_recompute(trial_command, [int(b) for b in FLAGS.benchmark_batch_sizes.split(",")])
+
+    elif FLAGS.mode == "benchmark_hogwild":
+        # Train fresh models with 1 and num_train_threads threads for the same time, and compare
+        train_paths = (train_context_path, train_qn_path, train_ans_path)
+        dev_paths = (dev_context_path, dev_qn_path, dev_ans_path)
+        benchmark_hogwild(FLAGS, current_model, id2word, word2id, emb_matrix, train_paths, dev_paths, [1, FLAGS.num_train_threads], FLAGS.benchmark_secs)
+
+    elif FLAGS.mode == "benchmark_span_scorer":
+        # Check the fast F1/EM scorer against evaluate.py on the dev set
+        dev_batches = load_batches(word2id, dev_context_path, dev_qn_path, dev_ans_path, FLAGS.batch_size, context_len=FLAGS.context_len, question_len=FLAGS.question_len, discard_long=False)
+        benchmark_span_scorer(dev_batches, np.random.RandomState(0))
+
+    elif FLAGS.mode == "benchmark_eval_batcher":
+        # Time official_eval's batching on synthetic inputs of up to 1M questions
+        benchmark_eval_batcher(FLAGS, word2id, [10000, 100000, 1000000], np.random.RandomState(0))
+
+    elif FLAGS.mode == "benchmark_length_sorting":
+        if FLAGS.json_in_path == "":
+            raise Exception("For benchmark_length_sorting mode, you need to specify --json_in_path")
+        json_data = get_json_data(FLAGS.json_in_path, FLAGS.tokenize_processes or multiprocessing.cpu_count(), FLAGS.token_cache_dir)
+
+        with tf.Session(config=config) as sess:
+            # Use the checkpoint in ckpt_load_dir if given (the speed doesn't depend on the weights)
+            if FLAGS.ckpt_load_dir:
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            else:
+                sess.run(tf.global_variables_initializer())
+
+            # Compare the input order with sorting
+            benchmark_length_sorting(sess, qa_model, word2id, json_data, FLAGS.eval_batch_size or FLAGS.batch_size, [0, FLAGS.sort_window])
+
     else:
         raise Exception("Unexpected value of FLAGS.mode: %s" % FLAGS.mode)
 
@@ -21,6 +21,7 @@ import time
 import logging
 import os
 import sys
+import threading
 
 import numpy as np
 import tensorflow as tf
@@ -28,8 +29,10 @@ from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import embedding_ops
 
 from evaluate import exact_match_score, f1_score
-from data_batcher import get_batch_generator
+from data_batcher import get_batch_generator, load_batches, load_sampled_batches
 from pretty_print import print_example
+from optimizers import get_learning_rate, get_optimizer, effective_batch_size
+from span_scorer import SpanScorer
 from modules import RNNEncoder, SimpleSoftmaxLayer, BasicAttn, BiDAF, AnsPtr
 
 logging.basicConfig(level=logging.INFO)
@@ -41,7 +44,7 @@ class BaselineModel(object):
         Uses Bidaf, Self attention, and end pointers based on the start pointer
     """
 
-    def __init__(self, FLAGS, id2word, word2id, emb_matrix):
+    def __init__(self, FLAGS, id2word, word2id, emb_matrix, training=True):
         """
         Initializes the QA model.
 
@@ -50,34 +53,93 @@ class BaselineModel(object):
           id2word: dictionary mapping word idx (int) to word (string)
           word2id: dictionary mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+          training: If False, only build the forward pass (no gradients, optimizer or summaries).
+            Use this when the model is only restored from a checkpoint and run, never trained.
         """
         self.FLAGS = FLAGS
         self.id2word = id2word
         self.word2id = word2id
+        self.training = training
+
+        # Models whose context encoding doesn't depend on the question set this in build_graph
+        self.context_hiddens = None
+
+        # For F1/EM during training (see span_scorer.py)
+        self.span_scorer = SpanScorer()
 
         # Add all parts of the graph
         with tf.variable_scope("QAModel", initializer=tf.contrib.layers.variance_scaling_initializer(factor=1.0, uniform=True)):
             self.add_placeholders()
             self.add_embedding_layer(emb_matrix)
             self.build_graph()
+            self.add_span_decoder()
             self.add_loss()
 
+        self.global_step = tf.Variable(0, name="global_step", trainable=False)
+
+        if training:
+            self.add_training_ops()
+
+        # Define savers (for checkpointing)
+        # Note: when training=False, tf.global_variables() doesn't include the optimizer's slot variables,
+        # so restoring skips them (and saving doesn't write them)
+        self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.keep)
+        self.bestmodel_saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+
+
+    def add_training_ops(self):
+        """
+        Add gradients, optimizer and summaries to the graph.
+
+        Defines:
+          self.updates: what you need to fetch in session.run to do a gradient update
+          self.gradient_norm, self.param_norm: scalar tensors
+          self.summaries: merged summaries (for tensorboard)
+          self.sync_optimizer: only in distributed training. The SyncReplicasOptimizer.
+          self.accumulate: only if FLAGS.grad_accum_steps > 1. What you need to fetch in session.run
+            to add the gradients for a batch to the accumulators, without updating the parameters.
+        """
         # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
         params = tf.trainable_variables()
         gradients = tf.gradients(self.loss, params)
+
+        if self.FLAGS.grad_accum_steps > 1:
+            # Sum the gradients of grad_accum_steps batches before each update.
+            # self.updates adds the current batch's gradients, then applies the average.
+            # The accumulators are local variables, so they aren't saved in checkpoints.
+            params, gradients = zip(*[(p, g) for p, g in zip(params, gradients) if g is not None])
+            # Each accumulator lives with its gradient (i.e. on the worker, not the parameter server, in distributed training)
+            accumulators = []
+            with tf.variable_scope("grad_accum"):
+                for p, g in zip(params, gradients):
+                    with tf.colocate_with(g):
+                        accumulators.append(tf.Variable(tf.zeros(p.get_shape(), dtype=p.dtype.base_dtype), trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=p.op.name.replace("/", "_")))
+            self.accumulate = tf.group(*[a.assign_add(g) for a, g in zip(accumulators, gradients)])
+            with tf.control_dependencies([self.accumulate]):
+                gradients = [tf.identity(a) / self.FLAGS.grad_accum_steps for a in accumulators]
+
         self.gradient_norm = tf.global_norm(gradients)
-        clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
+        clipped_gradients, _ = tf.clip_by_global_norm(gradients, self.FLAGS.max_gradient_norm)
         self.param_norm = tf.global_norm(params)
 
         # Define optimizer and updates
         # (updates is what you need to fetch in session.run to do a gradient update)
-        self.global_step = tf.Variable(0, name="global_step", trainable=False)
-        opt = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate) # you can try other optimizers
+        # (the learning rate is scaled for the effective batch size and warmed up, see optimizers.py)
+        self.learning_rate = get_learning_rate(self.FLAGS, self.global_step)
+        tf.summary.scalar('learning_rate', self.learning_rate)
+        opt = get_optimizer(self.FLAGS, self.learning_rate)
+        if self.FLAGS.job_name == "worker":
+            # Distributed training (see distributed.py): average the gradients of all the workers before each update
+            opt = tf.train.SyncReplicasOptimizer(opt, replicas_to_aggregate=self.FLAGS.num_workers, total_num_replicas=self.FLAGS.num_workers)
+            self.sync_optimizer = opt
         self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
 
-        # Define savers (for checkpointing) and summaries (for tensorboard)
-        self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.keep)
-        self.bestmodel_saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
+        if self.FLAGS.grad_accum_steps > 1:
+            # Zero the accumulators once the update has been applied
+            with tf.control_dependencies([self.updates]):
+                self.updates = tf.group(*[a.assign(tf.zeros_like(a)) for a in accumulators])
+
+        # Define summaries (for tensorboard)
         self.summaries = tf.summary.merge_all()
 
 
@@ -88,15 +150,22 @@ class BaselineModel(object):
         # Add placeholders for inputs.
         # These are all batch-first: the None corresponds to batch_size and
         # allows you to run the same model with variable batch_size
-        self.context_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.context_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.qn_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.qn_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.ans_span = tf.placeholder(tf.int32, shape=[None, 2])
+        self.qn_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len], name="qn_ids")
+        self.qn_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len], name="qn_mask")
+        self.ans_span = tf.placeholder(tf.int32, shape=[None, 2], name="ans_span")
+
+        # Usually we feed one context per question, into self.context_ids and self.context_mask.
+        # Alternatively, we can feed a single context into self.shared_context_ids and
+        # self.shared_context_mask, and it is broadcast to every question (see get_prob_dists_multi).
+        self.shared_context_ids = tf.placeholder(tf.int32, shape=[1, self.FLAGS.context_len], name="shared_context_ids")
+        self.shared_context_mask = tf.placeholder(tf.int32, shape=[1, self.FLAGS.context_len], name="shared_context_mask")
+        num_qns = tf.shape(self.qn_ids)[0]
+        self.context_ids = tf.placeholder_with_default(tf.tile(self.shared_context_ids, [num_qns, 1]), shape=[None, self.FLAGS.context_len], name="context_ids")
+        self.context_mask = tf.placeholder_with_default(tf.tile(self.shared_context_mask, [num_qns, 1]), shape=[None, self.FLAGS.context_len], name="context_mask")
 
         # Add a placeholder to feed in the keep probability (for dropout).
         # This is necessary so that we can instruct the model to use dropout when training, but not when testing
-        self.keep_prob = tf.placeholder_with_default(1.0, shape=())
+        self.keep_prob = tf.placeholder_with_default(1.0, shape=(), name="keep_prob")
 
 
     def add_embedding_layer(self, emb_matrix):
@@ -121,6 +190,20 @@ class BaselineModel(object):
     def build_graph(self):
         raise NotImplementedError
 
+    def add_span_decoder(self):
+        """
+        Add the most likely answer span to the graph.
+        get_start_end_pos computes the same thing in numpy; this is so that
+        exported inference graphs (see frozen_graph.py) include the span decoder.
+
+        Defines:
+          self.pred_start, self.pred_end: both shape (batch_size)
+        """
+        with vs.variable_scope("span_decoder"):
+            self.pred_start = tf.argmax(self.probdist_start, axis=1, name="pred_start")
+            self.pred_end = tf.argmax(self.probdist_end, axis=1, name="pred_end")
+
+
     def add_loss(self):
         """
         Add loss computation to the graph.
@@ -139,6 +222,7 @@ class BaselineModel(object):
 
         Defines:
           self.loss_start, self.loss_end, self.loss: all scalar tensors
+          self.example_loss: shape (batch_size). The loss for each example.
         """
         with vs.variable_scope("loss"):
 
@@ -154,6 +238,7 @@ class BaselineModel(object):
 
             # Add the two losses
             self.loss = self.loss_start + self.loss_end
+            self.example_loss = loss_start + loss_end # shape (batch_size)
             tf.summary.scalar('loss', self.loss)
 
 
@@ -173,6 +258,22 @@ class BaselineModel(object):
           gradient_norm: Global norm of the gradients
         """
         # Match up our input data with the placeholders
+        input_feed = self.get_train_input_feed(batch)
+
+        # output_feed contains the things we want to fetch.
+        output_feed = [self.updates, self.summaries, self.loss, self.global_step, self.param_norm, self.gradient_norm]
+
+        # Run the model
+        [_, summaries, loss, global_step, param_norm, gradient_norm] = session.run(output_feed, input_feed)
+
+        # All summaries in the graph are added to Tensorboard
+        summary_writer.add_summary(summaries, global_step)
+
+        return loss, global_step, param_norm, gradient_norm
+
+
+    def get_train_input_feed(self, batch):
+        """Returns the feed_dict for a training iteration on batch (with dropout)"""
         input_feed = {}
         input_feed[self.context_ids] = batch.context_ids
         input_feed[self.context_mask] = batch.context_mask
@@ -180,18 +281,75 @@ class BaselineModel(object):
         input_feed[self.qn_mask] = batch.qn_mask
         input_feed[self.ans_span] = batch.ans_span
         input_feed[self.keep_prob] = 1.0 - self.FLAGS.dropout # apply dropout
+        return input_feed
 
-        # output_feed contains the things we want to fetch.
-        output_feed = [self.updates, self.summaries, self.loss, self.global_step, self.param_norm, self.gradient_norm]
 
-        # Run the model
-        [_, summaries, loss, global_step, param_norm, gradient_norm] = session.run(output_feed, input_feed)
+    def run_accumulated_train_iter(self, session, batches, summary_writer):
+        """
+        This performs a single training iteration with gradient accumulation (FLAGS.grad_accum_steps > 1):
+        the gradients of each batch are computed in turn and summed, and their average is applied once.
+        This gives the update of a batch len(batches) times bigger, without having to fit it in memory.
 
-        # All summaries in the graph are added to Tensorboard
+        Inputs:
+          session: TensorFlow session
+          batches: list of FLAGS.grad_accum_steps Batch objects
+          summary_writer: for Tensorboard
+
+        Returns:
+          loss: The loss (averaged across the batches) for this iteration.
+          global_step: The current number of training iterations (i.e. updates) we've done
+          param_norm: Global norm of the parameters
+          gradient_norm: Global norm of the averaged gradients
+        """
+        losses = []
+
+        # Accumulate the gradients for all but the last batch
+        for batch in batches[:-1]:
+            [_, loss] = session.run([self.accumulate, self.loss], self.get_train_input_feed(batch))
+            losses.append(loss)
+
+        # The last batch's gradients are accumulated as part of the update
+        output_feed = [self.updates, self.summaries, self.loss, self.global_step, self.param_norm, self.gradient_norm]
+        [_, summaries, loss, global_step, param_norm, gradient_norm] = session.run(output_feed, self.get_train_input_feed(batches[-1]))
+        losses.append(loss)
+
+        # All summaries in the graph are added to Tensorboard (once per update)
         summary_writer.add_summary(summaries, global_step)
 
-        return loss, global_step, param_norm, gradient_norm
+        return np.mean(losses), global_step, param_norm, gradient_norm
+
 
+    def train_thread(self, session, train_context_path, train_qn_path, train_ans_path, shard_index, num_shards, summary_writer, stop_event, examples_trained, thread_index, run_event=None, iter_lock=None):
+        """
+        Hogwild training: runs training iterations on one shard of the training data,
+        epoch after epoch, until stop_event is set. Several threads run this at once on the same session,
+        updating the shared variables without locks (TensorFlow releases the GIL inside session.run).
+
+        Inputs:
+          session: TensorFlow session
+          train_{qn/context/ans}_path: paths to the training data files
+          shard_index, num_shards: which part of the training data to train on (see get_batch_generator)
+          summary_writer: for Tensorboard
+          stop_event: threading.Event
+          examples_trained: list with one count per thread. examples_trained[thread_index] is
+            incremented by the size of each batch trained on.
+          thread_index: int
+          run_event, iter_lock: If given, the thread only starts an iteration while run_event is set,
+            and holds iter_lock during each iteration. To pause the thread (e.g. to evaluate or save the model),
+            clear run_event, then acquire iter_lock (which waits for the current iteration to finish).
+        """
+        while not stop_event.is_set():
+            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True, shard_index=shard_index, num_shards=num_shards):
+                if run_event is not None:
+                    run_event.wait()
+                if stop_event.is_set():
+                    break
+                if iter_lock is not None:
+                    with iter_lock:
+                        self.run_train_iter(session, batch, summary_writer)
+                else:
+                    self.run_train_iter(session, batch, summary_writer)
+                examples_trained[thread_index] += batch.batch_size
 
     def get_loss(self, session, batch):
         """
@@ -243,6 +401,102 @@ class BaselineModel(object):
         return probdist_start, probdist_end
 
 
+    def get_prob_dists_cached(self, session, batch, cache):
+        """
+        Like get_prob_dists, but computes the context encodings (self.context_hiddens)
+        only for contexts that aren't already in cache, and feeds in the cached
+        encodings for the rest. Only the question-dependent part of the graph is run
+        for every example. Falls back to get_prob_dists if the model doesn't define
+        self.context_hiddens.
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+          cache: ContextEncodingCache
+
+        Returns:
+          probdist_start and probdist_end: both shape (batch_size, context_len)
+        """
+        if self.context_hiddens is None:
+            return self.get_prob_dists(session, batch)
+
+        keys = [cache.key(context_ids) for context_ids in batch.context_ids]
+
+        # Look up the encodings we already have
+        # Note: we keep them in a dict, in case adding new encodings to the cache evicts them
+        encodings = {}
+        for key in keys:
+            if key not in encodings:
+                encoding = cache.get(key)
+                if encoding is not None:
+                    encodings[key] = encoding
+
+        # Encode each of the remaining contexts once
+        missing_idxs = []
+        for ex_idx, key in enumerate(keys):
+            if key not in encodings:
+                encodings[key] = None
+                missing_idxs.append(ex_idx)
+        if missing_idxs:
+            input_feed = {}
+            input_feed[self.context_ids] = batch.context_ids[missing_idxs]
+            input_feed[self.context_mask] = batch.context_mask[missing_idxs]
+            [context_hiddens] = session.run([self.context_hiddens], input_feed)
+            for ex_idx, encoding in zip(missing_idxs, context_hiddens):
+                encodings[keys[ex_idx]] = encoding
+                cache.put(keys[ex_idx], encoding)
+
+        # Feed the encodings in place of the context encoder
+        input_feed = {}
+        input_feed[self.context_hiddens] = np.stack([encodings[key] for key in keys])
+        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+        # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+
+        output_feed = [self.probdist_start, self.probdist_end]
+        [probdist_start, probdist_end] = session.run(output_feed, input_feed)
+        return probdist_start, probdist_end
+
+
+    def get_example_loss_and_prob_dists(self, session, batch):
+        """
+        Run forward-pass only; get the loss for each example and the probability distributions
+        for start and end positions, from the same forward pass.
+
+        The batch may contain truncated examples (from get_batch_generator with discard_long=False),
+        whose gold span can be cut off the context. Their spans are clipped to the context,
+        so their loss is meaningless and should be ignored (see is_truncated).
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+
+        Returns:
+          example_loss: shape (batch_size)
+          probdist_start and probdist_end: both shape (batch_size, context_len)
+        """
+        input_feed = {}
+        input_feed[self.context_ids] = batch.context_ids
+        input_feed[self.context_mask] = batch.context_mask
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+        input_feed[self.ans_span] = np.minimum(batch.ans_span, self.FLAGS.context_len - 1)
+        # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+
+        output_feed = [self.example_loss, self.probdist_start, self.probdist_end]
+        [example_loss, probdist_start, probdist_end] = session.run(output_feed, input_feed)
+        return example_loss, probdist_start, probdist_end
+
+
+    def is_truncated(self, batch):
+        """
+        Returns a boolean numpy array shape (batch_size): whether each example's context or question
+        is longer than context_len or question_len (i.e. would be discarded with discard_long=True).
+        """
+        return np.array([len(context_tokens) > self.FLAGS.context_len or len(qn_tokens) > self.FLAGS.question_len for context_tokens, qn_tokens in zip(batch.context_tokens, batch.qn_tokens)])
+
+
     def get_start_end_pos(self, session, batch):
         """
         Run forward-pass only; get the most likely answer span.
@@ -265,13 +519,71 @@ class BaselineModel(object):
         return start_pos, end_pos
 
 
-    def get_dev_loss(self, session, dev_context_path, dev_qn_path, dev_ans_path):
+    def get_prob_dists_multi(self, session, batch):
+        """
+        Run forward-pass only, for several questions about the same context;
+        get probability distributions for start and end positions.
+
+        The context is fed once and broadcast to every question inside the graph.
+        If the model's context encoding doesn't depend on the question,
+        the context is also only encoded once.
+
+        Inputs:
+          session: TensorFlow session
+          batch: MultiQuestionBatch object
+
+        Returns:
+          probdist_start and probdist_end: both shape (num_questions, context_len)
+        """
+        input_feed = {}
+        input_feed[self.shared_context_ids] = batch.context_ids
+        input_feed[self.shared_context_mask] = batch.context_mask
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+        # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+
+        if self.context_hiddens is not None:
+            # Encode the single context, then share the encoding between the questions
+            [context_hiddens] = session.run([self.context_hiddens], {self.context_ids: batch.context_ids, self.context_mask: batch.context_mask})
+            input_feed[self.context_hiddens] = np.repeat(context_hiddens, batch.batch_size, axis=0)
+
+        output_feed = [self.probdist_start, self.probdist_end]
+        [probdist_start, probdist_end] = session.run(output_feed, input_feed)
+        return probdist_start, probdist_end
+
+
+    def get_start_end_pos_multi(self, session, batch):
+        """
+        Run forward-pass only, for several questions about the same context;
+        get the most likely answer span for each question.
+
+        Inputs:
+          session: TensorFlow session
+          batch: MultiQuestionBatch object
+
+        Returns:
+          start_pos, end_pos: both numpy arrays shape (num_questions).
+            The most likely start and end positions for each question.
+          scores: numpy array shape (num_questions).
+            The probability of each span, i.e. probdist_start[start_pos] * probdist_end[end_pos].
+        """
+        start_dist, end_dist = self.get_prob_dists_multi(session, batch)
+
+        start_pos = np.argmax(start_dist, axis=1)
+        end_pos = np.argmax(end_dist, axis=1)
+        scores = start_dist[np.arange(batch.batch_size), start_pos] * end_dist[np.arange(batch.batch_size), end_pos]
+
+        return start_pos, end_pos, scores
+
+
+    def get_dev_loss(self, session, dev_context_path, dev_qn_path, dev_ans_path, batches=None):
         """
         Get loss for entire dev set.
 
         Inputs:
           session: TensorFlow session
           dev_qn_path, dev_context_path, dev_ans_path: paths to the dev.{context/question/answer} data files
+          batches: optional list of Batches (see load_batches, with discard_long=True) to use instead of reading the files
 
         Outputs:
           dev_loss: float. Average loss across the dev set.
@@ -285,7 +597,9 @@ class BaselineModel(object):
         # which are longer than our context_len or question_len.
         # We need to do this because if, for example, the true answer is cut
         # off the context, then the loss function is undefined.
-        for batch in get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
+        if batches is None:
+            batches = get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True)
+        for batch in batches:
 
             # Get loss for this batch
             loss = self.get_loss(session, batch)
@@ -304,7 +618,7 @@ class BaselineModel(object):
         return dev_loss
 
 
-    def check_f1_em(self, session, context_path, qn_path, ans_path, dataset, num_samples=100, print_to_screen=False):
+    def check_f1_em(self, session, context_path, qn_path, ans_path, dataset, num_samples=100, print_to_screen=False, batches=None):
         """
         Sample from the provided (train/dev) set.
         For each sample, calculate F1 and EM score.
@@ -326,6 +640,7 @@ class BaselineModel(object):
           dataset: string. Either "train" or "dev". Just for logging purposes.
           num_samples: int. How many samples to use. If num_samples=0 then do whole dataset.
           print_to_screen: if True, pretty-prints each example to screen
+          batches: optional list of Batches (see load_batches, with discard_long=False) to use instead of reading the files
 
         Returns:
           F1 and EM: Scalars. The average across the sampled examples.
@@ -340,10 +655,24 @@ class BaselineModel(object):
 
         # Note here we select discard_long=False because we want to sample from the entire dataset
         # That means we're truncating, rather than discarding, examples with too-long context or questions
-        for batch in get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False):
+        if batches is None:
+            batches = get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False)
+        for batch in batches:
 
             pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
 
+            if not print_to_screen:
+                # Score the whole batch at once (same scores as f1_score and exact_match_score below)
+                f1, em = self.span_scorer.score_batch(batch, pred_start_pos, pred_end_pos)
+                if num_samples != 0:
+                    f1, em = f1[:num_samples - example_num], em[:num_samples - example_num]
+                f1_total += float(np.sum(f1))
+                em_total += float(np.sum(em))
+                example_num += len(f1)
+                if num_samples != 0 and example_num >= num_samples:
+                    break
+                continue
+
             # Convert the start and end positions to lists length batch_size
             pred_start_pos = pred_start_pos.tolist() # list length batch_size
             pred_end_pos = pred_end_pos.tolist() # list length batch_size
@@ -385,13 +714,145 @@ class BaselineModel(object):
         return f1_total, em_total
 
 
-    def train(self, session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path):
+    def get_dev_loss_f1_em(self, session, dev_context_path, dev_qn_path, dev_ans_path, batches=None):
+        """
+        Get the loss and F1/EM for the entire dev set, with one forward pass per batch.
+
+        Gives the same results as get_dev_loss and check_f1_em(..., num_samples=0) together:
+        the loss is averaged over the examples that fit in context_len and question_len
+        (see get_dev_loss), and F1/EM are averaged over all examples, truncating the long ones.
+
+        Inputs:
+          session: TensorFlow session
+          dev_qn_path, dev_context_path, dev_ans_path: paths to the dev.{context/question/answer} data files
+          batches: optional list of Batches (see load_batches, with discard_long=False) to use instead of reading the files
+
+        Returns:
+          dev_loss, dev_f1, dev_em: floats
+        """
+        logging.info("Calculating dev loss and F1/EM for all examples in dev set...")
+        tic = time.time()
+        loss_total = 0.
+        f1_total = 0.
+        em_total = 0.
+        num_loss_examples = 0
+        example_num = 0
+
+        if batches is None:
+            batches = get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False)
+        for batch in batches:
+
+            example_loss, start_dist, end_dist = self.get_example_loss_and_prob_dists(session, batch)
+
+            # Only count the loss for examples that weren't truncated
+            keep = np.logical_not(self.is_truncated(batch))
+            loss_total += float(np.sum(example_loss[keep]))
+            num_loss_examples += int(np.sum(keep))
+
+            # Take argmax to get start_pos and end_pos, both shape (batch_size),
+            # and compare the predicted and true answers, using the original words (no UNKs)
+            pred_start_pos = np.argmax(start_dist, axis=1)
+            pred_end_pos = np.argmax(end_dist, axis=1)
+            f1, em = self.span_scorer.score_batch(batch, pred_start_pos, pred_end_pos)
+            f1_total += float(np.sum(f1))
+            em_total += float(np.sum(em))
+            example_num += batch.batch_size
+
+        toc = time.time()
+        logging.info("Calculating dev loss over %i examples and F1/EM for %i examples in dev set took %.2f seconds" % (num_loss_examples, example_num, toc-tic))
+
+        return loss_total / num_loss_examples, f1_total / example_num, em_total / example_num
+
+
+    def load_dev_batches(self, dev_context_path, dev_qn_path, dev_ans_path):
+        """
+        Reads the dev set into memory once, for evaluate (and get_dev_loss_f1_em) to use every time.
+
+        Returns:
+          dev_batches: list of Batches
+        """
+        tic = time.time()
+        dev_batches = load_batches(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False)
+        toc = time.time()
+        logging.info("Loaded %i dev examples into memory in %.2f seconds" % (sum(batch.batch_size for batch in dev_batches), toc-tic))
+        return dev_batches
+
+
+    def sample_train_eval_batches(self, train_context_path, train_qn_path, train_ans_path, rng):
+        """
+        Draws a uniform random sample of FLAGS.train_eval_samples training examples
+        (reservoir sampling, in one pass over the files) to estimate train F1/EM on.
+
+        Inputs:
+          train_{qn/context/ans}_path: paths to the train.{context/question/answer} data files
+          rng: np.random.RandomState. Use the same seed for the same sample.
+
+        Returns:
+          train_batches: list of Batches
+        """
+        tic = time.time()
+        train_batches = load_sampled_batches(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.train_eval_samples, rng, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len)
+        toc = time.time()
+        logging.info("Sampled %i train examples for evaluation in %.2f seconds" % (sum(batch.batch_size for batch in train_batches), toc-tic))
+        return train_batches
+
+
+    def evaluate(self, session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path, global_step, summary_writer, log_prefix, dev_batches=None, train_batches=None):
+        """
+        Computes the loss on the dev set, F1/EM on a sample of train examples and F1/EM on the dev set,
+        and logs them to the screen and to tensorboard.
+        Used by train, and by the eval worker (see eval_worker.py).
+
+        Inputs:
+          session: TensorFlow session
+          {train/dev}_{qn/context/ans}_path: paths to {train/dev}.{context/question/answer} data files
+          global_step: int. The training iteration the model is at.
+          summary_writer: for Tensorboard
+          log_prefix: string to start each log line with, e.g. "Epoch 1, Iter 500"
+          dev_batches: optional list of dev set Batches (see load_dev_batches) to use instead of reading the files
+          train_batches: optional sample of train set Batches (see sample_train_eval_batches).
+            If not given, the first FLAGS.train_eval_samples examples of the train set are used.
+
+        Returns:
+          dev_f1, dev_em: floats
+        """
+        # Get loss and F1/EM for entire dev set, in one pass
+        dev_loss, dev_f1, dev_em = self.get_dev_loss_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path, batches=dev_batches)
+
+        # Log dev loss to tensorboard
+        logging.info("%s, dev loss: %f" % (log_prefix, dev_loss))
+        write_summary(dev_loss, "dev/loss", summary_writer, global_step)
+
+
+        # Get F1/EM on train set and log to tensorboard
+        train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=self.FLAGS.train_eval_samples, batches=train_batches)
+        logging.info("%s, Train F1 score: %f, Train EM score: %f" % (log_prefix, train_f1, train_em))
+        write_summary(train_f1, "train/F1", summary_writer, global_step)
+        write_summary(train_em, "train/EM", summary_writer, global_step)
+
+
+        # Log F1/EM on dev set to tensorboard
+        logging.info("%s, Dev F1 score: %f, Dev EM score: %f" % (log_prefix, dev_f1, dev_em))
+        write_summary(dev_f1, "dev/F1", summary_writer, global_step)
+        write_summary(dev_em, "dev/EM", summary_writer, global_step)
+
+        return dev_f1, dev_em
+
+    def train(self, session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path, shard_index=0, num_shards=1, is_chief=True):
         """
         Main training loop.
 
         Inputs:
           session: TensorFlow session
           {train/dev}_{qn/context/ans}_path: paths to {train/dev}.{context/question/answer} data files
+          shard_index, num_shards: which part of the training data to train on (see get_batch_generator)
+          is_chief: In distributed training (see distributed.py), only the chief saves and evaluates,
+            and the other workers keep training until they're stopped.
+
+        With num_train_threads > 1, this thread trains on the first of num_train_threads shards
+        of its data and does the logging, saving and evaluation, while the other threads train on
+        the other shards (see train_thread) until this thread is done. The other threads are paused
+        while the model is saved or evaluated, so that the checkpoints are of the model that was scored.
         """
 
         # Print number of model parameters
@@ -412,24 +873,83 @@ class BaselineModel(object):
         best_dev_f1 = None
         best_dev_em = None
 
+        # The dev set is evaluated many times, so read it once
+        dev_batches = None
+        if is_chief and not self.FLAGS.async_eval:
+            dev_batches = self.load_dev_batches(dev_context_path, dev_qn_path, dev_ans_path)
+
+        # Train F1/EM is estimated on a random sample of the train set, redrawn every train_eval_refresh evaluations
+        train_eval_rng = np.random.RandomState(42)
+        train_batches = None
+        num_evals = 0
+
+        # With target_f1, training stops once dev F1 reaches it (to measure time-to-target)
+        reached_target = False
+
         # for TensorBoard
-        summary_writer = tf.summary.FileWriter(self.FLAGS.train_dir, session.graph)
+        summary_dir = self.FLAGS.train_dir if is_chief else os.path.join(self.FLAGS.train_dir, "worker%i" % shard_index)
+        summary_writer = tf.summary.FileWriter(summary_dir, session.graph)
 
         epoch = 0
 
+        # Hogwild training: start the other training threads, each on its own shard of the data
+        num_threads = self.FLAGS.num_train_threads
+        stop_event = threading.Event()
+        run_event = threading.Event()
+        run_event.set()
+        iter_locks = [threading.Lock() for _ in range(1, num_threads)]
+        examples_trained = [0] * num_threads
+        threads = [threading.Thread(target=self.train_thread, args=(session, train_context_path, train_qn_path, train_ans_path, shard_index * num_threads + i, num_shards * num_threads, summary_writer, stop_event, examples_trained, i, run_event, iter_locks[i - 1])) for i in range(1, num_threads)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        train_tic = time.time()
+
+        def pause_threads():
+            """Waits until the other training threads have finished their current iterations and are paused"""
+            run_event.clear()
+            for lock in iter_locks:
+                lock.acquire()
+
+        def resume_threads():
+            for lock in iter_locks:
+                lock.release()
+            run_event.set()
+
+        # The other threads advance global_step too, so this thread won't see every step.
+        # Print, save and evaluate when global_step reaches the next multiple of print_every, save_every and eval_every
+        def next_multiple(step, every):
+            return (step // every + 1) * every
+        start_step = session.run(self.global_step)
+        next_print = next_multiple(start_step, self.FLAGS.print_every)
+        next_save = next_multiple(start_step, self.FLAGS.save_every)
+        next_eval = next_multiple(start_step, self.FLAGS.eval_every)
+
+        # With gradient accumulation, each training iteration uses grad_accum_steps batches
+        accum_batches = []
+
         logging.info("Beginning training loop...")
-        while self.FLAGS.num_epochs == 0 or epoch < self.FLAGS.num_epochs:
+        while (self.FLAGS.num_epochs == 0 or epoch < self.FLAGS.num_epochs or not is_chief) and not reached_target:
             epoch += 1
             epoch_tic = time.time()
 
             # Loop over batches
-            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
+            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True, shard_index=shard_index * num_threads, num_shards=num_shards * num_threads):
 
                 # Run training iteration
+                if self.FLAGS.grad_accum_steps > 1:
+                    accum_batches.append(batch)
+                    if len(accum_batches) < self.FLAGS.grad_accum_steps:
+                        continue
                 iter_tic = time.time()
-                loss, global_step, param_norm, grad_norm = self.run_train_iter(session, batch, summary_writer)
+                if self.FLAGS.grad_accum_steps > 1:
+                    loss, global_step, param_norm, grad_norm = self.run_accumulated_train_iter(session, accum_batches, summary_writer)
+                    accum_batches = []
+                else:
+                    loss, global_step, param_norm, grad_norm = self.run_train_iter(session, batch, summary_writer)
                 iter_toc = time.time()
                 iter_time = iter_toc - iter_tic
+                examples_trained[0] += batch.batch_size * self.FLAGS.grad_accum_steps
 
                 # Update exponentially-smoothed loss
                 if not exp_loss: # first iter
@@ -438,37 +958,34 @@ class BaselineModel(object):
                     exp_loss = 0.99 * exp_loss + 0.01 * loss
 
                 # Sometimes print info to screen
-                if global_step % self.FLAGS.print_every == 0:
+                if global_step >= next_print:
+                    next_print = next_multiple(global_step, self.FLAGS.print_every)
+                    examples_per_sec = sum(examples_trained) / (iter_toc - train_tic) # over all training threads in this process
                     logging.info(
-                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f' %
-                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time))
+                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f, examples/sec %.1f' %
+                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time, examples_per_sec))
 
                 # Sometimes save model
-                if global_step % self.FLAGS.save_every == 0:
+                if is_chief and global_step >= next_save:
+                    next_save = next_multiple(global_step, self.FLAGS.save_every)
+                    pause_threads()
                     logging.info("Saving to %s..." % checkpoint_path)
                     self.saver.save(session, checkpoint_path, global_step=global_step)
+                    resume_threads()
 
                 # Sometimes evaluate model on dev loss, train F1/EM and dev F1/EM
-                if global_step % self.FLAGS.eval_every == 0:
-
-                    # Get loss for entire dev set and log to tensorboard
-                    dev_loss = self.get_dev_loss(session, dev_context_path, dev_qn_path, dev_ans_path)
-                    logging.info("Epoch %d, Iter %d, dev loss: %f" % (epoch, global_step, dev_loss))
-                    write_summary(dev_loss, "dev/loss", summary_writer, global_step)
-
+                # (unless a separate eval_worker process evaluates the checkpoints)
+                if is_chief and not self.FLAGS.async_eval and global_step >= next_eval:
+                    next_eval = next_multiple(global_step, self.FLAGS.eval_every)
+                    pause_threads()
+                    if train_batches is None or (self.FLAGS.train_eval_refresh and num_evals % self.FLAGS.train_eval_refresh == 0):
+                        train_batches = self.sample_train_eval_batches(train_context_path, train_qn_path, train_ans_path, train_eval_rng)
+                    num_evals += 1
+                    dev_f1, dev_em = self.evaluate(session, train_context_path, train_qn_path, train_ans_path, dev_qn_path, dev_context_path, dev_ans_path, global_step, summary_writer, "Epoch %d, Iter %d" % (epoch, global_step), dev_batches=dev_batches, train_batches=train_batches)
 
-                    # Get F1/EM on train set and log to tensorboard
-                    train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
-                    logging.info("Epoch %d, Iter %d, Train F1 score: %f, Train EM score: %f" % (epoch, global_step, train_f1, train_em))
-                    write_summary(train_f1, "train/F1", summary_writer, global_step)
-                    write_summary(train_em, "train/EM", summary_writer, global_step)
-
-
-                    # Get F1/EM on dev set and log to tensorboard
-                    dev_f1, dev_em = self.check_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=0)
-                    logging.info("Epoch %d, Iter %d, Dev F1 score: %f, Dev EM score: %f" % (epoch, global_step, dev_f1, dev_em))
-                    write_summary(dev_f1, "dev/F1", summary_writer, global_step)
-                    write_summary(dev_em, "dev/EM", summary_writer, global_step)
+                    if self.FLAGS.target_f1 and dev_f1 >= self.FLAGS.target_f1:
+                        reached_target = True
+                        logging.info("Reached target dev F1 %f at iter %d, after %.1f seconds and %d examples" % (self.FLAGS.target_f1, global_step, time.time() - train_tic, global_step * effective_batch_size(self.FLAGS)))
 
 
                     # Early stopping based on dev EM. You could switch this to use F1 instead.
@@ -477,10 +994,24 @@ class BaselineModel(object):
                         logging.info("Saving to %s..." % bestmodel_ckpt_path)
                         self.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
 
+                    resume_threads()
+
+                    if reached_target:
+                        break
+
 
             epoch_toc = time.time()
             logging.info("End of epoch %i. Time for epoch: %f" % (epoch, epoch_toc-epoch_tic))
 
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+        # Make sure the eval worker sees the final model
+        if is_chief and self.FLAGS.async_eval:
+            logging.info("Saving to %s..." % checkpoint_path)
+            self.saver.save(session, checkpoint_path, global_step=self.global_step)
+
         sys.stdout.flush()
 
 
@@ -14,10 +14,58 @@
 
 """This file contains some basic model components"""
 
+import itertools
+
 import tensorflow as tf
 from tensorflow.python.ops.rnn_cell import DropoutWrapper
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import rnn_cell
+from tensorflow.python.ops import array_ops
+
+
+_recompute_ids = itertools.count() # each recomputed layer needs its own registered gradient function
+
+NUM_LENGTH_BUCKETS = 4 # RNNEncoder rounds the length it runs for up to one of this many sizes
+
+
+def recompute_grad(fn, x, y, variables):
+    """
+    Gradient checkpointing for one layer.
+
+    Returns a tensor equal to y = fn(x), but whose gradient is computed by calling fn(x) again
+    during the backward pass. The activations inside fn are then freed after the forward pass
+    instead of being kept for backprop; only the layer input x is kept.
+    This uses less memory, at the cost of running fn twice per training step.
+
+    Inputs:
+      fn: function from a Tensor to a Tensor. Must be deterministic (i.e. no dropout inside),
+        and must reuse its variables when called again.
+      x: Tensor. The input to the layer.
+      y: Tensor. fn(x), as computed in the forward pass.
+      variables: list of the variables used by fn.
+
+    Returns:
+      Tensor equal to y.
+    """
+    grad_name = "RecomputeGrad_%i" % next(_recompute_ids)
+
+    @tf.RegisterGradient(grad_name)
+    def _recompute_grad(op, dy, *unused_grads):
+        # Build the recomputation outside of the enclosing tf.gradients' name scope:
+        # TensorFlow tells the gradients of while loops (e.g. dynamic_rnn) apart by their name scope,
+        # so the nested tf.gradients below must not be under the outer "gradients/" scope
+        with tf.name_scope(None):
+            # Make sure the recomputation only runs once the gradient has arrived (i.e. in the backward pass)
+            with tf.control_dependencies([dy]):
+                x_again = tf.identity(x)
+            y_again = fn(x_again)
+            grads = tf.gradients(tf.reduce_sum(y_again * tf.stop_gradient(dy)), [x_again] + variables)
+        return [None] + grads # no gradient flows into the original forward pass of fn
+
+    # Pass x and the variables through the same op as y, so that the gradient function can return their gradients
+    with tf.get_default_graph().gradient_override_map({"IdentityN": grad_name}):
+        outputs = array_ops.identity_n([y, x] + variables)
+    return outputs[0]
 
 
 class RNNEncoder(object):
@@ -36,18 +84,21 @@ class RNNEncoder(object):
     This code uses a bidirectional GRU, but you could experiment with other types of RNN.
     """
 
-    def __init__(self, hidden_size, keep_prob):
+    def __init__(self, hidden_size, keep_prob, recompute=False):
         """
         Inputs:
           hidden_size: int. Hidden size of the RNN
           keep_prob: Tensor containing a single scalar that is the keep probability (for dropout)
+          recompute: If True, don't keep the RNN's activations for the backward pass;
+            recompute them instead (see recompute_grad).
         """
         self.hidden_size = hidden_size
         self.keep_prob = keep_prob
-        self.rnn_cell_fw = rnn_cell.GRUCell(self.hidden_size)
-        self.rnn_cell_fw = DropoutWrapper(self.rnn_cell_fw, input_keep_prob=self.keep_prob)
-        self.rnn_cell_bw = rnn_cell.GRUCell(self.hidden_size)
-        self.rnn_cell_bw = DropoutWrapper(self.rnn_cell_bw, input_keep_prob=self.keep_prob)
+        self.recompute = recompute
+        self.gru_cell_fw = rnn_cell.GRUCell(self.hidden_size)
+        self.rnn_cell_fw = DropoutWrapper(self.gru_cell_fw, input_keep_prob=self.keep_prob)
+        self.gru_cell_bw = rnn_cell.GRUCell(self.hidden_size)
+        self.rnn_cell_bw = DropoutWrapper(self.gru_cell_bw, input_keep_prob=self.keep_prob)
 
     def build_graph(self, inputs, masks, scope_name="RNNEncoder"):
         """
@@ -61,15 +112,44 @@ class RNNEncoder(object):
           out: Tensor shape (batch_size, seq_len, hidden_size*2).
             This is all hidden states (fw and bw hidden states are concatenated).
         """
-        with vs.variable_scope(scope_name):
+        with vs.variable_scope(scope_name) as scope:
             input_lens = tf.reduce_sum(masks, reduction_indices=1) # shape (batch_size)
 
-            # Note: fw_out and bw_out are the hidden states for every timestep.
-            # Each is shape (batch_size, seq_len, hidden_size).
-            (fw_out, bw_out), _ = tf.nn.bidirectional_dynamic_rnn(self.rnn_cell_fw, self.rnn_cell_bw, inputs, input_lens, dtype=tf.float32)
-
-            # Concatenate the forward and backward hidden states
-            out = tf.concat([fw_out, bw_out], 2)
+            # dynamic_rnn steps through every timestep of its input (its outputs past input_lens are just zeros),
+            # so only give it the first max(input_lens) timesteps, and pad the output back to seq_len afterwards.
+            # This makes batches of shorter inputs faster (see official_eval_helper.refill_batches).
+            # max_len is rounded up to a multiple of seq_len / NUM_LENGTH_BUCKETS, so the RNN only ever sees
+            # a few different shapes (with --xla_jit, each new shape is compiled again; see session_config.py)
+            out_shape = inputs.get_shape()[:2].concatenate([self.hidden_size * 2])
+            seq_len = tf.shape(inputs)[1]
+            bucket_len = (seq_len + NUM_LENGTH_BUCKETS - 1) // NUM_LENGTH_BUCKETS
+            max_len = tf.maximum(tf.reduce_max(input_lens), 1)
+            max_len = tf.minimum((max_len + bucket_len - 1) // bucket_len * bucket_len, seq_len)
+            inputs = inputs[:, :max_len, :] # shape (batch_size, max_len, input_size)
+
+            if self.recompute:
+                # The recomputation has to see the same dropout mask as the forward pass,
+                # so apply the input dropout (which is what DropoutWrapper does) outside of it
+                inputs = tf.nn.dropout(inputs, self.keep_prob)
+
+                def encode(x):
+                    with vs.variable_scope(scope):
+                        (fw_out, bw_out), _ = tf.nn.bidirectional_dynamic_rnn(self.gru_cell_fw, self.gru_cell_bw, x, input_lens, dtype=tf.float32)
+                        return tf.concat([fw_out, bw_out], 2)
+
+                out = encode(inputs)
+                out = recompute_grad(encode, inputs, out, self.gru_cell_fw.trainable_weights + self.gru_cell_bw.trainable_weights)
+            else:
+                # Note: fw_out and bw_out are the hidden states for every timestep.
+                # Each is shape (batch_size, seq_len, hidden_size).
+                (fw_out, bw_out), _ = tf.nn.bidirectional_dynamic_rnn(self.rnn_cell_fw, self.rnn_cell_bw, inputs, input_lens, dtype=tf.float32)
+
+                # Concatenate the forward and backward hidden states
+                out = tf.concat([fw_out, bw_out], 2)
+
+            # Pad back to seq_len
+            out = tf.pad(out, [[0, 0], [0, seq_len - max_len], [0, 0]])
+            out.set_shape(out_shape) # shape (batch_size, seq_len, hidden_size*2)
 
             # Apply dropout
             out = tf.nn.dropout(out, self.keep_prob)
@@ -191,9 +271,10 @@ class AnsPtr(object):
 
 class BiDAFOut(object):
 
-    def __init__(self, hidden_size, keep_prob):
+    def __init__(self, hidden_size, keep_prob, recompute=False):
         self.hidden_size = hidden_size
         self.keep_prob = keep_prob
+        self.recompute = recompute # passed on to the M2 RNNEncoder
         # self.rnn_cell = rnn_cell.GRUCell(self.hidden_size)
         # self.rnn_cell = DropoutWrapper(self.rnn_cell, input_keep_prob=self.keep_prob)
 
@@ -207,14 +288,14 @@ class BiDAFOut(object):
 
             w1 = tf.get_variable("w1", shape=(self.hidden_size*10), initializer=tf.contrib.layers.xavier_initializer())
             weighted_mult1 = tf.tensordot(tf.concat([G,M], axis=2), w1, axes=[[2],[0]])
-            start_logits, start_dist = masked_softmax(weighted_mult1, masks, 2)
+            start_logits, start_dist = masked_softmax(weighted_mult1, masks, 1)
 
             # M2, _ = tf.nn.dynamic_rnn(self.rnn_cell, attn_output, input_lens, dtype=tf.float32)
-            M2 = RNNEncoder(self.hidden_size, self.keep_prob).build_graph(M, masks, scope_name="M2")
+            M2 = RNNEncoder(self.hidden_size, self.keep_prob, recompute=self.recompute).build_graph(M, masks, scope_name="M2")
 
             w2 = tf.get_variable("w2", shape=(self.hidden_size*10), initializer=tf.contrib.layers.xavier_initializer())
             weighted_mult2 = tf.tensordot(tf.concat([G,M2], axis=2), w2, axes=[[2],[0]])
-            end_logits, end_dist = masked_softmax(weighted_mult2, masks, 2)
+            end_logits, end_dist = masked_softmax(weighted_mult2, masks, 1)
 
             return start_logits, start_dist, end_logits, end_dist
 
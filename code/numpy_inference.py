@@ -0,0 +1,359 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a NumPy-only implementation of the forward pass of our models.
+It's meant for small-batch CPU serving, where TensorFlow's import time and
+per-session.run overhead dominate.
+
+Usage:
+  1. Convert a checkpoint to a .npz file once (this step needs TensorFlow):
+       weights = load_checkpoint_weights(ckpt_path); save_weights(weights, npz_path)
+     (or use export_numpy / quantize mode in main.py)
+  2. Serve without TensorFlow:
+       model = NumpyModel(FLAGS, model_name, load_weights(npz_path), emb_matrix)
+       probdist_start, probdist_end = model.get_prob_dists(None, batch)
+     official_eval mode in main.py does this when given --numpy_weights_path.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+from six.moves import xrange
+
+from quantization import QuantizedKernel, load_quantized_weights
+
+
+SCOPE = "QAModel/"
+
+
+def load_checkpoint_weights(ckpt_path):
+    """
+    Reads the model variables from a TensorFlow checkpoint.
+
+    Inputs:
+      ckpt_path: path to the checkpoint (e.g. experiments/{experiment_name}/best_checkpoint/qa_best.ckpt-1000)
+
+    Returns:
+      weights: dictionary mapping variable name (string, without the "QAModel/" scope) to numpy array.
+        Optimizer slot variables are skipped.
+    """
+    # This is the only function in this file that needs TensorFlow
+    import tensorflow as tf
+
+    reader = tf.train.NewCheckpointReader(ckpt_path)
+    names = set(reader.get_variable_to_shape_map())
+    weights = {}
+    for name in names:
+        # Optimizer slot variables (Adam, LAMB, LARS, ...) are named after the variable they belong to,
+        # e.g. "QAModel/fully_connected/weights/LAMB_1", so skip any variable nested under another variable
+        parents = ["/".join(name.split("/")[:i]) for i in range(1, name.count("/") + 1)]
+        if name.startswith(SCOPE) and not any(parent in names for parent in parents):
+            weights[name[len(SCOPE):]] = reader.get_tensor(name)
+    return weights
+
+
+def save_weights(weights, path):
+    """Saves the dictionary returned by load_checkpoint_weights to a .npz file"""
+    np.savez(path, **weights)
+
+
+def load_weights(path):
+    """
+    Loads the dictionary saved by save_weights, or by quantization.save_quantized_weights
+    (in which case the weight matrices are QuantizedKernels).
+    """
+    return load_quantized_weights(path)
+
+
+def masked_softmax(logits, mask, dim):
+    """
+    NumPy version of modules.masked_softmax.
+
+    Inputs:
+      logits: Numpy array. We want to take softmax over dimension dim.
+      mask: Numpy array broadcastable to logits. 1s where there's real data, 0s where there's padding.
+      dim: int. dimension over which to take softmax
+
+    Returns:
+      masked_logits, prob_dist: Numpy arrays same shape as logits
+    """
+    exp_mask = (1 - mask.astype(np.float32)) * np.float32(-1e30) # -large where there's padding, 0 elsewhere
+    masked_logits = logits + exp_mask
+    return masked_logits, softmax(masked_logits, dim)
+
+
+def softmax(logits, dim):
+    """Softmax over dimension dim"""
+    exp_logits = np.exp(logits - np.max(logits, axis=dim, keepdims=True))
+    return exp_logits / np.sum(exp_logits, axis=dim, keepdims=True)
+
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def fully_connected(weights, scope, inputs, activation_fn=True):
+    """
+    NumPy version of tf.contrib.layers.fully_connected (with ReLU, unless activation_fn=False).
+
+    Inputs:
+      weights: dictionary of weights (see load_checkpoint_weights)
+      scope: string. The variable scope of the layer, e.g. "fully_connected"
+      inputs: Numpy array shape (..., input_size)
+    """
+    out = np.dot(inputs, weights[scope + "/weights"]) + weights[scope + "/biases"]
+    if activation_fn:
+        out = np.maximum(out, 0)
+    return out
+
+
+def reverse_sequence(inputs, lens):
+    """NumPy version of tf.reverse_sequence with batch_axis=0, seq_axis=1"""
+    batch_size, seq_len = inputs.shape[:2]
+    positions = np.arange(seq_len)[np.newaxis, :] # shape (1, seq_len)
+    lens = lens[:, np.newaxis] # shape (batch_size, 1)
+    idxs = np.where(positions < lens, lens - 1 - positions, positions) # shape (batch_size, seq_len)
+    return inputs[np.arange(batch_size)[:, np.newaxis], idxs]
+
+
+def gru(weights, scope, inputs, lens):
+    """
+    NumPy version of tf.nn.dynamic_rnn with a GRUCell, starting from the zero state.
+
+    The input projections for all timesteps are computed with one matrix multiply,
+    so only the recurrent projections are computed inside the loop over timesteps.
+
+    Inputs:
+      weights: dictionary of weights (see load_checkpoint_weights)
+      scope: string. The variable scope of the GRUCell, e.g. "RNNEncoder/bidirectional_rnn/fw/gru_cell"
+      inputs: Numpy array shape (batch_size, seq_len, input_size)
+      lens: Numpy array shape (batch_size). Length of each sequence.
+
+    Returns:
+      outputs: Numpy array shape (batch_size, seq_len, hidden_size). Zero after the end of each sequence.
+      state: Numpy array shape (batch_size, hidden_size). The state at the end of each sequence.
+    """
+    gates_kernel, gates_bias = weights[scope + "/gates/kernel"], weights[scope + "/gates/bias"]
+    candidate_kernel, candidate_bias = weights[scope + "/candidate/kernel"], weights[scope + "/candidate/bias"]
+    batch_size, seq_len, input_size = inputs.shape
+    hidden_size = candidate_bias.shape[0]
+
+    # The kernels act on [inputs, state]. Split them into the input part and the recurrent part.
+    gates_input = np.dot(inputs, gates_kernel[:input_size]) + gates_bias # shape (batch_size, seq_len, 2*hidden_size)
+    candidate_input = np.dot(inputs, candidate_kernel[:input_size]) + candidate_bias # shape (batch_size, seq_len, hidden_size)
+    gates_recurrent = gates_kernel[input_size:]
+    candidate_recurrent = candidate_kernel[input_size:]
+
+    state = np.zeros((batch_size, hidden_size), dtype=np.float32)
+    outputs = np.zeros((batch_size, seq_len, hidden_size), dtype=np.float32)
+
+    # Like tf.nn.dynamic_rnn, stop at the longest sequence in the batch
+    for t in xrange(int(np.max(lens)) if batch_size else 0):
+        gates = sigmoid(gates_input[:, t] + np.dot(state, gates_recurrent))
+        r, u = gates[:, :hidden_size], gates[:, hidden_size:]
+        c = np.tanh(candidate_input[:, t] + np.dot(r * state, candidate_recurrent))
+        new_state = u * state + (1 - u) * c
+
+        # Sequences that have ended keep their state and output zeros
+        active = (t < lens)[:, np.newaxis]
+        state = np.where(active, new_state, state)
+        outputs[:, t] = np.where(active, new_state, 0)
+
+    return outputs, state
+
+
+def rnn_encoder(weights, scope, inputs, masks):
+    """
+    NumPy version of modules.RNNEncoder (a bidirectional GRU).
+
+    Inputs:
+      weights: dictionary of weights (see load_checkpoint_weights)
+      scope: string. The scope_name the RNNEncoder was built with, e.g. "RNNEncoder"
+      inputs: Numpy array shape (batch_size, seq_len, input_size)
+      masks: Numpy array shape (batch_size, seq_len)
+
+    Returns:
+      out: Numpy array shape (batch_size, seq_len, hidden_size*2)
+    """
+    lens = np.sum(masks, axis=1)
+    fw_out, _ = gru(weights, scope + "/bidirectional_rnn/fw/gru_cell", inputs, lens)
+    bw_out, _ = gru(weights, scope + "/bidirectional_rnn/bw/gru_cell", reverse_sequence(inputs, lens), lens)
+    bw_out = reverse_sequence(bw_out, lens)
+    return np.concatenate([fw_out, bw_out], axis=2)
+
+
+def basic_attn(values, values_mask, keys):
+    """
+    NumPy version of modules.BasicAttn.
+
+    Inputs:
+      values: Numpy array shape (batch_size, num_values, value_vec_size)
+      values_mask: Numpy array shape (batch_size, num_values)
+      keys: Numpy array shape (batch_size, num_keys, value_vec_size)
+
+    Returns:
+      attn_logits, attn_dist: Numpy arrays shape (batch_size, num_keys, num_values)
+      output: Numpy array shape (batch_size, num_keys, value_vec_size)
+    """
+    attn_logits = np.matmul(keys, values.transpose(0, 2, 1)) # shape (batch_size, num_keys, num_values)
+    attn_logits, attn_dist = masked_softmax(attn_logits, values_mask[:, np.newaxis, :], 2)
+    output = np.matmul(attn_dist, values) # shape (batch_size, num_keys, value_vec_size)
+    return attn_logits, attn_dist, output
+
+
+def bidaf_attn(weights, documents, queries, documents_mask, queries_mask):
+    """
+    NumPy version of modules.BiDAF.
+
+    Inputs:
+      weights: dictionary of weights (see load_checkpoint_weights)
+      documents: Numpy array shape (batch_size, num_docs, vec_size)
+      queries: Numpy array shape (batch_size, num_queries, vec_size)
+      documents_mask: Numpy array shape (batch_size, num_docs)
+      queries_mask: Numpy array shape (batch_size, num_queries)
+
+    Returns:
+      b: Numpy array shape (batch_size, num_docs, 4*vec_size)
+    """
+    # Similarity matrix S, shape (batch_size, num_docs, num_queries)
+    # Note: the trilinear term sum_k d_ik * w_k * q_jk is computed as (d * w) q^T,
+    # which avoids building the (batch_size, num_docs, num_queries, vec_size) tensor
+    weighted_mult = np.matmul(documents * weights["BiDAF/W_sim_mult"], queries.transpose(0, 2, 1))
+    weighted_docs = np.dot(documents, weights["BiDAF/W_sim_docs"]) # shape (batch_size, num_docs, 1)
+    weighted_queries = np.dot(queries, weights["BiDAF/W_sim_queries"]).transpose(0, 2, 1) # shape (batch_size, 1, num_queries)
+    S = weighted_mult + weighted_docs + weighted_queries
+
+    mask = (documents_mask[:, :, np.newaxis] * queries_mask[:, np.newaxis, :]).astype(np.float32) # shape (batch_size, num_docs, num_queries)
+
+    # Context to Query attention
+    _, C2Q = masked_softmax(S, mask, 2)
+    a = np.matmul(C2Q, queries) # shape (batch_size, num_docs, vec_size)
+
+    # Query to Context attention
+    masked_S = S * mask
+    m = np.max(masked_S, axis=2, keepdims=True) # shape (batch_size, num_docs, 1)
+    beta = softmax(m, 1) # shape (batch_size, num_docs, 1)
+    cprime = np.matmul(documents.transpose(0, 2, 1), beta) # shape (batch_size, vec_size, 1)
+
+    return np.concatenate([documents, a, documents * a, documents * cprime.transpose(0, 2, 1)], axis=2)
+
+
+def simple_softmax_layer(weights, scope, inputs, masks):
+    """NumPy version of modules.SimpleSoftmaxLayer, built under variable scope scope (e.g. "StartDist")"""
+    logits = fully_connected(weights, scope + "/SimpleSoftmaxLayer/fully_connected", inputs, activation_fn=False)[:, :, 0]
+    return masked_softmax(logits, masks, 1)
+
+
+def ansptr(weights, inputs, masks):
+    """NumPy version of modules.AnsPtr. Returns start_dist, end_dist"""
+    lens = np.sum(masks, axis=1)
+
+    # RNN over the inputs; its final state attends to the inputs to get the start distribution
+    _, state = gru(weights, "AnsPtr/rnn/gru_cell", inputs, lens)
+    _, start_dist, attn_output = basic_attn(inputs, masks, state[:, np.newaxis, :])
+
+    # One RNN step (from the zero state) on the attention output; attend again to get the end distribution
+    _, state = gru(weights, "AnsPtr/rnn/gru_cell", attn_output, np.ones_like(lens))
+    _, end_dist, _ = basic_attn(inputs, masks, state[:, np.newaxis, :])
+
+    return start_dist[:, 0, :], end_dist[:, 0, :]
+
+
+class NumpyModel(object):
+    """
+    NumPy-only forward pass for the models in main.models (except "AoA").
+    Has the same inference methods as BaselineModel (get_prob_dists, get_start_end_pos),
+    so it can be used with official_eval_helper.generate_answers.
+    """
+
+    def __init__(self, FLAGS, model_name, weights, emb_matrix):
+        """
+        Inputs:
+          FLAGS: the flags passed in from main.py
+          model_name: string. A key of main.models
+          weights: dictionary of weights (see load_checkpoint_weights).
+            May contain QuantizedKernels (see quantization.quantize_weights), which are dequantized here.
+          emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+        """
+        if model_name not in ["baseline", "BiDAF", "complete", "AnsPtr"]:
+            raise Exception("The NumPy forward pass isn't implemented for model %s" % model_name)
+        self.FLAGS = FLAGS
+        self.model_name = model_name
+        # int8 is only a storage format: np.dot has no int8 GEMM, and would convert
+        # the int8 values to float on every call, so dequantize once here
+        self.weights = dict((name, value.dequantize() if isinstance(value, QuantizedKernel) else value.astype(np.float32)) for name, value in weights.items())
+        self.emb_matrix = emb_matrix.astype(np.float32)
+
+        # The context encoding isn't cached (see ContextEncodingCache)
+        self.context_hiddens = None
+
+    def forward(self, context_ids, context_mask, qn_ids, qn_mask):
+        """
+        Inputs:
+          context_ids, context_mask: Numpy arrays shape (batch_size, context_len)
+          qn_ids, qn_mask: Numpy arrays shape (batch_size, question_len)
+
+        Returns:
+          probdist_start and probdist_end: both shape (batch_size, context_len)
+        """
+        w = self.weights
+        context_embs = self.emb_matrix[context_ids]
+        qn_embs = self.emb_matrix[qn_ids]
+
+        # The encoder is shared between the context and the question
+        context_hiddens = rnn_encoder(w, "RNNEncoder", context_embs, context_mask)
+        question_hiddens = rnn_encoder(w, "RNNEncoder", qn_embs, qn_mask)
+
+        if self.model_name in ["baseline", "AnsPtr"]:
+            _, _, attn_output = basic_attn(question_hiddens, qn_mask, context_hiddens)
+        else:
+            attn_output = bidaf_attn(w, context_hiddens, question_hiddens, context_mask, qn_mask)
+        blended_reps = np.concatenate([context_hiddens, attn_output], axis=2)
+
+        if self.model_name == "complete":
+            M = rnn_encoder(w, "BidafEncoder", blended_reps, context_mask)
+            _, probdist_start = masked_softmax(np.dot(np.concatenate([attn_output, M], axis=2), w["BiDAFOut/w1"]), context_mask, 1)
+            M2 = rnn_encoder(w, "BiDAFOut/M2", M, context_mask)
+            _, probdist_end = masked_softmax(np.dot(np.concatenate([attn_output, M2], axis=2), w["BiDAFOut/w2"]), context_mask, 1)
+            return probdist_start, probdist_end
+
+        blended_reps_final = fully_connected(w, "fully_connected", blended_reps)
+
+        if self.model_name == "AnsPtr":
+            return ansptr(w, blended_reps_final, context_mask)
+
+        _, probdist_start = simple_softmax_layer(w, "StartDist", blended_reps_final, context_mask)
+        _, probdist_end = simple_softmax_layer(w, "EndDist", blended_reps_final, context_mask)
+        return probdist_start, probdist_end
+
+    def get_prob_dists(self, session, batch):
+        """
+        Get probability distributions for start and end positions.
+        session is ignored; it's there so NumpyModel can be used in place of a BaselineModel.
+
+        Returns:
+          probdist_start and probdist_end: both shape (batch_size, context_len)
+        """
+        return self.forward(batch.context_ids, batch.context_mask, batch.qn_ids, batch.qn_mask)
+
+    def get_start_end_pos(self, session, batch):
+        """
+        Get the most likely answer span.
+
+        Returns:
+          start_pos, end_pos: both numpy arrays shape (batch_size).
+        """
+        start_dist, end_dist = self.get_prob_dists(session, batch)
+        return np.argmax(start_dist, axis=1), np.argmax(end_dist, axis=1)
@@ -19,129 +19,207 @@ and write those answers to another JSON file."""
 from __future__ import absolute_import
 from __future__ import division
 
+import io
 import os
+import json
+import shutil
+import hashlib
+import subprocess
+import multiprocessing
+from itertools import tee
+from operator import itemgetter
 from tqdm import tqdm
 import numpy as np
-from six.moves import xrange
+from six.moves import xrange, map as imap, zip as izip, cPickle as pickle
 from nltk.tokenize.moses import MosesDetokenizer
 
 from preprocessing.squad_preprocess import data_from_json, tokenize
 from vocab import UNK_ID, PAD_ID
 from data_batcher import padded, Batch
+from context_cache import ContextEncodingCache
 
 
+# Change this when the tokenization changes, so that old token caches aren't used
+TOKEN_CACHE_VERSION = 1
 
-def readnext(x):
-    """x is a list"""
-    if len(x) == 0:
-        return False
-    else:
-        return x.pop(0)
 
+def get_window_starts(num_tokens, context_len, doc_stride):
+    """
+    Splits a context of length num_tokens into overlapping windows of length context_len.
 
+    Inputs:
+      num_tokens: int. Length of the context.
+      context_len: int. Length of each window.
+      doc_stride: int. Distance between the starts of consecutive windows.
+        Should be at most context_len, otherwise some tokens are in no window.
 
-def refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+    Returns:
+      window_starts: list of ints. The start position of each window.
+        The last window is shifted back so that it ends at the end of the context.
+    """
+    if num_tokens <= context_len:
+        return [0]
+    window_starts = range(0, num_tokens - context_len, doc_stride)
+    window_starts.append(num_tokens - context_len)
+    return window_starts
+
+
+
+def refill_batches(batches, word2id, examples, batch_size, context_len, question_len, doc_stride=0, sort_window=160, keep_contexts_together=True):
     """
     This is similar to refill_batches in data_batcher.py, but:
-      (1) instead of reading from (preprocessed) datafiles, it reads from the provided lists
+      (1) instead of reading from (preprocessed) datafiles, it reads from the examples iterator
       (2) it only puts the context and question information in the batches (not the answer information)
       (3) it also gets UUID information and puts it in the batches
+      (4) it also records the position of each example's question in the input,
+        so that the input order can be restored after the examples are sorted by length
 
     Inputs:
       batches: list to be refilled
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
+      word2id: dictionary mapping word (string) to word id (int)
+      examples: iterator of (qn_idx, (qn_uuid, context_tokens, qn_tokens)), as made by get_batch_chunks
       batch_size: int. size of batches to make
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      doc_stride: int. If 0, contexts longer than context_len are truncated.
+        Otherwise they are split into overlapping windows (see get_window_starts),
+        and each window becomes a separate example with the same uuid.
+      sort_window: int. Read this many batches' worth of examples, and sort them by (context length, question length)
+        so that each batch has inputs of similar length (RNNEncoder only runs for the length of the longest input in the batch).
+        If 0, read about one batch and keep the input order.
+      keep_contexts_together: If True, keep the examples for each context (window) together when sorting,
+        ordered by question length, so that the context encoding cache can reuse its encoding.
 
     Makes batches that contain:
-      uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch: all lists length batch_size
+      uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch, window_starts_batch, qn_idxs_batch: all lists length batch_size
     """
-    examples = []
+    windows = []
 
-    # Get next example
-    qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
+    for qn_idx, (qn_uuid, context_tokens, qn_tokens) in examples:
 
-    while qn_uuid and context_tokens and qn_tokens:
+        # Skip empty contexts and questions (there's no span to predict)
+        if not context_tokens or not qn_tokens:
+            continue
 
         # Convert context_tokens and qn_tokens to context_ids and qn_ids
         context_ids = [word2id.get(w, UNK_ID) for w in context_tokens]
         qn_ids = [word2id.get(w, UNK_ID) for w in qn_tokens]
 
-        # Truncate context_ids and qn_ids
-        # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
+        # Truncate qn_ids
         if len(qn_ids) > question_len:
             qn_ids = qn_ids[:question_len]
-        if len(context_ids) > context_len:
-            context_ids = context_ids[:context_len]
 
-        # Add to list of examples
-        examples.append((qn_uuid, context_tokens, context_ids, qn_ids))
-
-        # Stop if you've got a batch
-        if len(examples) == batch_size:
+        if doc_stride == 0:
+            # Truncate context_ids
+            # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
+            # Use doc_stride > 0 to avoid this.
+            window_starts = [0]
+        else:
+            # Split context_ids into overlapping windows, so that every token is in some window
+            window_starts = get_window_starts(len(context_ids), context_len, doc_stride)
+
+        # Add to list of windows (one example per window)
+        for window_start in window_starts:
+            windows.append((qn_uuid, context_tokens, context_ids[window_start : window_start + context_len], qn_ids, window_start, qn_idx))
+
+        # Stop refilling if you have sort_window batches.
+        # Note: this only happens between questions, so all the windows of a question are in the same refill
+        if len(windows) >= batch_size * max(sort_window, 1):
             break
 
-        # Get next example
-        qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
+    if sort_window > 0:
+        # Sort by context length, then question length.
+        # Note: the sort is stable, so the windows of a question stay in order (generate_answers keeps the first of equally good windows)
+        if keep_contexts_together:
+            # The questions about a context share its context_tokens list. Key each context window by where it first appears
+            context_window_pos = {}
+            for pos, window in enumerate(windows):
+                context_window_pos.setdefault((id(window[1]), window[4]), pos)
+            windows.sort(key=lambda w: (len(w[2]), context_window_pos[(id(w[1]), w[4])], len(w[3])))
+        else:
+            windows.sort(key=lambda w: (len(w[2]), len(w[3])))
 
     # Make into batches
-    for batch_start in xrange(0, len(examples), batch_size):
-        uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch = zip(*examples[batch_start:batch_start + batch_size])
-
-        batches.append((uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch))
+    for batch_start in xrange(0, len(windows), batch_size):
+        batches.append(zip(*windows[batch_start:batch_start + batch_size]))
 
     return
 
 
 
-def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+def make_batch(uuids, context_tokens, context_ids, qn_ids, window_starts, qn_idxs, context_len, question_len):
+    """Pads one of the batches made by refill_batches, and makes it into a Batch object"""
+    # Pad context_ids and qn_ids
+    qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
+    context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+
+    # Make qn_ids into a np array and create qn_mask
+    qn_ids = np.array(qn_ids)
+    qn_mask = (qn_ids != PAD_ID).astype(np.int32)
+
+    # Make context_ids into a np array and create context_mask
+    context_ids = np.array(context_ids)
+    context_mask = (context_ids != PAD_ID).astype(np.int32)
+
+    # Make into a Batch object
+    return Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids, window_starts=window_starts, qn_idxs=qn_idxs)
+
+
+
+def get_batch_chunks(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, doc_stride=0, sort_window=160, keep_contexts_together=True):
     """
-    This is similar to get_batch_generator in data_batcher.py, but with some
-    differences (see explanation in refill_batches).
+    Reads the examples in chunks of sort_window batches (see refill_batches), and yields each chunk.
+    The data is only iterated over, so the lists passed in are left as they are,
+    and iterators (e.g. for streaming) work too.
 
-    Inputs:
-      word2id: dictionary mapping word (string) to word id (int)
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
-      batch_size: int. size of batches to make
-      context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+    Inputs: as for get_batch_generator
 
     Yields:
-      Batch objects, but they only contain context and question information (no answer information)
+      chunk: iterator of Batch objects, sorted by length (unless sort_window is 0).
+        All the windows of a question are in the same chunk, and batch.qn_idxs gives the position
+        of each example's question in the input, so the input order can be restored.
     """
-    batches = []
+    examples = enumerate(izip(qn_uuid_data, context_token_data, qn_token_data))
 
     while True:
-        if len(batches) == 0:
-            refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len)
+        batches = []
+        refill_batches(batches, word2id, examples, batch_size, context_len, question_len, doc_stride, sort_window, keep_contexts_together)
         if len(batches) == 0:
             break
 
-        # Get next batch. These are all lists length batch_size
-        (uuids, context_tokens, context_ids, qn_ids) = batches.pop(0)
+        # Make the Batch objects as they're used, as they're much bigger than the lists of ids
+        yield (make_batch(*batch, context_len=context_len, question_len=question_len) for batch in batches)
 
-        # Pad context_ids and qn_ids
-        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
-        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+    return
 
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32)
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids)
-        context_mask = (context_ids != PAD_ID).astype(np.int32)
 
-        # Make into a Batch object
-        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids)
+def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, doc_stride=0, sort_window=160, keep_contexts_together=True):
+    """
+    This is similar to get_batch_generator in data_batcher.py, but with some
+    differences (see explanation in refill_batches).
+
+    Inputs:
+      word2id: dictionary mapping word (string) to word id (int)
+      qn_uuid_data: list (or iterator) of strings that are unique ids
+      context_token_data, qn_token_data: lists (or iterators) of lists of strings (no UNKs, no padding)
+      batch_size: int. size of batches to make
+      context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      doc_stride: int. If nonzero, split long contexts into overlapping windows instead of truncating them.
+      sort_window, keep_contexts_together: how to sort the examples by length (see refill_batches)
 
-        yield batch
+    Yields:
+      Batch objects, but they only contain context and question information (no answer information).
+      The examples aren't in input order (see get_batch_chunks).
+    """
+    for chunk in get_batch_chunks(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, doc_stride, sort_window, keep_contexts_together):
+        for batch in chunk:
+            yield batch
 
     return
 
 
-def preprocess_dataset(dataset):
+
+def preprocess_dataset(dataset, num_processes=1, token_cache_path=None):
     """
     Note: this is similar to squad_preprocess.preprocess_and_write, but:
       (1) We only extract the context and question information from the JSON file.
@@ -152,6 +230,7 @@ def preprocess_dataset(dataset):
 
     Input:
       dataset: data read from SQuAD JSON file
+      num_processes, token_cache_path: see iter_dataset
 
     Returns:
       qn_uuid_data, context_token_data, qn_token_data: lists of uuids, tokenized context and tokenized questions
@@ -160,44 +239,169 @@ def preprocess_dataset(dataset):
     context_token_data = []
     qn_token_data = []
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing data"):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
+    for question_uuid, context_tokens, question_tokens in iter_dataset(dataset, num_processes=num_processes, token_cache_path=token_cache_path):
+        qn_uuid_data.append(question_uuid)
+        context_token_data.append(context_tokens)
+        qn_token_data.append(question_tokens)
 
-            context = unicode(article_paragraphs[pid]['context']) # string
+    return qn_uuid_data, context_token_data, qn_token_data
 
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
 
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
+def tokenize_paragraphs(paragraphs):
+    """
+    Tokenizes the contexts and questions of one article. Run in a process pool by tokenize_articles.
 
-            qas = article_paragraphs[pid]['qas'] # list of questions
+    Inputs:
+      paragraphs: list of (context, questions) pairs, where questions is a list of (question_uuid, question) pairs.
+        None for paragraphs that don't need tokenizing.
 
-            # for each question
-            for qn in qas:
+    Returns:
+      tokenized: list (one per paragraph) of (context_tokens, qn_tokens) pairs, or None.
+        context_tokens is a list of strings (lowercase), and qn_tokens is a dictionary mapping question_uuid to question tokens.
+    """
+    tokenized = []
+    for paragraph in paragraphs:
+        if paragraph is None:
+            tokenized.append(None)
+            continue
+        context, questions = paragraph
+
+        # The following replacements are suggested in the paper
+        # BidAF (Seo et al., 2016)
+        context = unicode(context) # string
+        context = context.replace("''", '" ')
+        context = context.replace("``", '" ')
+
+        context_tokens = tokenize(context) # list of strings (lowercase)
+        qn_tokens = dict((question_uuid, tokenize(unicode(question))) for question_uuid, question in questions)
+        tokenized.append((context_tokens, qn_tokens))
+    return tokenized
+
+
+def tokenize_articles(articles, num_processes, pool=None):
+    """
+    Yields tokenize_paragraphs(paragraphs) for each item of articles, in order.
+    The articles are tokenized by pool if it's given (the caller closes it),
+    otherwise, if num_processes > 1, by a new pool of that many processes.
+    """
+    if pool is None and num_processes <= 1:
+        for paragraphs in articles:
+            yield tokenize_paragraphs(paragraphs)
+        return
+
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(num_processes)
+    try:
+        # imap returns the results in order, so the output doesn't depend on the number of processes
+        for tokenized in pool.imap(tokenize_paragraphs, articles, chunksize=4):
+            yield tokenized
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+def get_token_cache_path(data_filename, cache_dir):
+    """
+    Returns the path in cache_dir of the token cache (see iter_dataset) for the JSON file data_filename.
+    The cache is keyed by a hash of the file's contents, so a changed file is tokenized again.
+    """
+    file_hash = hashlib.sha1("token cache v%i\n" % TOKEN_CACHE_VERSION)
+    with open(data_filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+    return os.path.join(cache_dir, "%s.tokens" % file_hash.hexdigest())
 
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
 
-                # also get the question_uuid
-                question_uuid = qn['id']
+def read_token_cache(token_cache_path):
+    """Yields the tokenized articles saved by write_token_cache"""
+    with open(token_cache_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
 
-                # Append to data lists
-                qn_uuid_data.append(question_uuid)
-                context_token_data.append(context_tokens)
-                qn_token_data.append(question_tokens)
 
-    return qn_uuid_data, context_token_data, qn_token_data
+def write_token_cache(tokenized_articles, token_cache_path):
+    """
+    Yields the tokenized articles, saving them to token_cache_path as they go.
+    The cache file only appears once all of them have been saved.
+    """
+    cache_dir = os.path.dirname(token_cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = "%s.tmp%i" % (token_cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        for tokenized in tokenized_articles:
+            pickle.dump(tokenized, f, pickle.HIGHEST_PROTOCOL)
+            yield tokenized
+    os.rename(tmp_path, token_cache_path)
+
+
+def iter_dataset(dataset, shard_index=0, num_shards=1, skip_uuids=frozenset(), num_processes=1, token_cache_path=None, pool=None):
+    """
+    Like preprocess_dataset, but yields the examples one at a time, tokenizing each article when it's reached.
+
+    Input:
+      dataset: data read from SQuAD JSON file
+      shard_index, num_shards: only yield the questions about every num_shards'th paragraph, starting at shard_index
+        (so the questions about a context stay together)
+      skip_uuids: set of question uuids not to yield (e.g. because they're answered already).
+        Contexts with no questions left aren't tokenized.
+      num_processes, pool: int and multiprocessing.Pool. How to tokenize the articles (see tokenize_articles).
+      token_cache_path: If given, and the file exists, read the tokens from it instead of tokenizing.
+        If it doesn't exist, the whole dataset is tokenized and saved there
+        (unless some questions are skipped, in which case nothing is saved).
 
+    Yields:
+      (question_uuid, context_tokens, question_tokens) triples.
+        The questions about a context share its context_tokens list.
+    """
+    def selected_questions():
+        """Yields, for each article, a list (one per paragraph) of the questions to yield"""
+        paragraph_num = 0
+        for article in dataset['data']:
+            article_qas = []
+            for paragraph in article['paragraphs']:
+                # Skip other shards' paragraphs
+                paragraph_num += 1
+                if (paragraph_num - 1) % num_shards != shard_index:
+                    article_qas.append([])
+                else:
+                    article_qas.append([qn for qn in paragraph['qas'] if qn['id'] not in skip_uuids])
+            yield article_qas
+
+    if token_cache_path and os.path.exists(token_cache_path):
+        print "Reading tokens from %s..." % token_cache_path
+        tokenized_articles = read_token_cache(token_cache_path)
+    else:
+        # Only send the paragraphs with questions to yield to be tokenized
+        articles = ([(paragraph['context'], [(qn['id'], qn['question']) for qn in qas]) if qas else None for paragraph, qas in zip(article['paragraphs'], article_qas)] for article, article_qas in izip(dataset['data'], selected_questions()))
+        tokenized_articles = tokenize_articles(articles, num_processes, pool)
+        if token_cache_path and num_shards == 1 and not skip_uuids:
+            tokenized_articles = write_token_cache(tokenized_articles, token_cache_path)
+
+    # Note: tokenized_articles comes first, so it's run to the end (and write_token_cache finishes writing the cache)
+    for tokenized, article_qas in tqdm(izip(tokenized_articles, selected_questions()), total=len(dataset['data']), desc="Preprocessing data"):
+        for paragraph_tokens, qas in zip(tokenized, article_qas):
+            if not qas:
+                continue
+            context_tokens, qn_tokens = paragraph_tokens
+            for qn in qas:
+                yield qn['id'], context_tokens, qn_tokens[qn['id']]
 
-def get_json_data(data_filename):
+
+def get_json_data(data_filename, num_processes=1, token_cache_dir=""):
     """
     Read the contexts and questions from a .json file (like dev-v1.1.json)
 
+    Inputs:
+      data_filename: path to the .json file
+      num_processes: int. Number of processes to tokenize in.
+      token_cache_dir: If given, cache the tokens in this directory, so the same file isn't tokenized again (see iter_dataset).
+
     Returns:
       qn_uuid_data: list (length equal to dev set size) of unicode strings like '56be4db0acb8001400a502ec'
       context_token_data, qn_token_data: lists (length equal to dev set size) of lists of strings (no UNKs, unpadded)
@@ -212,7 +416,8 @@ def get_json_data(data_filename):
 
     # Get the tokenized contexts and questions, and unique question identifiers
     print "Preprocessing data from %s..." % data_filename
-    qn_uuid_data, context_token_data, qn_token_data = preprocess_dataset(data)
+    token_cache_path = get_token_cache_path(data_filename, token_cache_dir) if token_cache_dir else None
+    qn_uuid_data, context_token_data, qn_token_data = preprocess_dataset(data, num_processes, token_cache_path)
 
     data_size = len(qn_uuid_data)
     assert len(context_token_data) == data_size
@@ -222,7 +427,74 @@ def get_json_data(data_filename):
     return qn_uuid_data, context_token_data, qn_token_data
 
 
-def generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data):
+def predict_batch(session, model, batch, cache, detokenizer):
+    """
+    Gets the predicted answer for each example in batch.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      batch: Batch from get_batch_generator
+      cache: ContextEncodingCache, or None
+      detokenizer: MosesDetokenizer
+
+    Returns:
+      predictions: list length batch_size of (uuid, answer, score) triples.
+        answer is the detokenized predicted answer (string), and score is p_start(start) * p_end(end)
+        (used to choose between windows of the same context).
+    """
+    # Get the predicted spans, and their scores p_start(start) * p_end(end)
+    if cache is not None:
+        start_dist, end_dist = model.get_prob_dists_cached(session, batch, cache)
+    else:
+        start_dist, end_dist = model.get_prob_dists(session, batch)
+    pred_start_batch = np.argmax(start_dist, axis=1)
+    pred_end_batch = np.argmax(end_dist, axis=1)
+    score_batch = start_dist[np.arange(batch.batch_size), pred_start_batch] * end_dist[np.arange(batch.batch_size), pred_end_batch]
+
+    # Convert pred_start_batch and pred_end_batch to lists length batch_size
+    pred_start_batch = pred_start_batch.tolist()
+    pred_end_batch = pred_end_batch.tolist()
+    score_batch = score_batch.tolist()
+
+    predictions = []
+
+    # For each example in the batch:
+    for ex_idx, (pred_start, pred_end, score) in enumerate(zip(pred_start_batch, pred_end_batch, score_batch)):
+
+        # Original context tokens (no UNKs or padding) for this example
+        context_tokens = batch.context_tokens[ex_idx] # list of strings
+
+        # Map the predicted span from the window back to the original context
+        pred_start += batch.window_starts[ex_idx]
+        pred_end += batch.window_starts[ex_idx]
+
+        # Check the predicted span is in range
+        assert pred_start in range(len(context_tokens))
+        assert pred_end in range(len(context_tokens))
+
+        # Predicted answer tokens
+        pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
+
+        # Detokenize
+        predictions.append((batch.uuids[ex_idx], detokenizer.detokenize(pred_ans_tokens, return_str=True), score))
+
+    return predictions
+
+
+def get_eval_batch_size(FLAGS):
+    """Returns the batch size for official_eval mode"""
+    return FLAGS.eval_batch_size or FLAGS.batch_size
+
+
+def get_context_cache(model):
+    """Many questions share a context, so cache the context encodings (if the model supports it)"""
+    if model.FLAGS.context_cache_size > 0 and getattr(model, "context_hiddens", None) is not None:
+        return ContextEncodingCache(model.FLAGS.context_cache_size)
+    return None
+
+
+def generate_answers(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size=None, sort_window=None):
     """
     Given a model, and a set of (context, question) pairs, each with a unique ID,
     use the model to generate an answer for each pair, and return a dictionary mapping
@@ -233,49 +505,179 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
       model: QAModel
       word2id: dictionary mapping word (string) to word id (int)
       qn_uuid_data, context_token_data, qn_token_data: lists
+      batch_size, sort_window: if given, use these instead of FLAGS.eval_batch_size and FLAGS.sort_window
 
     Outputs:
       uuid2ans: dictionary mapping uuid (string) to predicted answer (string; detokenized)
     """
     uuid2ans = {} # maps uuid to string containing predicted answer
+    uuid2score = {} # maps uuid to the score of the best predicted answer so far (when contexts are split into windows)
     data_size = len(qn_uuid_data)
-    num_batches = ((data_size-1) / model.FLAGS.batch_size) + 1
+    batch_size = batch_size or get_eval_batch_size(model.FLAGS)
+    sort_window = model.FLAGS.sort_window if sort_window is None else sort_window
     batch_num = 0
     detokenizer = MosesDetokenizer()
+    cache = get_context_cache(model)
 
     print "Generating answers..."
 
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len):
+    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, model.FLAGS.context_len, model.FLAGS.question_len, model.FLAGS.doc_stride, sort_window, cache is not None):
+
+        for uuid, answer, score in predict_batch(session, model, batch, cache, detokenizer):
+
+            # Keep only the best-scoring window for each uuid
+            if uuid in uuid2score and uuid2score[uuid] >= score:
+                continue
+            uuid2ans[uuid] = answer
+            uuid2score[uuid] = score
 
-        # Get the predicted spans
-        pred_start_batch, pred_end_batch = model.get_start_end_pos(session, batch)
+        batch_num += 1
 
-        # Convert pred_start_batch and pred_end_batch to lists length batch_size
-        pred_start_batch = pred_start_batch.tolist()
-        pred_end_batch = pred_end_batch.tolist()
+        # Progress is counted in questions: with --doc_stride, a question can take several windows (and batches)
+        if batch_num % 10 == 0:
+            print "Generated answers for %i batches (%i/%i questions = %.2f%%)" % (batch_num, len(uuid2ans), data_size, len(uuid2ans)*100.0/data_size)
 
-        # For each example in the batch:
-        for ex_idx, (pred_start, pred_end) in enumerate(zip(pred_start_batch, pred_end_batch)):
+    print "Finished generating answers for dataset."
+    if cache is not None:
+        print "Context encoding cache hit rate: %.2f%%" % (cache.hit_rate() * 100)
 
-            # Original context tokens (no UNKs or padding) for this example
-            context_tokens = batch.context_tokens[ex_idx] # list of strings
+    return uuid2ans
 
-            # Check the predicted span is in range
-            assert pred_start in range(len(context_tokens))
-            assert pred_end in range(len(context_tokens))
 
-            # Predicted answer tokens
-            pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
+def write_jsonl_prediction(f, uuid, answer):
+    """Writes one prediction to an open JSONL predictions file (see stream_answers)"""
+    f.write(unicode(json.dumps({"id": uuid, "answer": answer}, ensure_ascii=False)) + u"\n")
 
-            # Detokenize and add to dict
-            uuid = batch.uuids[ex_idx]
-            uuid2ans[uuid] = detokenizer.detokenize(pred_ans_tokens, return_str=True)
 
-        batch_num += 1
+def read_answered_uuids(jsonl_path):
+    """
+    Reads the uuids answered so far in a JSONL predictions file (see stream_answers), to resume from it.
+    If the run writing it was killed part way through a line, that line is removed from the file.
 
-        if batch_num % 10 == 0:
-            print "Generated answers for %i/%i batches = %.2f%%" % (batch_num, num_batches, batch_num*100.0/num_batches)
+    Returns:
+      answered: set of uuids (strings)
+    """
+    answered = set()
+    size = 0 # bytes of complete lines
+    with io.open(jsonl_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            answered.add(json.loads(line.decode('utf-8'))['id'])
+            size += len(line)
+    with io.open(jsonl_path, 'r+b') as f:
+        f.truncate(size)
+    return answered
+
+
+def stream_answers(session, model, word2id, data_filename, jsonl_out_path, shard_index=0, num_shards=1, resume=True, pool=None, token_cache_dir=""):
+    """
+    Like get_json_data and generate_answers together, but tokenizes, batches and predicts
+    the questions as it goes, appending the answers to a JSONL file (one {"id": ..., "answer": ...}
+    object per line) after each chunk of batches (see get_batch_chunks), in input order. Apart from the JSON data itself, memory use doesn't
+    grow with the size of the dataset, and the answers so far are on disk if the run stops early.
+
+    If jsonl_out_path exists already and resume is True, the questions it answers are skipped
+    and the new answers are appended to it, so a run that crashed or was killed can be restarted
+    without losing its work.
+
+    Use convert_predictions.py to turn the JSONL file into the official predictions JSON.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      data_filename: path to a .json file (like dev-v1.1.json)
+      jsonl_out_path: path to write the predictions to
+      shard_index, num_shards: only answer this shard of the questions (see iter_dataset)
+      resume: If False, start jsonl_out_path afresh even if it exists.
+      pool: multiprocessing.Pool to tokenize the data in, or None to tokenize in this process.
+        Start it before opening session: forking once TensorFlow's threads are running isn't safe.
+      token_cache_dir: If given, cache the tokens in this directory (see get_json_data)
+
+    Returns:
+      num_answers: int. The number of predictions written by this run.
+    """
+    # Check the data file exists
+    if not os.path.exists(data_filename):
+        raise Exception("JSON input file does not exist: %s" % data_filename)
+
+    print "Reading data from %s..." % data_filename
+    data = data_from_json(data_filename)
+
+    token_cache_path = get_token_cache_path(data_filename, token_cache_dir) if token_cache_dir else None
+
+    answered = set()
+    if resume and os.path.exists(jsonl_out_path):
+        answered = read_answered_uuids(jsonl_out_path)
+        print "Resuming from %s: %i questions answered already" % (jsonl_out_path, len(answered))
+
+    # get_batch_chunks reads the uuids, contexts and questions from separate iterators,
+    # in step, so tee only ever holds one example
+    uuid_iter, context_iter, qn_iter = [imap(itemgetter(i), examples) for i, examples in enumerate(tee(iter_dataset(data, shard_index, num_shards, answered, token_cache_path=token_cache_path, pool=pool), 3))]
+
+    detokenizer = MosesDetokenizer()
+    cache = get_context_cache(model)
+    num_answers = 0
+    batch_num = 0
+
+    print "Generating answers..."
+
+    with io.open(jsonl_out_path, 'a' if answered else 'w', encoding='utf-8') as f:
+        for chunk in get_batch_chunks(word2id, uuid_iter, context_iter, qn_iter, get_eval_batch_size(model.FLAGS), model.FLAGS.context_len, model.FLAGS.question_len, model.FLAGS.doc_stride, model.FLAGS.sort_window, cache is not None):
+            best = {} # maps qn_idx to (uuid, answer, score) of the best-scoring window so far
+
+            for batch in chunk:
+                # Keep only the best-scoring window for each question (ties go to the first window, as in generate_answers)
+                for qn_idx, (uuid, answer, score) in zip(batch.qn_idxs, predict_batch(session, model, batch, cache, detokenizer)):
+                    if qn_idx not in best or best[qn_idx][2] < score:
+                        best[qn_idx] = (uuid, answer, score)
+
+                batch_num += 1
+                if batch_num % 10 == 0:
+                    print "Generated answers for %i batches (%i questions)" % (batch_num, num_answers + len(best))
+
+            # All the chunk's questions are answered now. Write them in input order
+            for qn_idx in sorted(best):
+                uuid, answer, _ = best[qn_idx]
+                write_jsonl_prediction(f, uuid, answer)
+            num_answers += len(best)
+            f.flush()
 
     print "Finished generating answers for dataset."
+    if cache is not None:
+        print "Context encoding cache hit rate: %.2f%%" % (cache.hit_rate() * 100)
 
-    return uuid2ans
+    return num_answers
+
+
+def get_shard_path(jsonl_out_path, shard_index, num_shards):
+    """Returns the path of the JSONL predictions file for one shard of a sharded official_eval run"""
+    return "%s-%05i-of-%05i" % (jsonl_out_path, shard_index, num_shards)
+
+
+def run_shards(command, num_shards):
+    """
+    Runs official_eval mode on num_shards shards of the questions at once, each in its own process
+    (with its own TensorFlow session), and waits for them all to finish.
+
+    Inputs:
+      command: list of strings. Command that runs main.py in official_eval mode.
+        --job_name=eval and --task_index (the shard index) are appended to it for each process.
+      num_shards: int
+    """
+    processes = [subprocess.Popen(command + ["--job_name=eval", "--task_index=%i" % i]) for i in range(num_shards)]
+    failed = [i for i, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise Exception("official_eval failed for shards %s. Run it again to resume." % failed)
+
+
+def merge_shards(jsonl_out_path, num_shards):
+    """
+    Concatenates the shards' JSONL predictions files into jsonl_out_path.
+    The shard files are kept, so a rerun resumes from them.
+    """
+    with io.open(jsonl_out_path, 'wb') as f:
+        for shard_index in range(num_shards):
+            with io.open(get_shard_path(jsonl_out_path, shard_index, num_shards), 'rb') as shard_file:
+                shutil.copyfileobj(shard_file, f)
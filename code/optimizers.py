@@ -0,0 +1,196 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains the learning rate schedule and optimizers for large-batch training.
+
+The learning rate is scaled with the effective batch size (batch_size * grad_accum_steps * number of workers)
+relative to lr_base_batch_size, and ramped up linearly over the first warmup_steps updates.
+
+LAMB (Adam with a per-layer trust ratio) and LARS (momentum SGD with a per-layer trust ratio)
+scale each variable's update by the ratio of its weight norm to its update norm,
+which keeps training stable at learning rates where Adam or plain SGD diverge.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import tensorflow as tf
+
+
+OPTIMIZERS = ["adam", "lamb", "lars"]
+LR_SCALING_RULES = ["none", "linear", "sqrt"]
+
+
+def effective_batch_size(FLAGS):
+    """Returns the number of examples in each parameter update"""
+    return FLAGS.batch_size * FLAGS.grad_accum_steps * max(FLAGS.num_workers, 1)
+
+
+def get_learning_rate(FLAGS, global_step):
+    """
+    Inputs:
+      FLAGS: the flags passed in from main.py. Uses learning_rate, lr_scaling, lr_base_batch_size and warmup_steps.
+      global_step: the global step variable
+
+    Returns:
+      learning_rate: scalar tensor. learning_rate scaled for the effective batch size
+        ("linear": by effective batch size / lr_base_batch_size, "sqrt": by its square root),
+        times global_step / warmup_steps during warmup.
+    """
+    ratio = effective_batch_size(FLAGS) / FLAGS.lr_base_batch_size
+    if FLAGS.lr_scaling == "linear":
+        scale = ratio
+    elif FLAGS.lr_scaling == "sqrt":
+        scale = ratio ** 0.5
+    else:
+        scale = 1.
+    learning_rate = tf.constant(FLAGS.learning_rate * scale, dtype=tf.float32)
+
+    if FLAGS.warmup_steps > 0:
+        warmup = tf.minimum(1., tf.cast(global_step + 1, tf.float32) / FLAGS.warmup_steps)
+        learning_rate *= warmup
+
+    return learning_rate
+
+
+def get_optimizer(FLAGS, learning_rate):
+    """Returns the tf.train.Optimizer chosen by FLAGS.optimizer"""
+    if FLAGS.optimizer == "adam":
+        return tf.train.AdamOptimizer(learning_rate=learning_rate)
+    elif FLAGS.optimizer == "lamb":
+        return LAMBOptimizer(learning_rate=learning_rate, weight_decay=FLAGS.weight_decay)
+    elif FLAGS.optimizer == "lars":
+        return LARSOptimizer(learning_rate=learning_rate, momentum=FLAGS.momentum, weight_decay=FLAGS.weight_decay)
+    else:
+        raise Exception("Unknown optimizer: %s" % FLAGS.optimizer)
+
+
+def trust_ratio(weight_norm, update_norm, coefficient=1.):
+    """Returns coefficient * weight_norm / update_norm, or 1 if either norm is zero (e.g. for a freshly zeroed bias)"""
+    return tf.where(tf.logical_and(weight_norm > 0, update_norm > 0), coefficient * weight_norm / update_norm, tf.ones_like(weight_norm))
+
+
+class LayerwiseOptimizer(tf.train.Optimizer):
+    """
+    Base class for LAMB and LARS. Subclasses implement _apply_dense.
+
+    Sparse gradients (e.g. from the character embeddings) are made dense first,
+    because the trust ratio needs the norm of the whole update.
+    """
+
+    def _apply_sparse_duplicate_indices(self, grad, var):
+        dense_grad = tf.unsorted_segment_sum(grad.values, grad.indices, tf.shape(var)[0])
+        return self._apply_dense(dense_grad, var)
+
+
+class LAMBOptimizer(LayerwiseOptimizer):
+    """
+    Adam, with weight decay added to the update, and each variable's update scaled by
+    ||weights|| / ||update|| (You et al., 2019: Large Batch Optimization for Deep Learning).
+    """
+
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-6, weight_decay=0., use_locking=False, name="LAMB"):
+        super(LAMBOptimizer, self).__init__(use_locking, name)
+        self._lr = learning_rate
+        self._beta1 = beta1
+        self._beta2 = beta2
+        self._epsilon = epsilon
+        self._weight_decay = weight_decay
+
+    def _create_slots(self, var_list):
+        for v in var_list:
+            self._zeros_slot(v, "m", self._name)
+            self._zeros_slot(v, "v", self._name)
+            # Each variable keeps its own step count for bias correction
+            self._get_or_make_slot(v, tf.zeros([], dtype=v.dtype.base_dtype), "step", self._name)
+
+    def _apply_dense(self, grad, var):
+        m, v, step = self.get_slot(var, "m"), self.get_slot(var, "v"), self.get_slot(var, "step")
+        m_t = m.assign(self._beta1 * m + (1. - self._beta1) * grad, use_locking=self._use_locking)
+        v_t = v.assign(self._beta2 * v + (1. - self._beta2) * tf.square(grad), use_locking=self._use_locking)
+        step_t = step.assign_add(1., use_locking=self._use_locking)
+        m_hat = m_t / (1. - tf.pow(self._beta1, step_t))
+        v_hat = v_t / (1. - tf.pow(self._beta2, step_t))
+
+        update = m_hat / (tf.sqrt(v_hat) + self._epsilon) + self._weight_decay * var
+        ratio = trust_ratio(tf.norm(var), tf.norm(update))
+        var_update = var.assign_sub(self._lr * ratio * update, use_locking=self._use_locking)
+        return tf.group(var_update, m_t, v_t, step_t)
+
+
+class LARSOptimizer(LayerwiseOptimizer):
+    """
+    Momentum SGD, with each variable's learning rate scaled by
+    eta * ||weights|| / (||gradient|| + weight_decay * ||weights||)
+    (You et al., 2017: Large Batch Training of Convolutional Networks).
+
+    Biases (and other variables with less than 2 dimensions) are left out of the scaling, as in the paper:
+    they start at zero, and a ratio of eta * ||weights|| would keep them near zero.
+    """
+
+    def __init__(self, learning_rate, momentum=0.9, weight_decay=0., eta=0.001, use_locking=False, name="LARS"):
+        super(LARSOptimizer, self).__init__(use_locking, name)
+        self._lr = learning_rate
+        self._momentum = momentum
+        self._weight_decay = weight_decay
+        self._eta = eta
+
+    def _create_slots(self, var_list):
+        for v in var_list:
+            self._zeros_slot(v, "momentum", self._name)
+
+    def _apply_dense(self, grad, var):
+        if var.get_shape().ndims < 2:
+            local_lr = 1.
+        else:
+            # eta only scales the trust ratio, not its fallback of 1 (as in tf.contrib.opt.LARSOptimizer)
+            weight_norm = tf.norm(var)
+            local_lr = trust_ratio(weight_norm, tf.norm(grad) + self._weight_decay * weight_norm, self._eta)
+        momentum = self.get_slot(var, "momentum")
+        momentum_t = momentum.assign(self._momentum * momentum + self._lr * local_lr * (grad + self._weight_decay * var), use_locking=self._use_locking)
+        var_update = var.assign_sub(momentum_t, use_locking=self._use_locking)
+        return tf.group(var_update, momentum_t)
+
+
+def train_zero_init_bias(optimizer, target, num_steps=500):
+    """
+    Trains a zero-initialized bias towards target with an L2 loss, and returns its final value.
+    A check that the trust ratio doesn't stall variables that start at zero.
+
+    Inputs:
+      optimizer: a tf.train.Optimizer
+      target: list of floats
+      num_steps: int
+
+    Returns:
+      Numpy array, same length as target
+    """
+    with tf.Graph().as_default():
+        bias = tf.Variable(tf.zeros([len(target)]))
+        loss = tf.reduce_sum(tf.square(bias - tf.constant(target)))
+        train_op = optimizer.minimize(loss)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(num_steps):
+                sess.run(train_op)
+            return sess.run(bias)
+
+
+if __name__ == '__main__':
+    # Usage: python optimizers.py
+    target = [1., -2., 3., 0.5]
+    for name, optimizer in [("momentum", tf.train.MomentumOptimizer(0.1, 0.9)), ("lamb", LAMBOptimizer(0.1)), ("lars", LARSOptimizer(0.1))]:
+        final = train_zero_init_bias(optimizer, target)
+        print "%s: %s" % (name, final)
+        assert max(abs(final - target)) < 0.05, "%s didn't train a zero-initialized bias" % name
@@ -30,6 +30,7 @@ from tensorflow.python.ops import embedding_ops
 from evaluate import exact_match_score, f1_score
 from data_batcher import get_batch_generator
 from pretty_print import print_example
+from optimizers import get_learning_rate, get_optimizer
 from modules import RNNEncoder, SimpleSoftmaxLayer, BasicAttn, AoA
 
 logging.basicConfig(level=logging.INFO)
@@ -38,7 +39,7 @@ logging.basicConfig(level=logging.INFO)
 class QAoAModel(object):
     """Top-level Question Answering module"""
 
-    def __init__(self, FLAGS, id2word, word2id, emb_matrix):
+    def __init__(self, FLAGS, id2word, word2id, emb_matrix, training=True):
         """
         Initializes the QA model.
 
@@ -47,6 +48,7 @@ class QAoAModel(object):
           id2word: dictionary mapping word idx (int) to word (string)
           word2id: dictionary mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+          training: If False, only build the forward pass (no gradients, optimizer or summaries).
         """
         print "Initializing the QAModel..."
         self.FLAGS = FLAGS
@@ -60,23 +62,30 @@ class QAoAModel(object):
             self.build_graph()
             self.add_loss()
 
-        # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
-        params = tf.trainable_variables()
-        gradients = tf.gradients(self.loss, params)
-        self.gradient_norm = tf.global_norm(gradients)
-        clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
-        self.param_norm = tf.global_norm(params)
-
-        # Define optimizer and updates
-        # (updates is what you need to fetch in session.run to do a gradient update)
         self.global_step = tf.Variable(0, name="global_step", trainable=False)
-        opt = tf.train.AdamOptimizer(learning_rate=FLAGS.learning_rate) # you can try other optimizers
-        self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
 
-        # Define savers (for checkpointing) and summaries (for tensorboard)
+        if training:
+            # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
+            params = tf.trainable_variables()
+            gradients = tf.gradients(self.loss, params)
+            self.gradient_norm = tf.global_norm(gradients)
+            clipped_gradients, _ = tf.clip_by_global_norm(gradients, FLAGS.max_gradient_norm)
+            self.param_norm = tf.global_norm(params)
+
+            # Define optimizer and updates
+            # (updates is what you need to fetch in session.run to do a gradient update)
+            # (the learning rate is scaled for the effective batch size and warmed up, see optimizers.py)
+            self.learning_rate = get_learning_rate(FLAGS, self.global_step)
+            tf.summary.scalar('learning_rate', self.learning_rate)
+            opt = get_optimizer(FLAGS, self.learning_rate)
+            self.updates = opt.apply_gradients(zip(clipped_gradients, params), global_step=self.global_step)
+
+            # Define summaries (for tensorboard)
+            self.summaries = tf.summary.merge_all()
+
+        # Define savers (for checkpointing)
         self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=FLAGS.keep)
         self.bestmodel_saver = tf.train.Saver(tf.global_variables(), max_to_keep=1)
-        self.summaries = tf.summary.merge_all()
 
 
     def add_placeholders(self):
@@ -0,0 +1,136 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code for post-training int8 quantization of model weights,
+for use with the NumPy forward pass in numpy_inference.py.
+
+Every weight matrix (the GRU kernels and fully_connected weights)
+is stored as int8 with one float32 scale per output channel (column).
+Biases and weight vectors (e.g. the BiDAF similarity weights) stay in float32.
+
+int8 is only a storage format, making the .npz file about 4x smaller.
+NumPy has no int8 GEMM (np.dot would convert the int8 values to float on every call,
+which is slower than float32), so NumpyModel dequantizes the kernels once when it's built
+and runs at float32 speed. benchmark_quantized mode reports the accuracy cost.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+SCALE_SUFFIX = ":scale" # suffix of the scale arrays in a quantized .npz file
+
+
+class QuantizedKernel(object):
+    """
+    A weight matrix W of shape (input_size, output_size),
+    approximated as values * scale where values is int8 and scale has one entry per column.
+    """
+
+    def __init__(self, values, scale):
+        """
+        Inputs:
+          values: Numpy array of int8, shape (input_size, output_size)
+          scale: Numpy array of float32, shape (output_size)
+        """
+        self.values = values
+        self.scale = scale
+        self.shape = values.shape
+
+    def dequantize(self):
+        """Returns the float32 approximation of W"""
+        return self.values.astype(np.float32) * self.scale
+
+
+def quantize_kernel(kernel):
+    """
+    Symmetric per-channel int8 quantization of a weight matrix.
+
+    Inputs:
+      kernel: Numpy array shape (input_size, output_size)
+
+    Returns:
+      QuantizedKernel
+    """
+    max_abs = np.max(np.abs(kernel), axis=0) # shape (output_size)
+    scale = np.where(max_abs > 0, max_abs / 127., 1.).astype(np.float32)
+    values = np.clip(np.round(kernel / scale), -127, 127).astype(np.int8)
+    return QuantizedKernel(values, scale)
+
+
+def quantize_weights(weights):
+    """
+    Quantizes every weight matrix in weights.
+
+    Inputs:
+      weights: dictionary of weights (see numpy_inference.load_checkpoint_weights)
+
+    Returns:
+      quantized: same keys as weights. 2-D arrays are replaced by QuantizedKernels.
+    """
+    quantized = {}
+    for name, value in weights.items():
+        quantized[name] = quantize_kernel(value) if value.ndim == 2 else value
+    return quantized
+
+
+def quantization_error(weights, quantized):
+    """Returns the largest absolute difference between any weight and its quantized version"""
+    error = 0.
+    for name, value in weights.items():
+        if isinstance(quantized[name], QuantizedKernel):
+            error = max(error, float(np.max(np.abs(value - quantized[name].dequantize()))))
+    return error
+
+
+def save_quantized_weights(quantized, path):
+    """Saves the dictionary returned by quantize_weights to a .npz file"""
+    arrays = {}
+    for name, value in quantized.items():
+        if isinstance(value, QuantizedKernel):
+            arrays[name] = value.values
+            arrays[name + SCALE_SUFFIX] = value.scale
+        else:
+            arrays[name] = value
+    np.savez(path, **arrays)
+
+
+def weights_nbytes(weights):
+    """Returns the storage size in bytes of a dictionary of weights, which may contain QuantizedKernels"""
+    nbytes = 0
+    for value in weights.values():
+        if isinstance(value, QuantizedKernel):
+            nbytes += value.values.nbytes + value.scale.nbytes
+        else:
+            nbytes += value.nbytes
+    return nbytes
+
+
+def load_quantized_weights(path):
+    """
+    Loads the dictionary saved by save_quantized_weights.
+    Also works for a float32 file written by numpy_inference.save_weights, which has no scale arrays.
+    """
+    data = np.load(path)
+    quantized = {}
+    for name in data.files:
+        if name.endswith(SCALE_SUFFIX):
+            continue
+        if name + SCALE_SUFFIX in data.files:
+            quantized[name] = QuantizedKernel(data[name], data[name + SCALE_SUFFIX])
+        else:
+            quantized[name] = data[name]
+    return quantized
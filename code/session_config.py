@@ -0,0 +1,126 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to build the tf.ConfigProto used for our TensorFlow sessions,
+and to control which CPUs and how many threads TensorFlow uses"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import subprocess
+
+import tensorflow as tf
+
+
+THREAD_CONFIG_FILE = "thread_config.json" # written to the experiment directory by autotune_threads mode
+
+
+def get_session_config(xla_jit=False, intra_op_threads=0, inter_op_threads=0):
+    """
+    Inputs:
+      xla_jit: If True, turn on XLA JIT compilation for the whole graph.
+        XLA fuses clusters of small ops (tensordots, tiles, concats, masked softmaxes)
+        into single kernels, which removes most of the per-op dispatch overhead on CPU.
+        Each cluster is compiled once per input shape: the context and question dimensions
+        are padded to context_len and question_len, and modules.RNNEncoder only trims them
+        to one of NUM_LENGTH_BUCKETS lengths, so there are at most that many compilations
+        per batch size (a smaller final batch is another batch size).
+      intra_op_threads: int. Size of the thread pool used inside a single op (e.g. a matmul).
+        0 means TensorFlow's default, which is one thread per core.
+      inter_op_threads: int. Size of the thread pool used to run independent ops in parallel.
+        0 means TensorFlow's default, which is one thread per core.
+
+    Note that TensorFlow creates its thread pools for the first session in the process,
+    so these settings have to be the same for every session in the process.
+
+    Returns:
+      config: tf.ConfigProto
+    """
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+    config.intra_op_parallelism_threads = intra_op_threads
+    config.inter_op_parallelism_threads = inter_op_threads
+    if xla_jit:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
+def parse_cpu_list(cpu_list):
+    """
+    Inputs:
+      cpu_list: string in taskset format, e.g. "0-3,8"
+
+    Returns:
+      cpus: sorted list of ints, e.g. [0, 1, 2, 3, 8]
+    """
+    cpus = set()
+    for part in cpu_list.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def set_cpu_affinity(cpu_list):
+    """
+    Pins this process (and any threads it starts afterwards) to the given CPUs,
+    so that several jobs on one host don't compete for the same cores.
+    Call this before creating any TensorFlow session.
+
+    Uses psutil if it's installed, otherwise the taskset command.
+
+    Inputs:
+      cpu_list: string in taskset format, e.g. "0-3,8"
+    """
+    cpus = parse_cpu_list(cpu_list)
+    try:
+        import psutil
+        psutil.Process().cpu_affinity(cpus)
+    except ImportError:
+        try:
+            subprocess.check_call(["taskset", "-a", "-p", "-c", ",".join(map(str, cpus)), str(os.getpid())])
+        except OSError:
+            raise Exception("Setting --cpu_affinity needs either psutil or the taskset command")
+    print "Pinned process to CPUs %s" % cpu_list
+
+
+def load_thread_config(train_dir, model_name):
+    """
+    Returns the (intra_op_threads, inter_op_threads) recorded for model_name by autotune_threads mode,
+    or None if there isn't one.
+    """
+    path = os.path.join(train_dir, THREAD_CONFIG_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        thread_config = json.load(f)
+    if model_name not in thread_config:
+        return None
+    return thread_config[model_name]["intra_op_threads"], thread_config[model_name]["inter_op_threads"]
+
+
+def save_thread_config(train_dir, model_name, intra_op_threads, inter_op_threads, train_step_time):
+    """Records the best thread pool sizes for model_name, keeping any other models' entries"""
+    path = os.path.join(train_dir, THREAD_CONFIG_FILE)
+    thread_config = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            thread_config = json.load(f)
+    thread_config[model_name] = {"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads, "train_step_time": train_step_time}
+    with open(path, 'w') as f:
+        json.dump(thread_config, f, indent=2, sort_keys=True)
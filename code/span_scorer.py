@@ -0,0 +1,114 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains a fast F1/EM scorer for predicted spans, used during training.
+
+evaluate.f1_score and exact_match_score join the tokens into a string, normalize it
+(see evaluate.normalize_answer) and count the overlap with a Counter, for every example.
+But normalize_answer works token by token: normalizing " ".join(tokens) gives the same words as
+normalizing each token separately and concatenating the results. So SpanScorer normalizes each
+distinct token once, maps the normalized words to integer ids, and then scores a whole batch
+with numpy. The scores are exactly the same as evaluate.py's.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import weakref
+
+import numpy as np
+
+from evaluate import normalize_answer
+
+
+class SpanScorer(object):
+    """Computes the F1 and EM scores of predicted spans against the true answers of a Batch"""
+
+    def __init__(self):
+        self.word2id = {} # normalized word (string) -> word id (int)
+        self.token_words = {} # token (string) -> list of word ids of the normalized token (usually 0 or 1 of them)
+        self.encoded_batches = weakref.WeakKeyDictionary() # Batch -> encoded contexts and answers (see encode_batch)
+
+    def encode_token(self, token):
+        """Returns the list of word ids of the normalized token (empty for punctuation and articles)"""
+        words = self.token_words.get(token)
+        if words is None:
+            words = [self.word2id.setdefault(word, len(self.word2id)) for word in normalize_answer(token).split()]
+            self.token_words[token] = words
+        return words
+
+    def encode_tokens(self, tokens):
+        """
+        Inputs:
+          tokens: list of strings
+
+        Returns:
+          word_ids: numpy array of the word ids of the normalized tokens
+          offsets: numpy array length len(tokens) + 1.
+            The words of tokens[i:j] are word_ids[offsets[i]:offsets[j]].
+        """
+        word_ids = []
+        offsets = [0]
+        for token in tokens:
+            word_ids.extend(self.encode_token(token))
+            offsets.append(len(word_ids))
+        return np.array(word_ids, dtype=np.int64), np.array(offsets)
+
+    def encode_batch(self, batch):
+        """
+        Encodes the contexts and true answers of batch, once per batch
+        (so in-memory batches that are scored many times are only encoded once).
+        """
+        if batch not in self.encoded_batches:
+            contexts = [self.encode_tokens(context_tokens) for context_tokens in batch.context_tokens]
+            answers = [self.encode_tokens(ans_tokens)[0] for ans_tokens in batch.ans_tokens]
+            self.encoded_batches[batch] = (contexts, answers)
+        return self.encoded_batches[batch]
+
+    def score_batch(self, batch, pred_start_pos, pred_end_pos):
+        """
+        Scores the predicted spans against the true answers in batch,
+        like evaluate.f1_score and exact_match_score on the joined tokens.
+
+        Inputs:
+          batch: a Batch
+          pred_start_pos, pred_end_pos: numpy arrays shape (batch_size). Predicted spans (inclusive), in context tokens.
+
+        Returns:
+          f1, em: numpy arrays of floats, shape (batch_size)
+        """
+        contexts, answers = self.encode_batch(batch)
+        preds = [word_ids[offsets[min(start, len(offsets) - 1)] : offsets[min(max(start, end + 1), len(offsets) - 1)]] for (word_ids, offsets), start, end in zip(contexts, pred_start_pos, pred_end_pos)]
+        pred_lens = np.array([len(pred) for pred in preds]) # shape (batch_size)
+        ans_lens = np.array([len(ans) for ans in answers]) # shape (batch_size)
+
+        # Count the words shared by each prediction and answer (the size of the multiset intersection),
+        # for the whole batch at once: key each word by its example, count each key in the predictions and answers,
+        # and sum the minimum of the two counts over each example's keys.
+        num_words = max(len(self.word2id), 1)
+        pred_keys = np.concatenate([pred + ex_idx * num_words for ex_idx, pred in enumerate(preds)] + [np.zeros(0, dtype=np.int64)])
+        ans_keys = np.concatenate([ans + ex_idx * num_words for ex_idx, ans in enumerate(answers)] + [np.zeros(0, dtype=np.int64)])
+        keys, key_idxs = np.unique(np.concatenate([pred_keys, ans_keys]), return_inverse=True)
+        pred_counts = np.bincount(key_idxs[:len(pred_keys)], minlength=len(keys))
+        ans_counts = np.bincount(key_idxs[len(pred_keys):], minlength=len(keys))
+        num_same = np.bincount(keys // num_words, weights=np.minimum(pred_counts, ans_counts), minlength=batch.batch_size) # shape (batch_size)
+
+        precision = num_same / np.maximum(pred_lens, 1)
+        recall = num_same / np.maximum(ans_lens, 1)
+        f1 = np.where(num_same > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.)
+
+        # Exact match: the same words in the same order
+        em = np.array([pred_len == ans_len and np.array_equal(pred, ans) for pred, ans, pred_len, ans_len in zip(preds, answers, pred_lens, ans_lens)], dtype=np.float64)
+
+        return f1, em
@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+
+# Compares time to reach a target dev F1 at batch size 100 (Adam, the default settings)
+# and batch size 800 (LAMB, with the learning rate scaled by sqrt(800 / 100) and warmed up).
+# Both runs evaluate after the same number of examples (every 51,200: 512 steps of 100, or 64 steps of 800)
+# and stop as soon as dev F1 reaches TARGET_F1. The batch order is shuffled differently in each run
+# (data_batcher.refill_batches isn't seeded), so compare averages over a few runs before drawing conclusions.
+#
+# Usage: ./large_batch_experiment.sh [MODEL_NAME] [TARGET_F1]
+# If batch size 800 doesn't fit in memory, replace --batch_size=800 with --batch_size=100 --grad_accum_steps=8
+# (same updates, but without the throughput gain).
+
+HEAD_DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" && pwd )"
+CODE_DIR=$HEAD_DIR/code
+EXP_DIR=$HEAD_DIR/experiments
+
+MODEL_NAME=${1:-baseline}
+TARGET_F1=${2:-0.6}
+
+run() {
+    NAME=$1
+    shift
+    python "$CODE_DIR/main.py" --mode=train --experiment_name="$NAME" --overwrite=True --model_name="$MODEL_NAME" --target_f1="$TARGET_F1" --save_every=100000 "$@"
+}
+
+run large_batch_100 --batch_size=100 --eval_every=512
+run large_batch_800 --batch_size=800 --eval_every=64 --optimizer=lamb --lr_scaling=sqrt --warmup_steps=200
+
+for NAME in large_batch_100 large_batch_800; do
+    echo "$NAME: $(grep "Reached target dev F1" "$EXP_DIR/$NAME/log.txt" || echo "did not reach dev F1 $TARGET_F1")"
+done